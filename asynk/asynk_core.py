@@ -18,7 +18,7 @@
 ## not, see <http://www.gnu.org/licenses/>.
 
 import logging, os, platform
-import re, sys, traceback
+import Queue, re, sys, threading, time, traceback
 
 ## First up we need to fix the sys.path before we can even import stuff we
 ## want... Just some weirdness specific to our code layout...
@@ -46,6 +46,10 @@ from   pimdb_bb         import BBPIMDB
 from   folder_bb        import BBContactsFolder
 import utils
 from   state_collection import collection_id_to_class as coll_id_class
+from   state_collection import CollectionSessions
+
+## The sample profiles that ship with ASynK
+SAMPLE_PROFILES = ['defolbb', 'defbbbb']
 
 class AsynkParserError(Exception):
     pass
@@ -79,15 +83,22 @@ class Asynk:
 
         conf = self.get_config()
         pname = self.get_name()
+        sessions = self.get_sessions()
 
         for coll in self.get_colls():
             coll.init_username_pwd()
-            coll.login()
+            if sessions is not None:
+                sessions.login(coll)
+            else:
+                coll.login()
 
     def reset_fields (self):
         self.atts = {}
 
         self.set_dry_run(True)
+        self.set_pnames(None)
+        self.set_sessions(None)
+        self.set_sync_workers(None)
         self.reset_colls()
 
     def dispatch (self):
@@ -367,11 +378,22 @@ class Asynk:
         logging.info('%s: Not Implemented', 'del_item')
 
     def op_sync (self):
-        conf  = self.get_config()
-        pname = self._load_profile()
+        if self.get_pnames():
+            return self._sync_profiles()
+
+        return self._sync_profile(self._load_profile())
+
+    def _sync_profile (self, pname, set_default=True):
+        """Sync the specified profile, which should already be loaded and
+        logged into. Unless set_default is False, the profile is made the
+        default one for the next run."""
+
+        conf = self.get_config()
 
         startt_old = conf.get_last_sync_start(pname)
         stopt_old  = conf.get_last_sync_stop(pname)
+        token1_old = conf.get_sync_token1(pname)
+        token2_old = conf.get_sync_token2(pname)
 
         if self.is_sync_all():
             # This is the case the user wants to force a sync ignoring the
@@ -380,12 +402,15 @@ class Asynk:
             # such.
             #
             # This works by briefly resetting the last sync start and stop
-            # times to fool the system. If the user is doing a dry run, we
-            # will restore his earlier times dutifully.
+            # times, and dropping the sync tokens of the folders, to fool the
+            # system. If the user is doing a dry run, we will restore his
+            # earlier times dutifully.
             if self.is_dry_run():
                 logging.debug('Temporarily resetting last sync times...')
             conf.set_last_sync_start(pname, val=utils.time_start)
             conf.set_last_sync_stop(pname, val=utils.time_start)
+            conf.set_sync_token1(pname, None)
+            conf.set_sync_token2(pname, None)
         sync = Sync(conf, pname, [x.get_db() for x in self.get_colls()],
                     dr=self.is_dry_run())
         if self.is_dry_run():
@@ -394,6 +419,8 @@ class Asynk:
             # real older sync is sort of called for.
             conf.set_last_sync_start(pname, val=startt_old)
             conf.set_last_sync_stop(pname, val=stopt_old)
+            conf.set_sync_token1(pname, token1_old)
+            conf.set_sync_token2(pname, token2_old)
             logging.debug('Reset last sync timestamps to real values')
         else:
             try:
@@ -402,6 +429,7 @@ class Asynk:
                 if result:
                     conf.set_last_sync_start(pname, val=startt)
                     conf.set_last_sync_stop(pname)
+                    sync.save_sync_tokens()
                     logging.info('Updating item inventory...')
                     sync.save_item_lists()
                     logging.info('Updating item inventory...done')
@@ -414,11 +442,150 @@ class Asynk:
                 logging.critical(traceback.format_exc())
                 return False
 
-        if not pname in ['defolbb', 'defbbbb']:
+        for coll in self.get_colls():
+            coll.get_db().log_stats()
+            coll.get_db().close_idle()
+
+        if set_default and not pname in SAMPLE_PROFILES:
             conf.set_default_profile(pname)
 
         return True
 
+    def _sync_profiles (self):
+        """Sync each of the profiles set with set_pnames(), on a pool of
+        worker threads. Profiles that have a collection in common share the
+        login to it, and are synched one after the other by the same worker;
+        the rest are synched in parallel. A summary of the time taken by each
+        profile is logged at the end. Returns True if all the profiles were
+        synched successfully."""
+
+        conf   = self.get_config()
+        pnames = self.get_pnames()
+        if pnames == ['all']:
+            pnames = [x for x in conf.get_profile_names()
+                      if not x in SAMPLE_PROFILES]
+
+        for pname in pnames:
+            if not conf.profile_exists(pname):
+                raise AsynkParserError('Profile "%s" not found' % pname)
+
+        ## Set up the collections and credentials of all profiles right here,
+        ## as the user may have to be prompted for them.
+        sessions = CollectionSessions()
+        asynks   = {}
+        for pname in pnames:
+            a = Asynk(conf, self.alogger)
+            a.set_op('op_sync')
+            a.set_name(pname)
+            a.set_dry_run(self.is_dry_run())
+            a.set_sync_all(self.is_sync_all())
+            a.set_sync_dir(self.get_sync_dir())
+            a.set_conflict_resolve(self.get_conflict_resolve())
+            a.set_sessions(sessions)
+            a._load_profile(login=False)
+
+            for coll in a.get_colls():
+                coll.init_username_pwd()
+
+            asynks[pname] = a
+
+        ## Group profiles with common collections, keeping the order in which
+        ## they were specified within each group.
+        group = dict([(p, [p]) for p in pnames])
+        owner = {}
+        for pname in pnames:
+            for coll in asynks[pname].get_colls():
+                other = owner.setdefault(coll.get_session_key(), pname)
+                if group[other] is not group[pname]:
+                    merged = [p for p in pnames
+                              if p in group[other] or p in group[pname]]
+                    for p in merged:
+                        group[p] = merged
+
+        groups = []
+        for pname in pnames:
+            if not group[pname] in groups:
+                groups.append(group[pname])
+
+        queue = Queue.Queue()
+        for g in groups:
+            queue.put(g)
+
+        results = {}
+        def worker ():
+            while True:
+                try:
+                    g = queue.get_nowait()
+                except Queue.Empty, e:
+                    return
+
+                for pname in g:
+                    results[pname] = self._sync_one_profile(asynks[pname])
+
+        nworkers = self.get_sync_workers() or conf.get_sync_workers()
+        nworkers = max(1, min(nworkers, len(groups)))
+        logging.info('Synching %d profiles in %d groups with %d workers',
+                     len(pnames), len(groups), nworkers)
+
+        start   = time.time()
+        threads = [threading.Thread(target=worker, name='sync-%d' % i)
+                   for i in range(nworkers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        total = time.time() - start
+
+        logging.info('=====================================================')
+        logging.info('   %-30s %8s %10s', 'Profile', 'Result', 'Seconds')
+        logging.info('=====================================================')
+        for pname in pnames:
+            res, secs = results[pname]
+            logging.info('   %-30s %8s %10.2f', pname,
+                         'ok' if res else 'FAILED', secs)
+        logging.info('=====================================================')
+        logging.info('   %-30s %8s %10.2f', 'Total (wall clock)', '', total)
+
+        ## The default profile for the next run is the last of the ones
+        ## specified to have been synched, as it would be if they had been
+        ## synched one after the other.
+        done = [p for p in pnames if results[p][0] and
+                not p in SAMPLE_PROFILES]
+        if done:
+            conf.set_default_profile(done[-1])
+
+        return all([results[p][0] for p in pnames])
+
+    def _sync_one_profile (self, asynk):
+        """Sync the profile of the specified Asynk object, and return a tuple
+        of whether it succeeded, and the time it took."""
+
+        pname = asynk.get_name()
+        logging.info('Synching profile %s...', pname)
+
+        start = time.time()
+        try:
+            asynk._login()
+            res = asynk._sync_profile(pname, set_default=False)
+        except Exception, e:
+            logging.critical('Exception (%s) while syncing profile %s',
+                             str(e), pname)
+            logging.critical(traceback.format_exc())
+            res = False
+        finally:
+            ## The worker thread is done with the profile, and the sessions
+            ## it opened are not going to be used by it again.
+            for coll in asynk.get_colls():
+                if coll.get_db():
+                    coll.get_db().release_session()
+                    coll.get_db().close_idle()
+
+        secs = time.time() - start
+        logging.info('Synching profile %s...%s', pname,
+                     'done' if res else 'failed')
+
+        return res, secs
+
     def op_startweb (self):
         logging.info('Try `python asynk.py -h` for options')
 
@@ -498,6 +665,24 @@ class Asynk:
     def is_sync_all (self):
         return self._get_att('sync_all')
 
+    def get_pnames (self):
+        return self._get_att('pnames')
+
+    def set_pnames (self, val):
+        return self._set_att('pnames', val)
+
+    def get_sessions (self):
+        return self._get_att('sessions')
+
+    def set_sessions (self, val):
+        return self._set_att('sessions', val)
+
+    def get_sync_workers (self):
+        return self._get_att('sync_workers')
+
+    def set_sync_workers (self, val):
+        return self._set_att('sync_workers', val)
+
     def get_item_id (self):
         return self._get_att('item_id')
 
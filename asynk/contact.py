@@ -438,6 +438,9 @@ class Contact(Item):
         return self._set_prop('email_home', val)
 
     def add_email_home (self, val):
+        if not self.in_init():
+            self.dirty(True)
+
         return self._append_to_prop('email_home', val)
 
     def get_email_work (self):
@@ -609,6 +612,9 @@ class Contact(Item):
         return self._set_prop('im', val)
 
     def add_im (self, which, val):
+        if not self.in_init():
+            self.dirty(True)
+
         return self._update_prop('im', which, val)
 
     def get_custom (self, which=None):
@@ -61,12 +61,16 @@ class BBContact(Contact):
     """This class extends the Contact abstract base class to wrap a BBDB
     Contact"""
 
-    def __init__ (self, folder, con=None, con_itemid=None, rec=None):
+    def __init__ (self, folder, con=None, con_itemid=None, rec=None,
+                  parsed=None):
         """rec is the native string vector representation of a BBDB contact
-        entry on disk."""
+        entry on disk. If rec has already been parsed elsewhere, parsed should
+        be the result of get_parsed_state() on a contact built from it; the
+        record is then not parsed again."""
 
         Contact.__init__(self, folder, con)
-        self.atts.update({'bbdb_folder' : None,})
+        self.atts.update({'bbdb_folder' : None,
+                          'rec'         : None,})
 
         conf = self.get_config()
         if con:
@@ -80,13 +84,19 @@ class BBContact(Contact):
 
         if rec:
             self.set_rec(rec)
-            self.init_props_from_rec(rec)
+            if parsed:
+                self.set_parsed_state(parsed)
+            else:
+                self.init_props_from_rec(rec)
 
         if not self.get_itemid():
             iid = ('%s' % uuid.uuid1())
             logging.debug('Assigning UUID %s for new contact: %s', iid, 
                           self.get_name())
             self.set_itemid(iid)
+            ## The record on disk does not have this ID, so it cannot be
+            ## written back verbatim.
+            self.set_rec(None)
 
         self.in_init(False)
 
@@ -119,19 +129,16 @@ class BBContact(Contact):
         return self._set_att('bbdb_folder', bbdb_folder)
 
     def get_rec (self):
+        """Return the text of the record as it was last read from or
+        written to the BBDB file, or None if there is no such record."""
+
         return self._get_att('rec')
 
     def set_rec (self, rec):
         return self._set_att('rec', rec)
 
     def init_props_from_rec (self, rec):
-        con_re = self.get_store().get_con_re()
-        parse_res = re.search(con_re, rec)
-
-        if not parse_res:
-            raise BBDBParseError('Could not Parse BBDB contact entry: %s' %rec)
-
-        d = parse_res.groupdict()
+        d = self.get_store().parse_rec(rec)
         self._snarf_names_from_parse_res(d)
         self._snarf_aka_from_parse_res(d)
         self._snarf_company_from_parse_res(d)
@@ -141,6 +148,24 @@ class BBContact(Contact):
         self._snarf_notes_from_parse_res(d)
         self._snarf_created_updated_from_parse_res(d)
 
+    def get_parsed_state (self):
+        """Return everything that was read from the BBDB record of this
+        contact as a picklable dictionary, so a record parsed in one process
+        can be reconstituted in another. Only meaningful for a contact just
+        built from a record."""
+
+        ## A contact whose record had no ID has a made up one, and no rec. The
+        ## made up ID should not be carried over.
+        return {'props'       : self.props,
+                'itemid'      : self.get_itemid() if self.get_rec() else None,
+                'bbdb_folder' : self.get_bbdb_folder(),}
+
+    def set_parsed_state (self, parsed):
+        self.props.update(parsed['props'])
+        if parsed['itemid']:
+            self.set_itemid(parsed['itemid'])
+        self.set_bbdb_folder(parsed['bbdb_folder'])
+
     def init_rec_from_props (self):
         if self.dirty():
             self.set_updated(pimdb_bb.BBPIMDB.get_bbdb_time())
@@ -793,3 +818,109 @@ class BBContact(Contact):
             ret += '(' + key + ' . ' + unchompq(val) + ')'
 
         return ret
+
+class BBContactRef:
+    """A light weight stand-in for a BBContact that has not been fully
+    parsed yet. This is used by a lazy BBDB store: when the file is indexed
+    only the location of the record in the memory mapped file, and the few
+    fields needed to prepare the sync lists (itemid, updated timestamp, sync
+    tags and the folder name) are extracted. The record is parsed into a full
+    BBContact by materialize() only when it is actually required."""
+
+    def __init__ (self, store, offset, length, rec):
+        self.store  = store
+        self.offset = offset
+        self.length = length
+
+        self.itemid    = None
+        self.updated   = None
+        self.folder    = None
+        self.sync_tags = {}
+
+        self._index_rec(rec)
+
+        self.new_itemid = not self.itemid
+        if self.new_itemid:
+            self.itemid = ('%s' % uuid.uuid1())
+
+    def _index_rec (self, rec):
+        pr    = self.store.parse_rec(rec)
+        noted = self.store.get_db().get_notes_map()
+
+        first, last = [unesc_str(chompq(pr[x])) for x in ['firstname',
+                                                           'lastname']]
+        self.name = ' '.join([x for x in [first, last] if x and x != 'nil'])
+
+        stag_re = self.store.get_sync_tag_re()
+        for note in re.findall(self.store.get_note_re(), pr['notes']):
+            (key, val) = note[:2]
+
+            key = key.rstrip()
+            val = unesc_str(chompq(val))
+
+            ## The order of the checks should stay consistent with the one in
+            ## BBContact._snarf_notes_from_parse_res
+            if key == noted['updated']:
+                self.updated = val
+            elif key == noted['itemid']:
+                self.itemid = val
+            elif re.search(stag_re, key):
+                self.sync_tags.update({key : val})
+            elif re.search(noted['folder'], key):
+                self.folder = val
+
+        if int(self.store.get_file_format()) >= 9:
+            lu = pr['lastupdated']
+            if lu and lu != 'nil':
+                self.updated = unesc_str(chompq(lu))
+
+    def get_itemid (self):
+        return self.itemid
+
+    def get_name (self):
+        return self.name
+
+    def get_updated (self):
+        return self.updated
+
+    def get_bbdb_folder (self):
+        return self.folder
+
+    def has_new_itemid (self):
+        """True if the record on disk has no itemid, and the one returned by
+        get_itemid() was made up while indexing it."""
+
+        return self.new_itemid
+
+    def get_sync_tags (self, label=None):
+        """Same semantics as Item.get_sync_tags()"""
+
+        tags = self.sync_tags
+        try:
+            return [(label, tags[label])] if label else tags
+        except KeyError, e:
+            if self.store.get_config().parse_sync_label(label):
+                return []
+
+        return [(k, v) for k, v in tags.iteritems() if re.search(label, k)]
+
+    def get_rec (self):
+        """Return the original text of the record from the store."""
+
+        return self.store.read_rec(self.offset, self.length)
+
+    def set_offset (self, offset, length):
+        self.offset = offset
+        self.length = length
+
+    def materialize (self, folder):
+        """Parse the full record and return a BBContact object for it, that
+        belongs to the specified folder."""
+
+        con = BBContact(folder, rec=self.get_rec())
+        if con.get_itemid() != self.itemid:
+            ## A record without a bbdb-id note gets a fresh UUID every time it
+            ## is parsed; stick to the one we handed out already.
+            con.set_itemid(self.itemid)
+
+        return con
@@ -32,6 +32,16 @@ import copy, datetime, logging, md5, os, re, string, uuid, vobject
 def l (s):
     return s.lower()
 
+def vcf_digest (vcf):
+    """Return a digest of the text of a vCard, as sent to or received from
+    the server. Line endings are normalized first, as the text returned in a
+    REPORT has been through an XML parser, which turns CRLFs into LFs."""
+
+    if isinstance(vcf, unicode):
+        vcf = vcf.encode('utf-8')
+
+    return md5.new(vcf.replace('\r\n', '\n').strip()).hexdigest()
+
 ## FIXME: This method should probably be inside vCard class. But not feeling
 ## adventorous enough to muck with that code
 def vco_find_in_group (vco, attr, group):
@@ -70,16 +80,21 @@ class CDContact(Contact):
     SYNC_TAG_PREFIX  = 'X-ASYNK-SYNCTAG-'
 
     def __init__ (self, folder, con=None, con_itemid=None, vco=None, itemid=None,
-                  debug_vcf=False):
+                  debug_vcf=False, parsed=None):
         """vco, if not None, should be a valid vCard object (i.e. the contents
         of a vCard file, for e.g. When vco is not None, itemid should also be
-        not None"""
+        not None
+
+        If the vCard has already been parsed elsewhere, parsed should be the
+        result of get_parsed_state() on a contact built from it, and vco
+        None. itemid should be set in this case too."""
 
         Contact.__init__(self, folder, con)
 
         self.debug_vcf = debug_vcf
 
         self.set_etag(None)
+        self.set_digest(None)
         self.set_uid(None)
         self.set_vco(vco)
         self._group_count = 0
@@ -95,6 +110,9 @@ class CDContact(Contact):
             if not self.debug_vcf:
                 assert(itemid)
             self.set_itemid(itemid)
+        elif parsed:
+            self.set_parsed_state(parsed)
+            self.set_itemid(itemid)
 
         self.in_init(False)
 
@@ -109,12 +127,27 @@ class CDContact(Contact):
 
         return os.path.splitext(os.path.basename(itemid))[0]
 
+    def get_parsed_state (self):
+        """Return everything that was read from the vCard of this contact as
+        a picklable dictionary, so it can be reconstituted without parsing
+        the vCard again. Only meaningful for a contact just built from a
+        vCard."""
+
+        return {'props' : self.props,
+                'uid'   : self.get_uid(),}
+
+    def set_parsed_state (self, parsed):
+        self.props.update(parsed['props'])
+        self.set_uid(parsed['uid'])
+
     ##
     ## First the inherited abstract methods from the base classes
     ##
 
-    def save (self, etag=None):
-        """Saves the current contact on the server."""
+    def save (self, etag=None, create=False):
+        """Saves the current contact on the server. If create is True, the
+        save fails if there already is a contact by the same itemid on the
+        server."""
 
         fo       = self.get_folder()
         vco      = self.init_vco_from_props()
@@ -125,20 +158,27 @@ class CDContact(Contact):
         if fn[-1] != '/':
             fn += "/"
 
-        if self.get_itemid():
-            fn += self.get_itemid() + '.vcf'
-            fo.put_item(fn, vcf_data, 'text/vcard', etag=etag)
-        else:
+        if not self.get_itemid():
             assert(not etag)
-            cdid = md5.new(vcf_data).hexdigest() 
-            fn += cdid + '.vcf'
-
-            ## FIXME: Handle errors and all that good stuff.
-            self.set_itemid(cdid)
-            try:
-                fo.put_item(fn, vcf_data, 'text/vcard')
-            except HTTPError, e:
-                success = False
+            self.set_itemid(md5.new(vcf_data).hexdigest())
+
+        fn += self.get_itemid() + '.vcf'
+
+        try:
+            new_etag = fo.put_item(fn, vcf_data, 'text/vcard', etag=etag,
+                                   create=create)
+        except HTTPError, e:
+            logging.error('Error (%s) saving CardDAV entry %s', e,
+                          self.get_disp_name())
+            success = False
+
+        if success:
+            ## The next sync recognizes the contact by the etag the server
+            ## sent back, or by the digest of what we sent if it did not
+            ## send one.
+            self.set_etag(new_etag)
+            self.set_digest(vcf_digest(vcf_data))
+            fo.get_sync_token().note_write(self)
 
         return success
 
@@ -166,6 +206,15 @@ class CDContact(Contact):
     def set_etag (self, etag):
         return self._set_att('etag', etag)
 
+    def get_digest (self):
+        """Return the vcf_digest() of the vCard text last read from or
+        written to the server for this contact, if known."""
+
+        return self._get_att('digest')
+
+    def set_digest (self, digest):
+        return self._set_att('digest', digest)
+
     ## The Rest...
 
     def init_props_from_vco (self, vco):
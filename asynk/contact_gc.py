@@ -30,7 +30,7 @@ from datetime import datetime
 import atom, iso8601
 import gdata, gdata.data, gdata.contacts.data, gdata.contacts.client
 
-import demjson, utils
+import demjson, parser_gc, utils
 from   contact    import Contact
 import folder_gc
 
@@ -90,7 +90,8 @@ class GCContact(Contact):
         ## FIXME: Handle the case of updating an existing contact's details.
 
         gce   = self.init_gce_from_props()
-        entry = self.get_db().get_gdc().CreateContact(gce)
+        entry = self.get_db().get_gdc().CreateContact(
+            gce, converter=self.get_db().get_converter())
 
         if entry:
             logging.debug('Creation Successful!')
@@ -148,6 +149,9 @@ class GCContact(Contact):
             self.set_updated(iso8601.tostring(time.time()))
         
     def init_gce_from_props (self):
+        if self.get_db().get_atom_codec() == 'lean':
+            return self.set_gce(self.init_xml_from_props())
+
         gce = gdata.contacts.data.ContactEntry()
 
         self._add_itemid_to_gce(gce)
@@ -485,36 +489,35 @@ class GCContact(Contact):
         if etag:
             gce.etag = etag
 
+    def _get_names_for_gce (self):
+        """Return an array of (gdata attribute, XML tag, value) tuples for
+        the parts of the name that are set."""
+
+        names = [('given_name',      'givenName',      self.get_firstname()),
+                 ('family_name',     'familyName',     self.get_lastname()),
+                 ('additional_name', 'additionalName', self.get_middlename()),
+                 ('full_name',       'fullName',       self.get_name()),
+                 ('name_suffix',     'nameSuffix',     self.get_suffix()),
+                 ('name_prefix',     'namePrefix',     self.get_prefix()),]
+
+        return [x for x in names if x[2]]
+
+    name_classes = {'given_name'      : 'GivenName',
+                    'family_name'     : 'FamilyName',
+                    'additional_name' : 'AdditionalName',
+                    'full_name'       : 'FullName',
+                    'name_suffix'     : 'NameSuffix',
+                    'name_prefix'     : 'NamePrefix',}
+
     def _add_names_gender_to_gce (self, gce):
         """Populate the Name fields in gce, which is a Google ContactEntry
         object. Values for the name fields are obtained from the current
         objects property fields that should have been set earlier"""
 
         n = gdata.data.Name()
-
-        text = self.get_firstname()
-        if text:
-            n.given_name = gdata.data.GivenName(text=text)
-
-        text = self.get_lastname()
-        if text:
-            n.family_name = gdata.data.FamilyName(text=text)
-
-        text = self.get_middlename()
-        if text:
-            n.additional_name = gdata.data.AdditionalName(text=text)
-
-        text = self.get_name()
-        if text:
-            n.full_name = gdata.data.FullName(text=text)
-
-        text = self.get_suffix()
-        if text:
-            n.name_suffix = gdata.data.NameSuffix(text=text)
-
-        text = self.get_prefix()
-        if text:
-            n.name_prefix = gdata.data.NamePrefix(text=text)
+        for attr, tag, text in self._get_names_for_gce():
+            cls = getattr(gdata.data, self.name_classes[attr])
+            setattr(n, attr, cls(text=text))
 
         gce.name = n
 
@@ -541,18 +544,17 @@ class GCContact(Contact):
         if notes:
             gce.content = atom.data.Content(text=notes[0])
 
-    def _add_group_membership_to_gce (self, gce):
-        """Append the group IDs that denote group membership to the specified
-        ContactEntry object."""
+    def _get_gids_for_gce (self):
+        """Return the group IDs that denote group membership of this contact,
+        starting with the current folder. Memberships in groups of other
+        gmail users are left behind in the 'gids' custom property."""
 
         gmail_owner = self.get_curr_gmail_userid()
 
-        gid = self.get_folder().get_itemid()
-        gidm = gdata.contacts.data.GroupMembershipInfo(href=gid)
-        gce.group_membership_info.append(gidm)
+        ret = [self.get_folder().get_itemid()]
 
         if not self.get_custom('gids'):
-            return
+            return ret
 
         js = self.get_custom('gids')
         js = js.replace('\\', '')
@@ -562,8 +564,7 @@ class GCContact(Contact):
         for gid in gids:
             gid_owner = self.get_gid_gmail_userid(gid)
             if gid_owner == gmail_owner:
-                gidm = gdata.contacts.data.GroupMembershipInfo(href=gid)
-                gce.group_membership_info.append(gidm)
+                ret.append(gid)
             else:
                 logging.debug(('Skipped mismatched membership in gid: %s; ' +
                               'Current Owner: %s'), gid, gmail_owner)
@@ -571,36 +572,52 @@ class GCContact(Contact):
 
         self.update_custom({'gids' : demjson.encode(retained_gids)})
 
-    def _add_emails_to_gce (self, gce):
-        """Append the email addresses from the current Contact object to the
-        specified ContactEntry object."""
+        return ret
+
+    def _add_group_membership_to_gce (self, gce):
+        """Append the group IDs that denote group membership to the specified
+        ContactEntry object."""
+
+        for gid in self._get_gids_for_gce():
+            gidm = gdata.contacts.data.GroupMembershipInfo(href=gid)
+            gce.group_membership_info.append(gidm)
+
+    def _get_emails_for_gce (self):
+        """Return an array of (address, primary, rel) tuples for the email
+        addresses of the current Contact object."""
 
         email_prim = self.get_email_prim()
+        ret = []
 
-        for email in self.get_email_home():
-            if not email:
-                continue
-            prim = 'true' if email == email_prim else 'false'
-            em = gdata.data.Email(address=email, primary=prim,
-                                  rel=gdata.data.HOME_REL)
-            gce.email.append(em)
+        for emails, rel in [(self.get_email_home(),  gdata.data.HOME_REL),
+                            (self.get_email_work(),  gdata.data.WORK_REL),
+                            (self.get_email_other(), gdata.data.OTHER_REL)]:
+            for email in emails:
+                if not email:
+                    continue
+                prim = 'true' if email == email_prim else 'false'
+                ret.append((email, prim, rel))
 
-        for email in self.get_email_work():
-            if not email:
-                continue
-            prim = 'true' if email == email_prim else 'false'
-            em = gdata.data.Email(address=email, primary=prim,
-                                  rel=gdata.data.WORK_REL)
-            gce.email.append(em)
+        return ret
 
-        for email in self.get_email_other():
-            if not email:
-                continue
-            prim = 'true' if email == email_prim else 'false'
-            em = gdata.data.Email(address=email, primary=prim,
-                                  rel=gdata.data.OTHER_REL)
+    def _add_emails_to_gce (self, gce):
+        """Append the email addresses from the current Contact object to the
+        specified ContactEntry object."""
+
+        for email, prim, rel in self._get_emails_for_gce():
+            em = gdata.data.Email(address=email, primary=prim, rel=rel)
             gce.email.append(em)
 
+    ## The elements of a structured postal address: the gdata attribute,
+    ## the key of our postal dictionaries the value comes from, the gdata
+    ## class and the XML tag
+    postal_parts = [('street',   'street',  'Street',   'gd:street'),
+                    ('city',     'city',    'City',     'gd:city'),
+                    ('region',   'state',   'Region',   'gd:region'),
+                    ('country',  'country', 'Country',  'gd:country'),
+                    ('postcode', 'zip',     'Postcode', 'gd:postcode'),
+                    ('formatted_address', 'formatted_address',
+                     'FormattedAddress', 'gd:formattedAddress'),]
 
     def _add_postal_to_gce (self, gce):
         """Insert the address fields from current contact object into the
@@ -613,31 +630,10 @@ class GCContact(Contact):
                 add  = gdata.data.StructuredPostalAddress(
                     label=label, primary=prim)
 
-                if postal['street']:
-                    strt = gdata.data.Street(text=postal['street'])
-                    add.street = strt
-
-                if postal['city']:
-                    city = gdata.data.City(text=postal['city'])
-                    add.city = city
-
-                if postal['state']:
-                    state = gdata.data.Region(text=postal['state'])
-                    add.region = state
-
-                if postal['country']:
-                    country = gdata.data.Country(text=postal['country'])
-                    add.country = country
-
-                if postal['zip']:
-                    postcode = gdata.data.Postcode(text=postal['zip'])
-                    add.postcode = postcode
-
-                k = 'formatted_address'
-                fa = postal[k] if k in postal else None
-                if fa:
-                    fad = gdata.data.FormattedAddress(text=fa)
-                    add.formatted_address = fad
+                for attr, key, cls, tag in self.postal_parts:
+                    val = postal[key] if key in postal else None
+                    if val:
+                        setattr(add, attr, getattr(gdata.data, cls)(text=val))
 
                 gce.structured_postal_address.append(add)
 
@@ -657,63 +653,43 @@ class GCContact(Contact):
                                       department=od, rel=gdata.data.WORK_REL)
         gce.organization = org
 
+    def _get_phones_for_gce (self):
+        """Return an array of (number, primary, label) tuples for the valid
+        phone and fax numbers of the current contact."""
 
-    def _add_phones_and_faxes_to_gce (self, gce):
-        """Append the contact's phone details into the specified ContactEntr
-        object."""
+        ret = []
 
         ph_prim = self.get_phone_prim()
+        for phones, type in [(self.get_phone_home(),  'Home'),
+                             (self.get_phone_work(),  'Work'),
+                             (self.get_phone_other(), 'Other'),
+                             (self.get_phone_mob(),   'Mobile')]:
+            for label, ph in phones:
+                if not ph or self._is_invalid_ph(ph, type):
+                    continue
+                prim = 'true' if ph == ph_prim else 'false'
+                ret.append((ph, prim, label))
 
-        for label, ph in self.get_phone_home():
-            if not ph or self._is_invalid_ph(ph, 'Home'):
-                continue
-            prim = 'true' if ph == ph_prim else 'false'
-            phone = gdata.data.PhoneNumber(text=ph, primary=prim,
-                                           label=label)
-            gce.phone_number.append(phone)
+        fax_prim = self.get_fax_prim()
+        for faxes, type in [(self.get_fax_home(), 'Home Fax'),
+                            (self.get_fax_work(), 'Work Fax')]:
+            for label, fa in faxes:
+                if not fa or self._is_invalid_ph(fa, type):
+                    continue
+                prim = 'true' if fa == fax_prim else 'false'
+                ret.append((fa, prim, label))
 
-        for label, ph in self.get_phone_work():
-            if not ph or self._is_invalid_ph(ph, 'Work'):
-                continue
-            prim = 'true' if ph == ph_prim else 'false'
-            phone = gdata.data.PhoneNumber(text=ph, primary=prim,
-                                           label=label)
-            gce.phone_number.append(phone)
+        return ret
 
-        for label, ph in self.get_phone_other():
-            if not ph or self._is_invalid_ph(ph, 'Other'):
-                continue
-            prim = 'true' if ph == ph_prim else 'false'
-            phone = gdata.data.PhoneNumber(text=ph, primary=prim,
-                                           label=label)
-            gce.phone_number.append(phone)
+    def _add_phones_and_faxes_to_gce (self, gce):
+        """Append the contact's phone details into the specified ContactEntr
+        object."""
 
-        for label, ph in self.get_phone_mob():
-            if not ph or self._is_invalid_ph(ph, 'Mobile'):
-                continue
-            prim = 'true' if ph == ph_prim else 'false'
+        for ph, prim, label in self._get_phones_for_gce():
             phone = gdata.data.PhoneNumber(text=ph, primary=prim,
                                            label=label)
             gce.phone_number.append(phone)
 
-        fax_prim = self.get_fax_prim()
-
-        for label, fa in self.get_fax_home():
-            if not fa or self._is_invalid_ph(fa, 'Home Fax'):
-                continue
-            prim = 'true' if fa == fax_prim else 'false'
-            fax  = gdata.data.PhoneNumber(text=fa, primary=prim,
-                                           label=label)
-            gce.phone_number.append(fax)
-
-        for label, fa in self.get_fax_work():
-            if not fa or self._is_invalid_ph(fa, 'Work Fax'):
-                continue
-            prim = 'true' if fa == fax_prim else 'false'
-            fax  = gdata.data.PhoneNumber(text=fa, primary=prim,
-                                           label=label)
-            gce.phone_number.append(fax)
-
     def _add_dates_to_gce (self, gce):
         """Append the date entries such as birthday and anniversary to the
         specified ContactEntry"""
@@ -728,30 +704,39 @@ class GCContact(Contact):
             ann  = gdata.contacts.data.Event(when=date, rel='anniversary')
             gce.event.append(ann)
 
+    def _get_websites_for_gce (self):
+        """Return an array of (url, primary, rel) tuples for the Web URLs of
+        the current contact."""
+
+        web_prim = self.get_web_prim()
+        ret = []
+
+        for webs, rel in [(self.get_web_home(), 'home-page'),
+                          (self.get_web_work(), 'work')]:
+            for web in webs:
+                if not web:
+                    continue
+                prim = 'true' if web == web_prim else 'false'
+                ret.append((web, prim, rel))
+
+        return ret
+
     def _add_websites_to_gce (self, gce):
         """Append any Web URLs from the current contact to the specified
         ContatEntry object."""
 
-        web_prim = self.get_web_prim()
+        for web, prim, rel in self._get_websites_for_gce():
+            site = gdata.contacts.data.Website(href=web, primary=prim,
+                                               rel=rel)
+            gce.website.append(site)
 
-        for web in self.get_web_home():
-            if not web:
-                continue
-            prim = 'true' if web == web_prim else 'false'
-            home = gdata.contacts.data.Website(href=web, primary=prim,
-                                               rel='home-page')
-            gce.website.append(home)
-
-        for web in self.get_web_work():
-            if not web:
-                continue
-            prim = 'true' if web == web_prim else 'false'
-            work = gdata.contacts.data.Website(href=web, primary=prim,
-                                               rel='work')
-            gce.website.append(work)
+    def _get_ims_for_gce (self):
+        """Return an array of (protocol, rel, address, primary) tuples for
+        the IM addresses of the current contact."""
 
-    def _add_ims_to_gce (self, gce):
         im_prim = self.get_im_prim()
+        ret = []
+
         for label, addr in self.get_im().iteritems():
             prim  = 'true' if im_prim == label else 'false'
             rel   = 'http://schemas.google.com/g/2005#other'
@@ -762,11 +747,17 @@ class GCContact(Contact):
             else:
                 proto = label
 
+            ret.append((proto, rel, addr, prim))
+
+        return ret
+
+    def _add_ims_to_gce (self, gce):
+        for proto, rel, addr, prim in self._get_ims_for_gce():
             im = gdata.data.Im(protocol=proto, rel=rel,
                                address=addr, primary=prim)
             gce.im.append(im)
 
-    def _add_sync_tags_to_gce (self, gce):
+    def _get_sync_tags_for_gce (self):
         conf     = self.get_config()
         pname_re = conf.get_profile_name_re()
         label    = conf.make_sync_label(pname_re, self.get_dbid())
@@ -774,6 +765,7 @@ class GCContact(Contact):
         ## These will be stored as extended properties. Note that if this
         ## routine keeps appending the sync_tags to the user_defined_fields,
         ## with no regard for whether it already exists or not...
+        ret = []
         for key, val in self.get_sync_tags().iteritems():
             ## FIXME: This was put in here for a reason. I think it had
             ## something to do with "reproducing" sync labels containing the
@@ -785,29 +777,120 @@ class GCContact(Contact):
             # if re.search(label, key):
             #     continue
 
+            ret.append((key, val))
+
+        return ret
+
+    def _add_sync_tags_to_gce (self, gce):
+        for key, val in self._get_sync_tags_for_gce():
             ud       = gdata.contacts.data.UserDefinedField()
             ud.key   = key
             ud.value = val
             gce.user_defined_field.append(ud)
 
-    def _add_custom_props_to_gce (self, gce):
+    def _get_custom_props_for_gce (self):
+        ret = []
+
         c = self.get_created()
         if c:
-            ud       = gdata.contacts.data.UserDefinedField()
-            ud.key   = 'created'
-            ud.value = c.isoformat() if isinstance(c, datetime) else c
-            gce.user_defined_field.append(ud)
+            ret.append(('created',
+                        c.isoformat() if isinstance(c, datetime) else c))
 
         for key, val in self.get_custom().iteritems():
             # We skip certain keys that have been processed already and
             # populated into other elements of the contact entry.
             if val and not key in []:
-                ud       = gdata.contacts.data.UserDefinedField()
-                ud.key   = key
                 val = val.isoformat() if isinstance(val, datetime) else val
-                ud.value = val
-                gce.user_defined_field.append(ud)
-                
+                ret.append((key, val))
+
+        return ret
+
+    def _add_custom_props_to_gce (self, gce):
+        for key, val in self._get_custom_props_for_gce():
+            ud       = gdata.contacts.data.UserDefinedField()
+            ud.key   = key
+            ud.value = val
+            gce.user_defined_field.append(ud)
+
+    ##
+    ## The lean counterpart of init_gce_from_props(), which writes out the
+    ## XML of the entry directly. This has to be kept in step with the
+    ## _add_*_to_gce routines above.
+    ##
+
+    def init_xml_from_props (self):
+        E  = parser_gc.elem
+        ch = []
+
+        itemid = self.get_itemid()
+        if itemid:
+            ch.append(E('atom:id', itemid))
+
+        ch.append(E('gd:name', [E('gd:' + tag, text) for attr, tag, text in
+                                self._get_names_for_gce()]))
+
+        text = self.get_nickname()
+        if text:
+            ch.append(E('gContact:nickname', text))
+
+        text = self.get_gender()
+        if text:
+            ch.append(E('gContact:gender', value=text))
+
+        notes = self.get_notes()
+        if notes:
+            ch.append(E('atom:content', notes[0]))
+
+        for gid in self._get_gids_for_gce():
+            ch.append(E('gContact:groupMembershipInfo', href=gid))
+
+        for email, prim, rel in self._get_emails_for_gce():
+            ch.append(E('gd:email', address=email, primary=prim, rel=rel))
+
+        for label, postal in self.get_postal(as_array=True):
+            if postal:
+                prim  = 'true' if self.is_postal_prim(label) else 'false'
+                parts = []
+                for attr, key, cls, tag in self.postal_parts:
+                    val = postal[key] if key in postal else None
+                    if val:
+                        parts.append(E(tag, val))
+
+                ch.append(E('gd:structuredPostalAddress', parts,
+                            label=label, primary=prim))
+
+        org = [E(tag, val) for tag, val in
+               [('gd:orgName',       self.get_company()),
+                ('gd:orgTitle',      self.get_title()),
+                ('gd:orgDepartment', self.get_dept())] if val]
+        ch.append(E('gd:organization', org, primary='true',
+                    rel=gdata.data.WORK_REL))
+
+        for ph, prim, label in self._get_phones_for_gce():
+            ch.append(E('gd:phoneNumber', ph, primary=prim, label=label))
+
+        dt = self.get_birthday()
+        if dt:
+            ch.append(E('gContact:birthday', when=dt))
+
+        dt = self.get_anniv()
+        if dt:
+            ch.append(E('gContact:event', [E('gd:when', startTime=dt)],
+                        rel='anniversary'))
+
+        for web, prim, rel in self._get_websites_for_gce():
+            ch.append(E('gContact:website', href=web, primary=prim, rel=rel))
+
+        for proto, rel, addr, prim in self._get_ims_for_gce():
+            ch.append(E('gd:im', protocol=proto, rel=rel, address=addr,
+                        primary=prim))
+
+        for key, val in (self._get_sync_tags_for_gce() +
+                         self._get_custom_props_for_gce()):
+            ch.append(E('gContact:userDefinedField', key=key, value=val))
+
+        return parser_gc.entry(ch, etag=self.get_etag() or None)
+
     ##
     ## Temporarily placing keeping this stuff here while we start by cleaning
     ## up pimdb_gc.py
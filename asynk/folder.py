@@ -29,6 +29,89 @@ from abc     import ABCMeta, abstractmethod
 class ASynKInvalidPropValueError(Exception):
     pass
 
+class SyncToken:
+    """The high water mark of the changes to a folder seen by a sync: the
+    newest 'updated' timestamp of the items in the folder, and the items
+    updated at that instant along with their timestamps. The timestamps are
+    those the folder itself keeps - the server's for a remote folder - so
+    neither the clock of this machine nor that of the other side comes into
+    it. They are strings in a fixed format, one for every kind of folder, so
+    they can be ordered as is.
+
+    An item is modified since the last sync if it is newer than the mark, or
+    updated at the mark but not one of the items known then. Items we write
+    ourselves during a sync are noted with their new timestamps too, so they
+    are not taken to be modified the next time around. A token is loaded
+    from state.json at the start of a sync, and the new one built during the
+    sync is saved back only if the sync is successful."""
+
+    def __init__ (self, fid, state=None):
+        self.fid  = fid
+        self.mark = None
+        self.seen = {}
+
+        ## A token is only good for the folder it was made for
+        if state and state.get('fid') == fid:
+            self.mark = state['mark']
+            self.seen = state['seen']
+
+        self.new_mark = None
+        self.new_seen = {}
+        self.limit    = None
+
+    def set_limit (self, limit):
+        """Set the newest timestamp the folder can rightly have. Timestamps
+        after it are kept out of the new mark, and a saved mark after it
+        makes the token invalid. This is for folders whose timestamps come
+        from the clocks of other machines, any of which could be ahead."""
+
+        self.limit = limit
+
+    def is_valid (self):
+        if self.mark is None:
+            return False
+
+        return self.limit is None or self.mark <= self.limit
+
+    def is_modified (self, itemid, updated):
+        if updated < self.mark:
+            return False
+
+        return self.seen.get(itemid) != updated
+
+    def note (self, itemid, updated):
+        """Note an item seen while listing the folder for changes."""
+
+        if self.limit is not None and updated > self.limit:
+            ## Not noted, so it shows up as modified till the limit catches
+            ## up with it
+            return
+
+        if self.new_mark is None or updated > self.new_mark:
+            self.new_mark = updated
+            self.new_seen = {itemid : updated}
+        elif updated == self.new_mark:
+            self.new_seen.update({itemid : updated})
+
+    def note_write (self, itemid, updated):
+        """Note an item written to the folder by the sync after it was listed.
+        The mark is left alone, as items modified by others between the
+        listing and the write can only be caught by their timestamps."""
+
+        if self.new_mark is not None and updated >= self.new_mark:
+            self.new_seen.update({itemid : updated})
+
+    def get_state (self):
+        """Return the new token in a form that can be saved in state.json, or
+        None if the folder was not listed during the sync."""
+
+        if self.new_mark is None:
+            return None
+
+        return {'fid'  : self.fid,
+                'mark' : self.new_mark,
+                'seen' : self.new_seen}
+
 class Folder:
     __metaclass__ = ABCMeta
 
@@ -69,6 +152,7 @@ class Folder:
         self.set_db(db)
         self.set_store(store)
         self.set_config(db.get_config())
+        self.sync_token = None
 
     @abstractmethod
     def __str__ (self):
@@ -235,6 +319,23 @@ class Folder:
     def set_store (self, store):
         self.store = store
 
+    def new_sync_token (self, state=None, pname=None):
+        """Return a sync token for this folder, loaded from state as saved in
+        state.json for profile pname if it is not None. Folders that detect
+        changes with something other than timestamps can return their own
+        kind of token, with a get_state() method like that of SyncToken."""
+
+        return SyncToken(self.get_itemid(), state)
+
+    def get_sync_token (self):
+        if self.sync_token is None:
+            self.sync_token = self.new_sync_token()
+
+        return self.sync_token
+
+    def set_sync_token (self, token):
+        self.sync_token = token
+
     def get_type (self):
         return self._get_prop('type')
 
@@ -17,9 +17,9 @@
 ## You should have a copy of the license in the doc/ directory of ASynK.  If
 ## not, see <http://www.gnu.org/licenses/>.
 
-import codecs, logging, re, string, traceback
+import codecs, datetime, logging, re, string, traceback
 from   folder     import Folder
-from   contact_bb import BBContact, BBDBParseError
+from   contact_bb import BBContact, BBContactRef, BBDBParseError
 import pimdb_bb, utils
 
 class BBContactsFolder(Folder):    
@@ -63,6 +63,19 @@ class BBContactsFolder(Folder):
         else:
             db2 = destid
 
+        ## Changes are picked up by the sync token of the folder if there is
+        ## one from the last sync, which goes by the timestamps in the BBDB
+        ## file alone. Failing that, by comparing the timestamps with the time
+        ## the last sync ended.
+        token = self.get_sync_token()
+
+        ## The timestamps are set by the clock of whichever machine edited a
+        ## record last. A record from the future must not move the mark past
+        ## our own clock, or the edits made here till then would be missed.
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        token.set_limit(now.isoformat())
+        use_token = not updated_min and token.is_valid()
+
         if not updated_min:
             ## Note that we only perform a string operation for comparing
             ## times. This rides on a big assumption that both the timestamps
@@ -75,7 +88,7 @@ class BBContactsFolder(Folder):
         logging.debug('destid: %s', destid)
 
         newi = {}
-        for iid, con in self.get_contacts().iteritems():
+        for iid, con in self.get_contacts(materialize=False).iteritems():
             i += 1
             if stag in con.get_sync_tags():
                 t, did = con.get_sync_tags(stag)[0]
@@ -85,7 +98,15 @@ class BBContactsFolder(Folder):
                     logging.error('Skipping entry %s without updated field.',
                                   iid)
                 else:
-                    if upd > updated_min:
+                    mark = self.get_sync_mark(upd)
+                    token.note(iid, mark)
+
+                    if use_token:
+                        modified = token.is_modified(iid, mark)
+                    else:
+                        modified = upd > updated_min
+
+                    if modified:
                         logging.debug('Modified BBDB Contact: %20s %s', 
                                       con.get_name(), iid)
                         sl.add_mod(iid, did)
@@ -96,25 +117,14 @@ class BBContactsFolder(Folder):
                               con.get_name(), iid)
                 sl.add_new(iid)
 
-        kss = newi.keys()
-        for x, y in oldi.iteritems():
-            ## FIXME: The following could lead to virtually undebuggable
-            ## problem if same item ID is used across two different sources
-            ## and stores. But what are the chances, eh?
-            
-            if not x in kss and not y in kss:
-                logging.debug('Del      BBDB Contact: %s:%s', x, y)
-                if pdb1id == self.get_dbid():
-                    sl.add_del(x, y)
-                else:
-                    sl.add_del(y,x)
+        sl.add_dels(oldi, newi, pdb1id == self.get_dbid(), 'BBDB')
 
     def get_itemids (self, pname, destid):
         """See documentation in folder.py"""
 
         ret = {}
         stag = self.get_config().make_sync_label(pname, destid)
-        for locid, con in self.get_contacts().iteritems():
+        for locid, con in self.get_contacts(materialize=False).iteritems():
             if stag in con.get_sync_tags():
                 t, remid = con.get_sync_tags(stag)[0]
                 ret.update({locid : remid})
@@ -124,7 +134,11 @@ class BBContactsFolder(Folder):
     def find_item (self, itemid):
         """See documentation in folder.py"""
 
-        return self.get_contacts()[itemid]
+        con = self.contacts[itemid]
+        if isinstance(con, BBContactRef):
+            con = self._materialize(con)
+
+        return con
 
     def find_items (self, itemids):
         """See documentation in folder.py"""
@@ -159,12 +173,15 @@ class BBContactsFolder(Folder):
                 logging.error('Could not instantiate BBDBContact object: %s',
                               str(e))
 
+        ## A failed save leaves the file on disk as it was. It is not rolled
+        ## back to the backup taken at the start of the sync, as that would
+        ## also undo what was saved earlier in the sync, and the other side
+        ## may already hold sync tags for those entries.
         try:
             self.get_store().save_file()
         except Exception, e:
             logging.error('bb:bc: Could not save BBDB folder %s (%s)',
                           self.get_name(), str(e))
-            self.get_store().restore_backup()
             logging.debug(traceback.format_exc())
             return False
 
@@ -191,7 +208,6 @@ class BBContactsFolder(Folder):
         except Exception, e:
             logging.error('bb:wst: Could not save BBDB folder %s (%s)',
                           self.get_name(), str(e))
-            self.get_store().restore_backup()
             logging.debug(traceback.format_exc())
             return False
 
@@ -242,20 +258,52 @@ class BBContactsFolder(Folder):
     def save (self):
         self.get_store().save_file()
 
-    def write_to_file (self, bbf, keep_open=True):
+    def write_to_file (self, bbf, keep_open=True, moves=None):
         """Write the folder's contacts to the specified file handle. bbf
         should be an open file handle. If the keep_open flag is False, this
-        will close the file handle after completing its work."""
+        will close the file handle after completing its work.
+
+        Only contacts that were modified, or never written out, are
+        serialized; the rest are copied over verbatim from the text they were
+        parsed from. If moves is a list, a (ref, offset, length) tuple giving
+        the new location of each unparsed record of a lazy store in bbf is
+        appended to it."""
+
+        for bbdbid, bbc in self.contacts.items():
+            if isinstance(bbc, BBContactRef):
+                if bbc.has_new_itemid():
+                    bbc = self._materialize(bbc)
+                else:
+                    off = bbf.tell()
+                    bbf.write('%s\n' % bbc.get_rec())
+                    if moves is not None:
+                        moves.append((bbc, off, bbf.tell() - off))
+                    continue
 
-        for bbdbid, bbc in self.get_contacts().iteritems():
-            con = bbc.init_rec_from_props()
-            bbf.write('%s\n' % unicode(con))
+            rec = bbc.get_rec()
+            if not rec or bbc.dirty():
+                rec = unicode(bbc.init_rec_from_props())
+                bbc.set_rec(rec)
+
+                upd = bbc.get_updated()
+                if upd:
+                    self.get_sync_token().note_write(bbdbid,
+                                                     self.get_sync_mark(upd))
+
+            bbf.write('%s\n' % rec)
 
         if not keep_open:
             bbf.close()
 
         self.set_clean()
 
+    def get_sync_mark (self, updated):
+        """Return the BBDB timestamp updated in the form it is kept in the
+        sync token of the folder."""
+
+        t = pimdb_bb.BBPIMDB.parse_bbdb_time(updated)
+        return t.isoformat() if t else updated
+
     ##
     ## Internal and helper routines
     ##
@@ -274,6 +322,7 @@ class BBContactsFolder(Folder):
 
     def add_contact (self, bbc):
         self.set_dirty()
+        self._forget_ref(bbc.get_itemid())
         self.contacts.update({bbc.get_itemid() : bbc})
 
     def del_itemids (self, itemids):
@@ -287,6 +336,7 @@ class BBContactsFolder(Folder):
                 con = self.contacts[itemid]
                 logging.info('Deleting ID: %s; Name: %s...', itemid,
                              con.get_name())
+                self._forget_ref(itemid)
                 del self.contacts[itemid]
             except KeyError, e:
                 retv = False
@@ -296,10 +346,41 @@ class BBContactsFolder(Folder):
             self.save()
         return retv, retf
 
+    def add_contact_ref (self, ref):
+        """Add an unparsed record of a lazy store to the folder. Unlike
+        add_contact() this does not mark the folder dirty."""
+
+        self.contacts.update({ref.get_itemid() : ref})
+        self.nrefs += 1
+
+    def _forget_ref (self, itemid):
+        if isinstance(self.contacts.get(itemid), BBContactRef):
+            self.nrefs -= 1
+
+    def _materialize (self, ref):
+        con = ref.materialize(self)
+        self._forget_ref(ref.get_itemid())
+        self.contacts.update({ref.get_itemid() : con})
+
+        return con
+
     def reset_contacts (self):
         self.contacts = {}
+        self.nrefs    = 0
+
+    def get_contacts (self, materialize=True):
+        """Return the dictionary of contacts in this folder, keyed by
+        itemid. In a lazy store some of the values may be BBContactRef objects
+        that only support the few methods needed to prepare the sync lists. If
+        materialize is True (the default) all of them are fully parsed
+        first."""
+
+        if materialize and self.nrefs > 0:
+            refs = [x for x in self.contacts.itervalues()
+                    if isinstance(x, BBContactRef)]
+            for ref in refs:
+                self._materialize(ref)
 
-    def get_contacts (self):
         return self.contacts
 
     def find_contacts_by_name (self, cnt=0, name=None):
@@ -20,13 +20,257 @@
 
 
 from   folder         import Folder
-from   contact_cd     import CDContact
+from   contact_cd     import CDContact, vcf_digest
 from   caldavclientlibrary.protocol.url                 import URL
 from   caldavclientlibrary.protocol.http.util           import HTTPError
+from   caldavclientlibrary.protocol.http.data.string import RequestDataString
+from   caldavclientlibrary.protocol.http.definitions    import statuscodes
+from   caldavclientlibrary.protocol.webdav.put          import Put
 from   caldavclientlibrary.protocol.webdav.definitions  import davxml
 from   caldavclientlibrary.protocol.carddav.definitions import carddavxml
+from   caldavclientlibrary.protocol.calendarserver.definitions import csxml
+
+import cPickle, logging, md5, os, Queue, sys, threading, time, urllib, uuid
+import utils, vobject
+
+def http_status (e):
+    """Return the HTTP status code of an HTTPError raised by the client
+    library, or None if it cannot be made out."""
+
+    for x in [getattr(e, 'status', None)] + list(e.args):
+        if hasattr(x, 'getStatusCode'):
+            x = x.getStatusCode()
+        if isinstance(x, int):
+            return x
+
+    return None
+
+def quote_etag (etag):
+    """Return etag with the quotes some servers leave out, as readData() of
+    the client library does, so it compares equal to the etags of the
+    contacts read from the server. None is returned as is."""
+
+    if etag and not etag.startswith('"'):
+        etag = '"%s"' % etag
+
+    return etag or None
+
+class CDSyncToken:
+    """What we know of the contents of an addressbook as of the last sync:
+    the WebDAV sync-token (RFC 6578) and the CalendarServer ctag of the
+    collection - either of which can be None if the server does not support
+    it - and the etag, vcf_digest() and sync tags of every contact in it,
+    keyed by the contact's itemid.
+
+    Only the sync-token and the ctag are saved in state.json. The state of
+    the contacts, which grows with the addressbook, is saved in the
+    CDContactCache of the folder, in a slot of its own for every profile
+    that syncs the addressbook, under a stamp that goes into state.json as
+    well. A token is not valid if its stamp is not that of the profile's
+    slot in the cache - if the cache was deleted, say, or could not be
+    written at the end of the last sync.
+
+    The etag of a contact we write ourselves is the one the server returns
+    for the PUT. A server need not return one, if it changed the vCard on
+    the way in for instance, and the etag is then None. The digest of what
+    was written is noted as well, and for contacts with no etag it is
+    compared with the digest of the vCard when it is next read from the
+    server.
+
+    This plays the part of folder.SyncToken for CardDAV folders."""
+
+    def __init__ (self, fid, state=None, cache=None, pname=None):
+        self.fid   = fid
+        self.cache = cache
+        self.pname = pname
+        self.valid = False
+
+        self.sync_token = None
+        self.ctag       = None
+        self.items      = {}
+
+        if state and state.get('fid') == fid and cache:
+            items = cache.get_synced(pname, state.get('stamp'))
+            if items is not None:
+                self.valid      = True
+                self.sync_token = state['sync_token']
+                self.ctag       = state['ctag']
+                self.items      = items
+
+        self.new = None
+
+    def is_valid (self):
+        return self.valid
+
+    def get_item (self, itemid):
+        """Return a dictionary with the 'etag', 'digest' and 'tags' of the
+        specified contact as of the last sync, or None if it was not
+        there."""
+
+        return self.items.get(itemid)
+
+    def get_items (self):
+        return self.items
+
+    def get_new_items (self):
+        """Return the contacts of the new token as in get_item(), keyed by
+        itemid, or None if the folder has not been scanned for changes in
+        this sync."""
+
+        return self.new['items'] if self.new else None
+
+    def set_new (self, sync_token, ctag, items):
+        """Set the new state of the folder as found by the change detection
+        of the current sync."""
+
+        self.new = {'sync_token' : sync_token,
+                    'ctag'       : ctag,
+                    'items'      : items}
+
+    @classmethod
+    def item_state (self, con):
+        return {'etag'   : con.get_etag(),
+                'digest' : con.get_digest(),
+                'tags'   : con.get_sync_tags()}
+
+    def note_write (self, con):
+        if self.new:
+            self.new['items'].update({con.get_itemid() : self.item_state(con)})
+
+    def note_delete (self, itemid):
+        if self.new and itemid in self.new['items']:
+            del self.new['items'][itemid]
+
+    def get_state (self):
+        """Save the state of the contacts in the new token to the cache, and
+        return the rest of it to be saved in state.json. None is returned if
+        the folder was not scanned for changes in this sync, or if the cache
+        could not be written."""
+
+        if not self.new or not self.cache:
+            return None
+
+        stamp = self.cache.set_synced(self.pname, self.new['items'])
+        if not stamp:
+            return None
+
+        return {'fid'        : self.fid,
+                'sync_token' : self.new['sync_token'],
+                'ctag'       : self.new['ctag'],
+                'stamp'      : stamp}
+
+class CDContactCache:
+    """A cache on local disk of the contacts of an addressbook as they were
+    last read from the server: the etag, vcf_digest() and the parsed state
+    of each, keyed by itemid. A cached contact is good for as long as its
+    etag on the server stays the same. Unless keep_contacts is True, no
+    contacts are cached.
+
+    The parsed state is kept pickled, so the contacts built from it and the
+    cache do not share anything that could be modified.
+
+    The state of the contacts as of the last successful sync of each
+    profile - see CDSyncToken - is kept here too, whether contacts are
+    cached or not."""
+
+    ## Caches written with a different version are thrown away. Change this
+    ## whenever the parsed state of a CDContact or the layout of the cache
+    ## changes.
+    VERSION = 3
+
+    def __init__ (self, fn, fid, keep_contacts=True):
+        self.fn     = fn
+        self.fid    = fid
+        self.keep   = keep_contacts
+        self.items  = {}
+        self.synced = {}
+
+        if not os.path.exists(fn):
+            return
+
+        try:
+            with open(fn, 'rb') as f:
+                data = cPickle.load(f)
+        except Exception, e:
+            logging.warning('Could not read CardDAV cache %s (%s). Ignoring.',
+                            fn, e)
+            return
+
+        if data.get('version') == self.VERSION and data.get('fid') == fid:
+            self.items  = data['items'] if self.keep else {}
+            self.synced = data['synced']
+
+    def get (self, itemid, etag):
+        """Return the parsed state of the specified contact if it is in the
+        cache with the specified etag, and None otherwise."""
+
+        ent = self.items.get(itemid)
+        if etag and ent and ent['etag'] == etag:
+            return cPickle.loads(ent['parsed'])
 
-import logging, vobject
+        return None
+
+    def get_digest (self, itemid):
+        return self.items[itemid]['digest']
+
+    def put (self, con):
+        if not self.keep:
+            return
+
+        self.items.update({con.get_itemid() : {
+            'etag'   : con.get_etag(),
+            'digest' : con.get_digest(),
+            'parsed' : cPickle.dumps(con.get_parsed_state(), 2)}})
+
+    def retain (self, itemids):
+        """Drop the contacts other than the specified ones from the cache."""
+
+        itemids = set(itemids)
+        for itemid in self.items.keys():
+            if not itemid in itemids:
+                del self.items[itemid]
+
+    def get_synced (self, pname, stamp):
+        """Return the state of the contacts saved by set_synced() for the
+        specified profile if it was saved under the specified stamp, and None
+        otherwise."""
+
+        synced = self.synced.get(pname)
+        if stamp and synced and synced['stamp'] == stamp:
+            return synced['items']
+
+        return None
+
+    def set_synced (self, pname, items):
+        """Save items as the state of the contacts as of the sync of the
+        specified profile that just ended, along with the rest of the cache.
+        Returns the stamp it was saved under, or None if the cache could not
+        be written."""
+
+        stamp = str(uuid.uuid1())
+        self.synced.update({pname : {'stamp' : stamp,
+                                     'items' : items}})
+
+        return stamp if self.save() else None
+
+    def save (self):
+        """Write the cache to disk. Returns True if all went well."""
+
+        data = {'version' : self.VERSION,
+                'fid'     : self.fid,
+                'items'   : self.items,
+                'synced'  : self.synced}
+
+        try:
+            tmp = self.fn + '.tmp'
+            with open(tmp, 'wb') as f:
+                cPickle.dump(data, f, 2)
+            utils.replace_file(tmp, self.fn)
+            return True
+        except (IOError, OSError), e:
+            logging.warning('Could not write CardDAV cache %s (%s)',
+                            self.fn, e)
+            return False
 
 class CDContactsFolder(Folder):
     def __init__ (self, db, fid, gn, root_path):
@@ -40,6 +284,7 @@ class CDContactsFolder(Folder):
         self.set_root_path(root_path)
         self.set_type(Folder.CONTACT_t)
         self.reset_contacts()
+        self.cache = None
 
     ##
     ## Internal and helper functions
@@ -54,7 +299,7 @@ class CDContactsFolder(Folder):
     def get_batch_size (self):
         """See the documentation in folder.Folder"""
 
-        raise 100
+        return 100
 
     def prep_sync_lists (self, destid, sl, updated_min=None, cnt=0):
         """See the documentation in folder.Folder"""
@@ -63,62 +308,73 @@ class CDContactsFolder(Folder):
         conf  = self.get_config()
         pdb1id = conf.get_profile_db1(pname)
         oldi  = conf.get_itemids(pname)
-        curi  = self.get_itemids(pname, destid)
-
-        kss = curi.keys()
-        for x, y in oldi.iteritems():
-            if not x in kss and not y in kss:
-                logging.debug('Del      Carddav Contact: %s:%s', x, y)
-                if pdb1id == self.get_dbid():
-                    sl.add_del(x, y)
-                else:
-                    sl.add_del(y,x)
-
-        stag = conf.make_sync_label(pname, destid)
-
-        if not updated_min:
-            updated_min = conf.get_last_sync_stop(pname)
+        stag  = conf.make_sync_label(pname, destid)
+        token = self.get_sync_token()
+
+        ## With what we know of the folder as of the last sync, only the
+        ## contacts that have changed since then need to be fetched, and a
+        ## contact is modified if its vCard is not what it was then - which
+        ## does not involve any timestamps. Without it, we fall back to
+        ## fetching the entire addressbook and comparing the modification
+        ## times of the vCards with the time the last sync ended.
+        if token.is_valid() and not updated_min:
+            items, mods = self._get_changes(token)
+        else:
+            items = self._get_all_contacts(token)
+            if not updated_min:
+                updated_min = conf.get_last_sync_stop(pname)
+
+            mods = set([x for x, y in self.get_contacts().iteritems()
+                        if y.get_updated(iso=True) > updated_min])
 
         # Note: crdid refers to the CardDAV server item id for the contact,
         # and the remid refers to the ID on the other end of the sync
         # profile.
-        for i, (crdid, item) in enumerate(self.get_contacts().iteritems()):
-            try:
-                label, remid = item.get_sync_tags(stag)[0]
-            except IndexError, e:
-                label = None
-                remid = None
-
-            name = 'No Name'
-            if item.get_name():
-                name = item.get_name()
-            elif item.get_disp_name():
-                name = item.get_disp_name()
+        curi = {}
+        for crdid, item in items.iteritems():
+            remid = item['tags'].get(stag)
 
             if not remid:
                 # New contact
-                logging.debug('New      CardDAV Contact: %20s %s', 
-                              name, crdid)
+                logging.debug('New      CardDAV Contact: %s', crdid)
                 sl.add_new(crdid)
             else:
-                if item.get_updated(iso=True) > updated_min:
-                    logging.debug('Modified CardDAV Contact: %20s %s', 
-                                  name, crdid)
+                curi.update({crdid : remid})
+                if crdid in mods:
+                    logging.debug('Modified CardDAV Contact: %s', crdid)
                     sl.add_mod(crdid, remid)
                 else:
                     sl.add_unmod(crdid)
 
-            # FIXME: We should really storing the etags here...
-            sl.add_etag(crdid, item.get_etag())
+            sl.add_etag(crdid, item['etag'])
+
+        sl.add_dels(oldi, curi, pdb1id == self.get_dbid(), 'Carddav')
 
         logging.debug('Total Contacts   : %5d', len(curi))
 
+    def new_sync_token (self, state=None, pname=None):
+        """See the documentation in folder.Folder"""
+
+        return CDSyncToken(self.get_itemid(), state, self.get_cache(), pname)
+
     def get_itemids (self, pname, destid):
         """See the documentation in folder.Folder"""
 
-        self._refresh_contacts()
         ret = {}
         stag = self.get_config().make_sync_label(pname, destid)
+
+        ## If the folder was scanned for changes in this sync, its sync token
+        ## has the sync tags of every contact, including the ones we have
+        ## written since.
+        items = self.get_sync_token().get_new_items()
+        if items is not None:
+            for locid, item in items.iteritems():
+                if stag in item['tags']:
+                    ret.update({locid : item['tags'][stag]})
+
+            return ret
+
+        self._refresh_contacts()
         for locid, con in self.get_contacts().iteritems():
             if stag in con.get_sync_tags():
                 t, remid = con.get_sync_tags(stag)[0]
@@ -132,6 +388,7 @@ class CDContactsFolder(Folder):
             try:
                 sess.deleteResource(URL(url=self.item_path(itemid)))
                 self.del_contact(itemid)
+                self.get_sync_token().note_delete(itemid)
                 logging.info('Deleted CardDAV server contact %s...', itemid)
             except HTTPError, e:
                 logging.error('Could not delete itemid: %s (%s)', itemid, e)
@@ -167,8 +424,95 @@ class CDContactsFolder(Folder):
     def find_items (self, itemids):
         """See the documentation in folder.Folder"""
 
+        return list(self.iter_items(itemids))
+
+    def iter_items (self, itemids):
+        """Generator that fetches the contacts specified by itemids from the
+        server and yields them as CDContacts. The contacts are fetched in
+        addressbook-multiget REPORTs of multiget_size contacts each, and up
+        to multiget_concurrency of those are run at a time, each on a thread
+        and a session of its own. The contacts of a REPORT are yielded as
+        soon as it completes, in no particular order, so that they can be
+        put to use while the rest are still on the wire; and only as many
+        REPORTs as there are threads are held in memory at any time."""
+
+        conf  = self.get_config()
+        size  = max(1, conf.get_cd_multiget_size())
+        cache = self.get_cache()
+
+        chunks = [itemids[i:i+size] for i in range(0, len(itemids), size)]
+        limit  = conf.get_cd_multiget_concurrency()
+
+        for chunk, cons, err in self._run_concurrent(self._multiget, chunks,
+                                                     limit):
+            if err:
+                raise err[0], err[1], err[2]
+
+            for con in cons:
+                cache.put(con)
+                yield con
+
+    def _run_concurrent (self, fn, jobs, limit):
+        """Generator that calls fn on each of jobs from up to limit threads,
+        and yields (job, ret, err) for each in the order they complete - ret
+        being what fn returned, and err the sys.exc_info() of what it raised,
+        if anything. The threads work on sessions of their own (see
+        CDPIMDB.session()), which they give back when they are done, so the
+        threads of later calls can have them without logging in again. With
+        a limit of one the jobs are simply run here one after another."""
+
+        if limit <= 1 or len(jobs) <= 1:
+            for job in jobs:
+                try:
+                    yield job, fn(job), None
+                except Exception, e:
+                    yield job, None, sys.exc_info()
+            return
+
+        todo = Queue.Queue()
+        done = Queue.Queue(limit)
+        stop = threading.Event()
+
+        for job in jobs:
+            todo.put(job)
+
+        def worker ():
+            try:
+                while not stop.is_set():
+                    try:
+                        job = todo.get_nowait()
+                    except Queue.Empty, e:
+                        break
+
+                    try:
+                        done.put((job, fn(job), None))
+                    except Exception, e:
+                        done.put((job, None, sys.exc_info()))
+            finally:
+                self.get_db().release_session()
+
+        threads = [threading.Thread(target=worker, name='carddav-%d' % i)
+                   for i in range(min(limit, len(jobs)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        try:
+            for i in range(len(jobs)):
+                yield done.get()
+        finally:
+            ## If we are not iterated to the end, let the threads finish what
+            ## they have on hand and go away.
+            stop.set()
+            while [t for t in threads if t.is_alive()]:
+                try:
+                    done.get(timeout=0.1)
+                except Queue.Empty, e:
+                    pass
+
+    def _multiget (self, hrefs):
         sess = self.get_db().session()
-        ids = [self.item_path(x) for x in itemids]
+        ids = [self.item_path(x) for x in hrefs]
         results = sess.multiGet(URL(path=self.get_itemid()), ids,
                                 (davxml.getetag, carddavxml.address_data))
 
@@ -186,6 +530,7 @@ class CDContactsFolder(Folder):
                 raise
 
             cd.set_etag(etag.text)
+            cd.set_digest(vcf_digest(vcf.text))
             ret.append(cd)
 
         return ret
@@ -200,24 +545,28 @@ class CDContactsFolder(Folder):
         src_sync_tag = c.make_sync_label(src_sl.get_pname(), src_dbid)
         dst_sync_tag = c.make_sync_label(src_sl.get_pname(), my_dbid)
 
-        success = True
+        cons = []
         for item in items:
-
-            ## CardDAV does not support a multiput operation. So we will have
-            ## to PUT the damn items one at a time. What kind of a standard is
-            ## this, anyway?
-
             con_itemid = item.get_itemid_from_synctags(pname, 'cd')
             cd = CDContact(self, con=item, con_itemid=con_itemid)
-            cd.update_sync_tags(src_sync_tag, item.get_itemid(), save=True)
-            self.add_contact(cd)            
+            cd.update_sync_tags(src_sync_tag, item.get_itemid())
+            cons.append(cd)
+
+        saved = self.save_items([(x, None) for x in cons], create=True)
 
+        for item, cd, ok in zip(items, cons, saved):
+            if not ok:
+                logging.error('Could not create CardDAV entry for %s',
+                              cd.get_disp_name())
+                continue
+
+            self.add_contact(cd)
             item.update_sync_tags(dst_sync_tag, cd.get_itemid())
 
             logging.info('Successfully created CardDAV entry for %30s (%s)',
                          cd.get_disp_name(), cd.get_itemid())
 
-        return True
+        return not False in saved
 
     def batch_update (self, src_sl, src_dbid, items):
         """See the documentation in folder.Folder"""
@@ -229,14 +578,22 @@ class CDContactsFolder(Folder):
         src_sync_tag = c.make_sync_label(pname, src_dbid)
         dst_sync_tag = c.make_sync_label(pname, my_dbid)
 
+        ## Only the contacts that changed since the last sync are fetched
+        ## during change detection. The rest are needed now for their UIDs
+        ## and etags.
         cons = self.get_contacts()
-
-        ## FIXME: We will try to overwrite using the etags we had fetched just
-        ## a fe moments back. It could still fail; and the error handling
-        ## needs to be robust ... but it is not
-
-        success = True
-
+        hrefs = [x.get_sync_tags(dst_sync_tag)[0][1] for x in items]
+        missing = [x for x in hrefs if not x in cons]
+        if missing:
+            for con in self.iter_items(missing):
+                self.add_contact(con)
+
+        ## The contacts are overwritten only if they are still as we had
+        ## fetched them - as given by their etags. If they were modified on
+        ## the server in the meantime the update fails, and the change will
+        ## be picked up by the next sync.
+
+        puts = []
         for item in items:
             tag, href = item.get_sync_tags(dst_sync_tag)[0]
             ## FIXME: Some times we might find it expedient to force a
@@ -249,28 +606,59 @@ class CDContactsFolder(Folder):
 
             con_new.set_uid(con_old.get_uid())
             con_new.update_sync_tags(src_sync_tag, item.get_itemid())
+            puts.append((con_new, con_old.get_etag()))
 
-            try:
-                con_new.save(etag=con_old.get_etag())
+        saved = self.save_items(puts)
+
+        for (con_new, etag), ok in zip(puts, saved):
+            if ok:
                 logging.info('Successfully updated CardDAV entry for %30s (%s)',
                              con_new.get_disp_name(), con_new.get_itemid())
-            except HTTPError, e:
-                logging.error('Error (%s). Could not update CardDAV entry %s',
-                              e, con_new.get_disp_name())
-                success = False
+            else:
+                logging.error('Could not update CardDAV entry %s',
+                              con_new.get_disp_name())
 
-        return success
+        return not False in saved
 
     def writeback_sync_tags (self, pname, items):
         """See the documentation in folder.Folder"""
 
         logging.info('Writing sync state to CardDAV server...')
-        success = True
-        for item in items:
-            success = success and item.save()
 
-        logging.info('Writing sync state to CardDAV server...done')
-        return success
+        ## The etag is that of the contact as we last saw it, or the one the
+        ## server sent back if we wrote it ourselves since
+        saved = self.save_items([(x, x.get_etag()) for x in items])
+
+        logging.info('Writing sync state to CardDAV server...done. '
+                     '%d of %d failed', saved.count(False), len(saved))
+        return not False in saved
+
+    def save_items (self, items, create=False):
+        """Save the contacts in items - a list of (CDContact, etag) pairs - to
+        the server, each with an If-Match precondition on its etag if that
+        is not None. CardDAV does not have a multiput operation, so the
+        contacts are PUT one at a time; but up to put_concurrency of them at
+        a time, each on a thread and a session of its own, so that large
+        uploads are limited by what the server can take rather than by the
+        round trip time. create is passed on to CDContact.save(). Returns a
+        list with the success of each save, in the order of items."""
+
+        limit = self.get_config().get_cd_put_concurrency()
+        index = dict([(id(x), i) for i, x in enumerate(items)])
+        saved = [False] * len(items)
+
+        def save (job):
+            con, etag = job
+            return con.save(etag=etag, create=create)
+
+        for job, ret, err in self._run_concurrent(save, items, limit):
+            if err:
+                logging.error('Error (%s) saving CardDAV entry %s',
+                              err[1], job[0].get_disp_name(), exc_info=err)
+            else:
+                saved[index[id(job)]] = ret
+
+        return saved
 
     def bulk_clear_sync_flags (self, label_re=None):
         """See the documentation in folder.Folder"""
@@ -296,7 +684,173 @@ class CDContactsFolder(Folder):
         if itemid in self.contacts:
             del self.contacts[itemid]
 
+    def _get_collection_state (self):
+        """Return the sync-token and the ctag of the addressbook as a tuple.
+        Either can be None if the server does not support it."""
+
+        sess  = self.get_db().session()
+        props = (davxml.sync_token, csxml.getctag)
+        try:
+            res, bad = sess.getProperties(URL(url=self.get_itemid()), props)
+        except HTTPError, e:
+            logging.debug('Could not get sync-token and ctag of %s (%s)',
+                          self.get_name(), e)
+            return None, None
+
+        ret = []
+        for prop in props:
+            val = res.get(prop)
+            if val is not None and not isinstance(val, basestring):
+                val = val.text
+            ret.append(val.strip() if val else None)
+
+        return tuple(ret)
+
+    def _get_href (self, href):
+        if isinstance(href, URL):
+            href = href.relativeURL()
+
+        return href.strip()
+
+    def _is_item_href (self, href):
+        """Return False if href is that of the addressbook itself, or of a
+        collection in it."""
+
+        path = urllib.unquote(URL(url=self.get_itemid()).relativeURL())
+        return (not href.endswith('/') and
+                urllib.unquote(href).rstrip('/') != path.rstrip('/'))
+
+    def _sync_collection (self, sync_token):
+        """Ask the server for the contacts added, modified or removed since
+        the specified sync-token with a sync-collection REPORT. Returns a
+        tuple of the hrefs changed, the itemids removed and the new
+        sync-token, or None if the server would not tell us - it may not
+        support the REPORT, or may have forgotten the token."""
+
+        sess = self.get_db().session()
+        try:
+            res = sess.syncCollection(URL(url=self.get_itemid()), sync_token,
+                                      (davxml.getetag,))
+        except HTTPError, e:
+            logging.info('sync-collection REPORT failed on %s (%s)',
+                         self.get_name(), e)
+            return None
+
+        if not res:
+            return None
+
+        changed, removed, other, sync_token = res
+        changed = [self._get_href(x) for x in changed]
+        removed = [CDContact.normalize_cdid(self._get_href(x))
+                   for x in removed]
+
+        return ([x for x in changed if self._is_item_href(x)], removed,
+                sync_token)
+
+    def _get_etags (self):
+        """Return the etags of all the contacts in the addressbook, keyed by
+        their hrefs."""
+
+        sess  = self.get_db().session()
+        items = sess.getPropertiesOnHierarchy(URL(url=self.get_itemid()),
+                                              (davxml.getetag,))
+        ret = {}
+        for href, props in items.iteritems():
+            href = self._get_href(href)
+            if self._is_item_href(href):
+                ret.update({href : props.get(davxml.getetag)})
+
+        return ret
+
+    def _get_changes (self, token):
+        """Work out what changed in the addressbook since the sync that saved
+        token, and fetch the contacts that did. The changes are found with a
+        sync-collection REPORT if the server supports it. If not, the ctag of
+        the addressbook tells us if anything at all changed, and if something
+        did, the etags of all the contacts are compared with what they were.
+
+        Returns a tuple of the state of all the contacts, as it will be
+        saved in the new sync token, and the set of itemids of the ones that
+        were modified."""
+
+        changed  = None
+        sync_tok = None
+        ctag     = None
+        old      = token.get_items()
+
+        if token.sync_token:
+            res = self._sync_collection(token.sync_token)
+            if res:
+                changed, removed, sync_tok = res
+
+        if changed is None:
+            sync_tok, ctag = self._get_collection_state()
+            if ctag and ctag == token.ctag:
+                changed = []
+                removed = []
+            else:
+                etags = self._get_etags()
+                ids   = set([CDContact.normalize_cdid(x) for x in etags])
+                changed = [x for x, e in etags.iteritems() if
+                           old.get(CDContact.normalize_cdid(x), {}).get('etag')
+                           != e]
+                removed = [x for x in old.keys() if not x in ids]
+
+        logging.info('CardDAV folder %s: %d contacts changed, %d removed '
+                     'since last sync', self.get_name(), len(changed),
+                     len(removed))
+
+        items = dict(old)
+        mods  = set()
+        for itemid in removed:
+            items.pop(itemid, None)
+
+        ## Anything that cannot be fetched has been deleted in the meantime
+        for href in changed:
+            items.pop(CDContact.normalize_cdid(href), None)
+
+        for con in self.iter_items(changed):
+            itemid = con.get_itemid()
+            self.add_contact(con)
+            items.update({itemid : CDSyncToken.item_state(con)})
+
+            was = old.get(itemid)
+            if was and (was['etag'] == con.get_etag() or
+                        (was['etag'] is None and
+                         was['digest'] == con.get_digest())):
+                ## Not modified, or it is what we wrote ourselves
+                continue
+
+            mods.add(itemid)
+
+        token.set_new(sync_tok, ctag, items)
+
+        cache = self.get_cache()
+        cache.retain(items.keys())
+        cache.save()
+
+        return items, mods
+
+    def _get_all_contacts (self, token):
+        """Fetch all the contacts in the addressbook, and start afresh with
+        the state of the folder in token. Returns the state of the contacts
+        as in _get_changes()."""
+
+        ## Changes made while we are at it will be seen the next time
+        sync_tok, ctag = self._get_collection_state()
+        self._refresh_contacts()
+
+        items = dict([(x, CDSyncToken.item_state(y)) for x, y in
+                      self.get_contacts().iteritems()])
+        token.set_new(sync_tok, ctag, items)
+
+        return items
+
     def _refresh_contacts (self):
+        """Refresh the list of contacts of the folder from the server. The
+        etags of all the contacts are fetched, and only the contacts not in
+        the local cache with the same etag are fetched in full."""
+
         logging.debug('Refreshing Contacts for folder %s...',
                       self.get_name())
         self.reset_contacts()
@@ -308,15 +862,33 @@ class CDContactsFolder(Folder):
         items = sess.getPropertiesOnHierarchy(path, props)
 
         hrefs = [x for x in items.keys() if x != path.toString().strip()]
-        etags = [items[x].get(davxml.getetag, "-") for x in items.keys()]
+        cache = self.get_cache()
+        fetch = []
+
+        for href in hrefs:
+            itemid = CDContact.normalize_cdid(href)
+            etag   = items[href].get(davxml.getetag)
+            parsed = cache.get(itemid, etag)
+            if parsed is None:
+                fetch.append(href)
+                continue
+
+            con = CDContact(self, parsed=parsed, itemid=itemid)
+            con.set_etag(etag)
+            con.set_digest(cache.get_digest(itemid))
+            self.add_contact(con)
 
-        cons  = self.find_items(hrefs)
+        logging.debug('%d contacts unchanged since they were cached. '
+                      'Fetching %d.', len(hrefs) - len(fetch), len(fetch))
 
-        for con in cons:
+        for con in self.iter_items(fetch):
             self.add_contact(con)
             logging.debug('Successfully fetched and added contact: %s',
                           con.get_disp_name())
 
+        cache.retain(self.get_contacts().keys())
+        cache.save()
+
         logging.debug('Refreshing Contacts for folder %s..done.',
                       self.get_name())
 
@@ -334,17 +906,106 @@ class CDContactsFolder(Folder):
                 logging.info('  Name: %-25s Gender: %s Itemid: %s',
                              con.get_disp_name(), con.get_gender(), itemid)
 
+    def get_cache (self):
+        """Return the CDContactCache of this folder. It holds the contacts
+        themselves only if caching of CardDAV contacts is enabled in the
+        configuration."""
+
+        conf = self.get_config()
+        if self.cache is None:
+            cdir = os.path.join(conf.get_user_dir(), conf.get_cache_dir())
+            if not os.path.exists(cdir):
+                logging.info('Creating cache directory at: %s', cdir)
+                os.mkdir(cdir)
+
+            key = md5.new(self.get_db().get_server() + self.get_itemid())
+            fn  = os.path.join(cdir, 'cd-%s.pickle' % key.hexdigest())
+            self.cache = CDContactCache(fn, self.get_itemid(),
+                                        conf.get_cd_cache())
+
+        return self.cache
+
     def get_root_path (self):
         return self._get_prop('root_path')
 
     def set_root_path (self, root_path):
         self._set_prop('root_path', root_path)
 
-    def put_item (self, name, data, content_type, etag=None):
-        path = URL(url=name)
-        res = self.get_db().session().writeData(path, data, content_type,
-                                                etag=etag)
+    def put_item (self, name, data, content_type, etag=None, create=False):
+        """PUT data to the resource name on the server, with an If-Match
+        precondition on etag if it is not None, or an If-None-Match: *
+        precondition if create is True. A PUT that fails with a server error
+        or a conflict is tried again after a delay, which doubles every
+        time, up to put_retries times before giving up and letting the
+        HTTPError through.
+
+        A PUT that failed may still have been carried out by the server, in
+        which case the precondition of the retry fails. If it does, the
+        resource is read back, and the PUT is taken to have gone through if
+        the resource has the data we sent.
+
+        Returns the new etag of the resource, or None if the server did not
+        send one."""
+
+        conf  = self.get_config()
+        path  = URL(url=name)
+        tries = conf.get_cd_put_retries()
+        delay = conf.get_cd_put_backoff()
+        retry = False
+
+        while True:
+            try:
+                return self._put(path, data, content_type, etag, create)
+            except HTTPError, e:
+                status = http_status(e)
+                if status == 412 and retry:
+                    same, new_etag = self._read_back(path, data)
+                    if same:
+                        logging.debug('PUT of %s had gone through before it '
+                                      'was retried', name)
+                        return new_etag
+
+                if tries <= 0 or not (status == 409 or status >= 500):
+                    raise
+
+                logging.debug('PUT of %s failed with status %s. Retrying '
+                              'in %.1f seconds', name, status, delay)
+                time.sleep(delay)
+                tries -= 1
+                delay *= 2
+                retry = True
+
+    def _put (self, path, data, content_type, etag, create):
+        """Make a single PUT request for put_item(), and return the etag the
+        server sent back, if any. writeData() of the client library can only
+        send an If-Match precondition, and does not return the etag, so the
+        request is made here."""
+
+        sess = self.get_db().session()
+        req  = Put(sess, path.relativeURL())
+        req.setData(RequestDataString(data, content_type), None, etag=etag,
+                    new_item=create)
+        sess.runSession(req)
+
+        if req.getStatusCode() not in (statuscodes.OK, statuscodes.Created,
+                                       statuscodes.NoContent):
+            sess.handleHTTPError(req)
+
+        return quote_etag(req.getNewETag())
+
+    def _read_back (self, path, data):
+        """Read the resource at path from the server. Returns a tuple of
+        True if it has the vCard data, going by vcf_digest(), and its etag;
+        or of False and None if it does not, or could not be read."""
+
+        try:
+            res = self.get_db().session().readData(path)
+        except HTTPError, e:
+            logging.debug('Could not read back %s (%s)', path.relativeURL(),
+                          e)
+            return False, None
 
-        return name
+        if res and vcf_digest(res[0]) == vcf_digest(data):
+            return True, res[1]
 
-        ## FIXME: How do we handle errors?
+        return False, None
@@ -86,7 +86,7 @@ class EXFolder(Folder):
             updated_min = updated_min[0:19] + 'Z'
 
         ex_items = self.get_ews().FindItems(self.get_fobj(), ids_only=True)
-        ex_itemids = [x.itemid.value for x in ex_items]
+        ex_itemids = set([x.itemid.value for x in ex_items])
 
         for ex_item in ex_items:
             eid = ex_item.itemid.value
@@ -18,14 +18,14 @@
 ## not, see <http://www.gnu.org/licenses/>.
 ##
 
-import copy, logging, re
+import collections, logging, Queue, random, re, sys, threading, time
 from   abc            import ABCMeta, abstractmethod
-from   folder         import Folder
+from   folder         import Folder, SyncToken
 from   contact_gc     import GCContact
 import xml.etree.ElementTree as ET
 
-import utils
-import atom, gdata.contacts.client
+import iso8601, utils
+import atom, gdata.client, gdata.contacts.client
 
 class AddHeader:
     def __init__ (self):
@@ -50,6 +50,20 @@ def get_udp_by_key (udps, key):
 
     return None
 
+def get_entry_name (entry):
+    """Return the best available name for the specified ContactEntry, or
+    None if it has no name."""
+
+    if entry.name:
+        if entry.name.full_name:
+            return entry.name.full_name.text
+        elif entry.name.family_name:
+            return entry.name.family_name.text
+        elif entry.name.given_name:
+            return entry.name.given_name.text
+
+    return None
+
 def get_udps_by_key_prefix (udps, keyprefix):
     """Get a dictionary of all the user defind properties whose keys have a
     prefix match with the specified string"""
@@ -79,8 +93,41 @@ SYNC_BAD_REQUEST           = 400
 SYNC_UNAUTHORIZED          = 401
 SYNC_FORBIDDEN             = 403
 SYNC_CONFLICT              = 409
+SYNC_PRECONDITION_FAILED   = 412
 SYNC_INTERNAL_SERVER_ERROR = 500
 
+class GCSyncToken(SyncToken):
+    """The sync token of a Google Contacts folder. Besides the high water
+    mark, it keeps the itemid maps of the folder - for each sync label, the
+    ids of the entries that carry it and the remote ids they point to. The
+    maps are built when the group feed is listed for changes, and kept up to
+    date with the entries written and deleted by the sync, so the feed need
+    not be listed again at the end of the sync. They are not saved."""
+
+    def __init__ (self, fid, state=None):
+        SyncToken.__init__(self, fid, state)
+        self.itemids = {}
+
+    def set_itemids (self, stag, itemids):
+        self.itemids[stag] = itemids
+
+    def get_itemids (self, stag):
+        """Return a copy of the itemid map for the sync label stag, or None
+        if the folder has not been listed during the sync."""
+
+        ids = self.itemids.get(stag)
+        return None if ids is None else dict(ids)
+
+    def note_itemid (self, stag, gcid, remid):
+        ids = self.itemids.get(stag)
+        if ids is not None:
+            ids[GCContact.normalize_gcid(gcid)] = remid
+
+    def note_delete (self, gcid):
+        gcid = GCContact.normalize_gcid(gcid)
+        for ids in self.itemids.values():
+            ids.pop(gcid, None)
+
 ## Unlike the Outlook case, we will avoid doing another level of abstract
 ## class. When we get to implementing the tasks stuff we can evolve the class
 ## structure as well. for now, taking the easy way out
@@ -100,13 +147,14 @@ class GCContactsFolder(Folder):
         self.set_gdc(db.get_gdc())
 
         self.reset_contacts()
+        self.reset_etags()
 
     ##
     ## Implementation of the abstract methods inherited from Folder
     ##
 
     def get_batch_size (self):
-        return 100
+        return self.get_config().get_gc_batch_max_entries()
 
     def prep_sync_lists (self, destid, sl, updated_min=None, cnt=0):
         """See the documentation in folder.Folder"""
@@ -115,119 +163,97 @@ class GCContactsFolder(Folder):
         conf  = self.get_config()
         pdb1id = conf.get_profile_db1(pname)
         oldi  = conf.get_itemids(pname)
-        newi  = self.get_itemids(pname, destid)
-
-        kss = newi.keys()
-        for x, y in oldi.iteritems():
-            if not x in kss and not y in kss:
-                logging.debug('Del      Google Contact: %s:%s', x, y)
-                if pdb1id == self.get_dbid():
-                    sl.add_del(x, y)
-                else:
-                    sl.add_del(y,x)
-
-        logging.info('Querying Google for status of Contact Entries...')
-        stag = conf.make_sync_label(pname, destid)
-
-        ## FIXME: The following commented out code appears very fishy. I am
-        ## not able to recall why these two have to be used in sorted order. I
-        ## am pretty sure there was some sense behind it, but as of now db1
-        ## and db2 are not really being used; so the code works even without
-        ## this "sorted" behaviour... Hm, this really should go, but I am
-        ## being conservative here and leving the stuff commented out so we
-        ## can come back to it later if required.
-
-        # ## Sort the DBIds so dest1 has the 'lower' ID
-        # db1 = self.get_db().get_dbid()
-        # if db1 > destid:
-        #     db2 = db1
-        #     db1 = destid
-        # else:
-        #     db2 = destid
-
+        stag  = conf.make_sync_label(pname, destid)
+
+        ## Changes are picked up by the sync token of the folder if there is
+        ## one from the last sync, which goes by the server's own timestamps
+        ## alone. Failing that, by comparing the timestamps with the time the
+        ## last sync ended on this machine.
+        token     = self.get_sync_token()
+        use_token = not updated_min and token.is_valid()
         if not updated_min:
             updated_min = conf.get_last_sync_stop(pname)
+        since = iso8601.parse(updated_min) if updated_min else None
+
+        ## Everything we need - the itemid map of synched entries, what is
+        ## new or modified since the last sync, and the etags - is worked out
+        ## in a single pass over a single fetch of the group feed, one page
+        ## at a time. Only the feed without the deleted entries is needed, as
+        ## deletes are detected by comparing with the itemid map of the last
+        ## sync.
+        logging.info('Querying Google for status of Contact Entries...')
+        reqs = self.get_db().get_request_count('list')
 
-        # FIXME: We are fetching the group feed a second time. Ideally we
-        # shoul dbe able to everything we want with the feed already fetched
-        # above. This has a performance implication for groups with a large
-        # number of items. Will fix this once functionality is validated.
-        feed = self._get_group_feed(updated_min=updated_min, showdeleted='false')
-
-        logging.info('Response recieved from Google. Processing...')
-
-        if not feed.entry:
-            logging.info('No entries in feed.')
-
-            for x in kss:
-                sl.add_unmod(x)
-
-            return
-
-        skip     = 0
+        newi     = {}
         etag_cnt = 0
 
-        for i, entry in enumerate(feed.entry):
-            gcid = utils.get_link_rel(entry.link, 'edit')
-            gcid = GCContact.normalize_gcid(gcid)
+        for entry in self._iter_group_feed(showdeleted='false'):
+            gcid = GCContact.normalize_gcid(entry.id.text)
             olid = get_udp_by_key(entry.user_defined_field, stag)
-            etag = entry.etag
-            epd  = entry.deleted
-            name = None
-            if entry.name:
-                if entry.name.full_name:
-                    name = entry.name.full_name.text
-                elif entry.name.family_name:
-                    name = entry.name.family_name.text
-                elif entry.name.given_name:
-                    name = entry.name.given_name.text
-
-            if epd:
-                if olid:
-                    pass
-                    # We will trust our own delete logic...
-                    # sl.add_del(gcid)
-                else:
-                    # Deleted before it got synched. Get on with life
-                    skip += 1
-                    continue
+            if olid:
+                newi.update({gcid : olid})
+
+            updated = entry.updated.text
+            token.note(gcid, updated)
+
+            if use_token:
+                modified = token.is_modified(gcid, updated)
             else:
+                modified = since is None or iso8601.parse(updated) >= since
+
+            if modified:
                 if olid:
-                    logging.debug('Modified Google Contact: %20s %s', 
-                                  name, gcid)
+                    logging.debug('Modified Google Contact: %20s %s',
+                                  get_entry_name(entry), gcid)
                     sl.add_mod(gcid, olid)
                 else:
-                    logging.debug('New      Google Contact: %20s %s', 
-                                  name, gcid)
+                    logging.debug('New      Google Contact: %20s %s',
+                                  get_entry_name(entry), gcid)
                     sl.add_new(gcid)
+            elif olid:
+                sl.add_unmod(gcid)
 
-            if etag:
-                sl.add_etag(gcid, etag)
+            if entry.etag:
+                sl.add_etag(gcid, entry.etag)
                 etag_cnt += 1
             else:
                 sl.add_entry(gcid)
 
-        for x in kss:
-            if not x in sl.get_news() and not x in sl.get_mods():
-                sl.add_unmod(x)
+        sl.add_dels(oldi, newi, pdb1id == self.get_dbid(), 'Google')
+        token.set_itemids(stag, newi)
 
         logging.debug('Total Contacts   : %5d', len(newi))
         logging.debug('num with etags   : %5d', etag_cnt)
-        logging.debug('num del bef sync : %5d', skip)
+        logging.debug('Listing requests : %5d',
+                      self.get_db().get_request_count('list') - reqs)
+
+    def new_sync_token (self, state=None, pname=None):
+        """See the documentation in folder.Folder"""
+
+        return GCSyncToken(self.get_itemid(), state)
 
     def get_itemids (self, pname, destid):
-        self._refresh_contacts()
-        ret = {}
+        """See the documentation in folder.Folder"""
+
         stag = self.get_config().make_sync_label(pname, destid)
-        for locid, con in self.get_contacts().iteritems():
-            if stag in con.get_sync_tags():
-                t, remid = con.get_sync_tags(stag)[0]
-                ret.update({locid : remid})
+
+        ## If the folder was listed for changes in this sync, the sync token
+        ## has the map, with the entries we wrote and deleted since.
+        ret = self.get_sync_token().get_itemids(stag)
+        if ret is not None:
+            return ret
+
+        ret = {}
+        for entry in self._iter_group_feed():
+            remid = get_udp_by_key(entry.user_defined_field, stag)
+            if remid:
+                ret.update({GCContact.normalize_gcid(entry.id.text) : remid})
 
         return ret
 
     def find_item (self, itemid):
-        gce = self.get_gdc().GetContact(itemid)
+        gce = self.get_gdc().GetContact(itemid,
+                                        converter=self.get_db().get_converter())
         gc  = GCContact(self, gce=gce)
 
         return gc
@@ -253,45 +279,18 @@ class GCContactsFolder(Folder):
         src_sync_tag = c.make_sync_label(src_sl.get_pname(), src_dbid)
         dst_sync_tag = c.make_sync_label(src_sl.get_pname(), my_dbid)
 
-        f     = self.get_db().new_feed()
-        stats = BatchState(1, f, 'insert', sync_tag=dst_sync_tag)
+        def ops ():
+            for item in items:
+                con_itemid = item.get_itemid_from_synctags(pname, 'gc')
+                gc  = GCContact(self, con=item, con_itemid=con_itemid)
+                bid = item.get_itemid()
+                gc.update_sync_tags(src_sync_tag, bid)
 
-        success = True
-        for item in items:
-            con_itemid = item.get_itemid_from_synctags(pname, 'gc')
-            gc  = GCContact(self, con=item, con_itemid=con_itemid)
-            bid = item.get_itemid()
-            gc.update_sync_tags(src_sync_tag, bid)
-
-            gce = gc.get_gce()
-
-            stats.add_con(bid, new=gc, orig=item)
-            f.add_insert(entry=gce, batch_id_string=bid)
-            stats.incr_cnt()
-            
-            if stats.get_cnt() % self.get_batch_size() == 0:
-                # Feeds have to be less than 1MB. We can push this some
-                # more. FIXME.
-                logging.debug('Uploading new batch # %02d to Google. ' +
-                              'Count: %3d. Size: %6.2fK',
-                              stats.get_bnum(), stats.get_cnt(),
-                              stats.get_size())
-                rf = self.get_db().exec_batch(f)
-                succ, cons = stats.process_batch_response(rf)
-                success = success and succ
-
-                f = self.get_db().new_feed()
-                stats = BatchState(stats.get_bnum()+1, f, 'insert',
-                                   sync_tag=dst_sync_tag)
-           
-        # Upload any leftovers
-        if stats.get_cnt() > 0:
-            logging.debug('New Batch # %02d. Count: %3d. Size: %5.2fK',
-                          stats.get_bnum(), stats.get_cnt(),
-                          stats.get_size())
-            rf = self.get_db().exec_batch(f)
-            succ, cons = stats.process_batch_response(rf)
-            success = success and succ
+                yield ('insert', bid, gc.get_gce(), gc, item)
+
+        success, cons = self._run_batches('insert', ops(),
+                                          sync_tag=dst_sync_tag)
+        self._note_itemids(src_sync_tag, dst_sync_tag, cons)
 
         return success
 
@@ -301,49 +300,18 @@ class GCContactsFolder(Folder):
 
         Returns a list of ContactEntries"""
 
-        f      = self.get_db().new_feed()
-        stats = BatchState(1, f, 'query', sync_tag=None)
+        def ops ():
+            for gcid in gcids:
+                gcid = GCContact.normalize_gcid(gcid)
+                ce = self.get_db().new_entry(gcid)
 
-        ret = []
-        success = True
+                yield ('query', gcid, ce, ce, None)
 
-        for gcid in gcids:
-            gcid = GCContact.normalize_gcid(gcid)
-            ce = gdata.contacts.data.ContactEntry()
-            ce.id = atom.data.Id(text=gcid)
-            stats.add_con(gcid, ce, orig=None)
-
-            f.add_query(entry=ce, batch_id_string=gcid)
-            stats.incr_cnt()
-
-            if stats.get_cnt() % self.get_batch_size() == 0:
-                # Feeds have to be less than 1MB. We can push this some
-                # more
-                logging.debug('Qry Batch # %02d. Count: %3d. Size: %6.2fK',
-                              stats.get_bnum(), stats.get_cnt(),
-                              stats.get_size())
-
-                rf  = self.get_db().exec_batch(f)
-                suc, ces = stats.process_batch_response(rf)
-                success = success and suc
-                [ret.append(x) for x in ces]
-
-                f = self.get_db().new_feed()
-                s = BatchState(stats.get_bnum()+1, f, 'query', sync_tag=None)
-                stats = s
-
-        # Process any leftovers
-        if stats.get_cnt() > 0:
-            logging.debug('Qry Batch # %02d. Count: %3d. Size: %5.2fK',
-                          stats.get_bnum(), stats.get_cnt(),
-                          stats.get_size())
-            
-            rf  = self.get_db().exec_batch(f)
-            suc, ces = stats.process_batch_response(rf)
-            success = success and suc
-            [ret.append(x) for x in ces]
-
-        return success, ret
+        success, ces = self._run_batches('query', ops())
+        for ce in ces:
+            self.set_etag(ce.id.text, ce.etag)
+
+        return success, ces
 
     def batch_update (self, sync_list, src_dbid, items):
         """See the documentation in folder.Folder"""
@@ -351,11 +319,11 @@ class GCContactsFolder(Folder):
         # Updates and deletes on google require not just the entryid but also
         # its correct etag which is a version identifier. This is to ensure
         # two apps do not overwrite each other's work without even knowing
-        # about it. So we need to approach this in two steps: (a) Fetch the
-        # ContactEntries for all the items we are interested in. the returned
-        # entry objects have all the required info, including the latest
-        # etag. (b) Modify the same entry with the local updates and send it
-        # back
+        # about it. The etags of all the entries in the folder were noted
+        # when the group feed was read during change detection, so we go
+        # right ahead with those. Only the entries whose etags we do not know,
+        # or that Google turns down because the etag is stale, are fetched
+        # again for their current etag.
 
         my_dbid = self.get_dbid()
         c       = self.get_config()
@@ -364,53 +332,67 @@ class GCContactsFolder(Folder):
         src_sync_tag = c.make_sync_label(pname, src_dbid)
         dst_sync_tag = c.make_sync_label(pname, my_dbid)
 
-        tags  = [item.get_sync_tags(dst_sync_tag)[0] for item in items]
-        gcids = [val for (tag, val) in tags]
-
-        logging.debug('Refreshing etags for modified entries...')
-
-        success, ces   = self._fetch_gc_entries(gcids)
-        etags = [copy.deepcopy(ce.etag) for ce in ces]
-        f     = self.get_db().new_feed()
-        stats = BatchState(1, f, 'update', sync_tag=dst_sync_tag)
-
-        for item, etag in zip(items, etags):
-            con_itemid = item.get_itemid_from_synctags(pname, 'gc')
-            gc  = GCContact(self, con=item, con_itemid=con_itemid)
-            bid = item.get_itemid()
-            gc.update_sync_tags(src_sync_tag, bid)
-
-            gce = gc.get_gce()
-            gce.etag = etag
-
-            stats.add_con(bid, new=gc, orig=item)
-            f.add_update(entry=gce, batch_id_string=bid)
-            stats.incr_cnt()
-            
-            if stats.get_cnt() % self.get_batch_size() == 0:
-                # Feeds have to be less than 1MB. We can push this some
-                # more. FIXME.
-                logging.debug('Uploading mod batch # %02d to Google. ' +
-                              'Count: %3d. Size: %6.2fK',
-                              stats.get_bnum(), stats.get_cnt(),
-                              stats.get_size())
-                rf = self.get_db().exec_batch(f, extra_headers=eh)
-                succ, cons = stats.process_batch_response(rf)
-                success = success and succ
-
-                f = self.get_db().new_feed()
-                stats = BatchState(stats.get_bnum()+1, f, 'update',
-                                   sync_tag=dst_sync_tag)
-           
-        # Upload any leftovers
-        if stats.get_cnt() > 0:
-            logging.debug('Mod Batch # %02d. Count: %3d. Size: %5.2fK',
-                          stats.get_bnum(), stats.get_cnt(),
-                          stats.get_size())
-            rf = self.get_db().exec_batch(f, extra_headers=eh)
-            succ, cons = stats.process_batch_response(rf)
+        gcids = {}
+        for item in items:
+            tag, gcid = item.get_sync_tags(dst_sync_tag)[0]
+            gcids[item.get_itemid()] = GCContact.normalize_gcid(gcid)
+
+        success = self._refresh_etags([x for x in gcids.values()
+                                       if self.get_etag(x) is None])
+
+        def ops (items):
+            for item in items:
+                con_itemid = item.get_itemid_from_synctags(pname, 'gc')
+                gc  = GCContact(self, con=item, con_itemid=con_itemid)
+                bid = item.get_itemid()
+                gc.update_sync_tags(src_sync_tag, bid)
+                gc.set_etag(self.get_etag(gcids[bid]))
+
+                yield ('update', bid, gc.get_gce(), gc, item)
+
+        stale = []
+        succ, cons = self._run_batches('update', ops(items),
+                                       sync_tag=dst_sync_tag,
+                                       extra_headers=eh, stale=stale)
+        success = success and succ
+        self._note_itemids(src_sync_tag, dst_sync_tag, cons)
+
+        if stale:
+            logging.info('%d entries changed on Google since they were '
+                         'read. Retrying with fresh etags...', len(stale))
+            stale = set(stale)
+            items = [x for x in items if x.get_itemid() in stale]
+            succ  = self._refresh_etags([gcids[x] for x in stale])
+            success = success and succ
+
+            succ, cons = self._run_batches('update', ops(items),
+                                           sync_tag=dst_sync_tag,
+                                           extra_headers=eh)
             success = success and succ
+            self._note_itemids(src_sync_tag, dst_sync_tag, cons)
+
+        return success
+
+    def _note_itemids (self, src_sync_tag, dst_sync_tag, cons):
+        """Note in the sync token the entries created or updated from the
+        items cons of the other folder, which now carry the ids of the
+        entries in dst_sync_tag."""
+
+        token = self.get_sync_token()
+        for con in cons:
+            t, gcid = con.get_sync_tags(dst_sync_tag)[0]
+            token.note_itemid(src_sync_tag, gcid, con.get_itemid())
+
+    def _refresh_etags (self, gcids):
+        """Fetch the current etags of the specified entries from Google.
+        Returns True if all of them could be fetched."""
+
+        if not gcids:
+            return True
 
+        logging.debug('Refreshing etags for %d modified entries...',
+                      len(gcids))
+        success, ces = self._fetch_gc_entries(gcids)
         return success
 
     def writeback_sync_tags (self, pname, items):
@@ -418,55 +400,32 @@ class GCContactsFolder(Folder):
         remid = conf.get_other_dbid(pname, self.get_dbid())
         stag  = conf.make_sync_label(pname, remid)
 
-        f     = self.get_db().new_feed()
-        stats = BatchState(1, f, 'Writeback olid', sync_tag=stag)
+        def ops ():
+            for item in items:
+                etag = item.get_etag()
+                if not etag:
+                    logging.error('GC (%s: %s) is expected to have a etag.',
+                                  item.get_name(), item.get_itemid())
+                    continue
 
-        success = True
-        for item in items:
-            etag = item.get_etag()
-            if not etag:
-                logging.error('GC (%s: %s) is expected to have a etag.',
-                              item.get_name(), item.get_itemid())
-                continue
+                tags = item.get_sync_tags(stag)
+                if not tags:
+                    logging.debug('Null tags. Item: \n%s', item)
+                    raise Exception()
 
-            tags = item.get_sync_tags(stag)
-            if not tags:
-                logging.debug('Null tags. Item: \n%s', item)
-                raise Exception()
-
-            t, iid = tags[0]
-            gce = item.get_gce(refresh=True)
-
-            stats.add_con(iid, new=gce, orig=item)
-            f.add_update(entry=gce, batch_id_string=iid)
-            stats.incr_cnt()
-            
-            if stats.get_cnt() % self.get_batch_size() == 0:
-                # Feeds have to be less than 1MB. We can push this some
-                # more. FIXME.
-                logging.info('Uploading Remote ItemIDs to Google...')
-                logging.debug('Batch #%02d. Count: %3d. Size: %6.2fK',
-                              stats.get_bnum(), stats.get_cnt(),
-                              stats.get_size())
-
-                rf = self.get_db().exec_batch(f, extra_headers=eh)
-                succ, cons = stats.process_batch_response(rf)
-                success = success and succ
-
-                f = self.get_db().new_feed()
-                stats = BatchState(stats.get_bnum()+1, f, 'Writeback olid',
-                                   sync_tag=stag)
-           
-        # Upload any leftovers
-        if stats.get_cnt() > 0:
-            logging.info('Uploading Remote ItemIDs to Google...')
-            logging.debug('Batch # %02d. Count: %3d. Size: %5.2fK',
-                          stats.get_bnum(), stats.get_cnt(),
-                          stats.get_size())
-
-            rf = self.get_db().exec_batch(f, extra_headers=eh)
-            succ, cons = stats.process_batch_response(rf)
-            success = success and succ
+                t, iid = tags[0]
+                gce = item.get_gce(refresh=True)
+
+                yield ('update', iid, gce, gce, item)
+
+        logging.info('Uploading Remote ItemIDs to Google...')
+        success, cons = self._run_batches('Writeback olid', ops(),
+                                          sync_tag=stag, extra_headers=eh)
+
+        token = self.get_sync_token()
+        for item in cons:
+            t, iid = item.get_sync_tags(stag)[0]
+            token.note_itemid(stag, item.get_itemid(), iid)
 
         return success
 
@@ -479,16 +438,14 @@ class GCContactsFolder(Folder):
         logging.info('Fetching contact entries from Google for folder %s...',
                      self.get_name())
 
-        feed = self._get_group_feed()
-        if not feed.entry:
-            return
-
         logging.info('Clearing sync state information...')
 
-        ces  = feed.entry
+        ## Only the entries that need to be modified are held on to. The
+        ## updates are sent once we are done reading the feed, lest they
+        ## shift the pages still to be read.
         mods = []
         cnt  = 0
-        for i, ce in enumerate(ces):
+        for i, ce in enumerate(self._iter_group_feed()):
             udp = []
             mod = False
             for ep in  ce.user_defined_field:
@@ -510,37 +467,8 @@ class GCContactsFolder(Folder):
         if cnt > 0:
             logging.info('Sending modification request to Google...')
 
-        f     = self.get_db().new_feed()
-        stats = BatchState(1, f, 'clear',)
-
-        ret = True
-
-        for cnt, ce in enumerate(mods):
-            stats.add_con(ce.id.text, new=ce)
-            f.add_update(entry=ce, batch_id_string=ce.id.text)
-            stats.incr_cnt()
-
-            if stats.get_cnt() % self.get_batch_size() == 0:
-                # Feeds have to be less than 1MB. We can push this some
-                # more. FIXME.
-                logging.debug('Uploading clear batch # %02d to Google. ' +
-                              'Count: %3d. Size: %6.2fK', stats.get_bnum(),
-                              stats.get_cnt(), stats.get_size())
-                rf = self.get_db().exec_batch(f)
-                hr, ces = stats.process_batch_response(rf)
-                ret = ret and hr
-
-                f = self.get_db().new_feed()
-                stats = BatchState(stats.get_bnum()+1, f, 'clear')
-
-        # Upload any leftovers
-        if stats.get_cnt() > 0:
-            logging.debug('Uploading clear batch # %02d to Google. ' +
-                          'Count: %3d. Size: %6.2fK', stats.get_bnum(),
-                          stats.get_cnt(), stats.get_size())
-            rf = self.get_db().exec_batch(f)
-            hr, ces = stats.process_batch_response(rf)
-            ret = ret and hr
+        ops = [('update', ce.id.text, ce, ce, None) for ce in mods]
+        ret, cons = self._run_batches('clear', ops)
 
         if cnt > 0:
             logging.info('Sending modification request to Google...Done')
@@ -548,8 +476,7 @@ class GCContactsFolder(Folder):
         return ret
        
     def _refresh_contacts (self):
-        feed = self._get_group_feed()
-        for gce in feed.entry:
+        for gce in self._iter_group_feed():
             gc = GCContact(self, gce=gce)
             self.add_contact(gc)
 
@@ -587,22 +514,65 @@ class GCContactsFolder(Folder):
         self.contacts.update({gcc.get_itemid() : gcc})
 
     def del_itemids (self, itemids):
-        """Remove the specified from the contact from this folder, and return
-        True. If it does not exist in the folder, returns False."""
+        """Delete the specified contacts from this folder if they exist, in
+        batches. The return value is a pair of (success, [failed
+        entries]). success is true only if all the entries were deleted."""
+
+        gcids   = [GCContact.normalize_gcid(x) for x in itemids]
+        success = self._refresh_etags([x for x in gcids
+                                       if self.get_etag(x) is None])
+
+        def ops (gcids):
+            for gcid in gcids:
+                etag = self.get_etag(gcid)
+                if etag is None:
+                    ## Not found on Google. Nothing to do.
+                    continue
 
-        success, cons = self._fetch_gc_entries(itemids)
-        for con in cons:
-            logging.info('Deleting ID: %s; Name: %s...', con.id.text,
-                         con.name.full_name.text if con.name else '')
-            self.get_gdc().Delete(con)
-            try:
-               del self.contacts[con.id.text]
-            except KeyError, e:
-               pass 
+                ce = self.get_db().new_entry(gcid, etag)
+
+                yield ('delete', gcid, ce, ce, None)
+
+        stale = []
+        succ, dels = self._run_batches('delete', ops(gcids), stale=stale)
+        success = success and succ
+
+        if stale:
+            logging.info('%d entries changed on Google since they were '
+                         'read. Retrying with fresh etags...', len(stale))
+            succ = self._refresh_etags(stale)
+            success = success and succ
+
+            succ, cons = self._run_batches('delete', ops(stale))
+            success = success and succ
+            dels.extend(cons)
+
+        dels  = set(dels)
+        token = self.get_sync_token()
+        for gcid in dels:
+            self.contacts.pop(gcid, None)
+            self.etags.pop(gcid, None)
+            token.note_delete(gcid)
+
+        return success, [x for x in itemids
+                         if not GCContact.normalize_gcid(x) in dels and
+                         self.get_etag(x) is not None]
 
     def reset_contacts (self):
         self.contacts = {}
 
+    def get_etag (self, gcid):
+        """Return the etag of the specified entry as of the last time it was
+        read from Google, or None if it has not been read."""
+
+        return self.etags.get(GCContact.normalize_gcid(gcid))
+
+    def set_etag (self, gcid, etag):
+        self.etags[GCContact.normalize_gcid(gcid)] = etag
+
+    def reset_etags (self):
+        self.etags = {}
+
     def get_contacts (self):
         return self.contacts    
 
@@ -618,37 +588,258 @@ class GCContactsFolder(Folder):
     def set_gcentry (self, gcentry):
         self._set_prop('gcentry', gcentry)
 
-    def _get_group_feed (self, showdeleted='false', updated_min=None):
+    def get_batch_max_size (self):
+        """Batch feeds are cut once they reach this many bytes, even if they
+        do not have get_batch_size() entries yet."""
+
+        return self.get_config().get_gc_batch_max_size()
+
+    def _new_batch (self, num, op, sync_tag=None, stale=None):
+        return BatchState(num, self.get_db().new_feed(), op, sync_tag=sync_tag,
+                          token=self.get_sync_token(),
+                          max_cnt=self.get_batch_size(),
+                          max_size=self.get_batch_max_size(), stale=stale)
+
+    def _new_dispatcher (self, extra_headers=None):
+        conf = self.get_config()
+        return BatchDispatcher(self.get_db(),
+                               limit=conf.get_gc_batch_concurrency(),
+                               retries=conf.get_gc_batch_retries(),
+                               extra_headers=extra_headers)
+
+    def _run_batches (self, op, ops, sync_tag=None, extra_headers=None,
+                      stale=None):
+        """Send the operations in the iterable ops to Google in as few batch
+        feeds as the entry count and size limits allow. Each element of ops
+        is a tuple (kind, batch id, entry, new, orig), where kind is one of
+        'insert', 'update', 'query' or 'delete', and new and orig are as in
+        BatchState.add_con(). op is the operation of the batch as a whole.
+
+        Batches are sent through a BatchDispatcher, so a few of them can be
+        in flight while the next one is being built.
+
+        If stale is a list, the batch ids of updates turned down because of
+        an etag mismatch are appended to it, instead of being treated as
+        failures.
+
+        Returns a tuple (success, cons) as BatchState.process_batch_response()
+        does, for all the batches put together."""
+
+        disp  = self._new_dispatcher(extra_headers)
+        stats = self._new_batch(1, op, sync_tag, stale)
+
+        try:
+            for kind, bid, entry, new, orig in ops:
+                size = BatchState.entry_size(entry)
+                if not stats.has_room(size):
+                    disp.submit(stats)
+                    stats = self._new_batch(stats.get_bnum()+1, op, sync_tag,
+                                            stale)
+
+                stats.add_con(bid, new=new, orig=orig)
+                stats.add_entry(kind, entry, bid, size)
+
+            # Upload any leftovers
+            if stats.get_cnt() > 0:
+                disp.submit(stats)
+        except:
+            disp.close()
+            raise
+
+        return disp.finish()
+
+    def _iter_group_feed (self, showdeleted='false', updated_min=None):
+        """Generator that yields the ContactEntries in the group feed of
+        this folder. The feed is fetched a page at a time, following the next
+        links, and a page is fetched only once all the entries of the
+        previous one have been consumed, so only one page is held in memory
+        at any time. The page size is configurable in config.json."""
+
         query             = gdata.contacts.client.ContactsQuery()
-        query.max_results = 100000
+        query.max_results = self.get_config().get_gc_feed_page_size()
         query.showdeleted = showdeleted
         query.group       = self.get_itemid()
 
         if updated_min:
             query.updated_min = updated_min
-        
-        feed = self.get_gdc().GetContacts(q=query)
-        return feed
+
+        db   = self.get_db()
+        conv = db.get_converter(stream=True)
+        db.count_request('list')
+        db.count_request('page')
+        feed = self.get_gdc().GetContacts(q=query, converter=conv)
+
+        while True:
+            for entry in (feed.entry or []):
+                self.set_etag(entry.id.text, entry.etag)
+                yield entry
+
+            if feed.GetNextLink() is None:
+                return
+
+            db.count_request('page')
+            feed = self.get_gdc().GetNext(feed, converter=conv)
 
     def del_all_entries (self):
         """Delete all contacts in specified group. """
 
-        feed = self._get_group_feed()
+        ## Deleting entries while paging through the feed would shift the
+        ## pages still to be read. Reading it notes the etags of all the
+        ## entries, which is all the deletes need.
+        gcids = [x.id.text for x in self._iter_group_feed()]
+
+        logging.info('Deleting %d entries from Google...', len(gcids))
+        success, failed = self.del_itemids(gcids)
+        logging.info('Deleting %d entries from Google...done', len(gcids))
+
+        return success
+
+class BatchDispatcher:
+    """Sends batch feeds to Google on a pool of worker threads, with up to
+    limit of them in flight at any time. The responses are processed with
+    BatchState.process_batch_response() on the thread that submitted the
+    batches, in the order they were submitted. Batches turned down because
+    we went over quota are retried after an exponentially growing delay,
+    during which none of the workers send anything."""
+
+    ## Seconds to wait before the first retry of a batch
+    BACKOFF = 1.0
+
+    def __init__ (self, db, limit=1, retries=5, extra_headers=None):
+        self.db      = db
+        self.limit   = max(1, limit)
+        self.retries = retries
+        self.extra_headers = extra_headers
+
+        self.success = True
+        self.cons    = []
+        self.pending = collections.deque()
+        self.work    = Queue.Queue()
+        self.threads = []
+        self.lock    = threading.Lock()
+        self.resume  = 0
+
+    def submit (self, stats):
+        """Send the batch in stats. If there are already limit batches in
+        flight, this waits for the oldest of them to complete first. An
+        exception raised while sending any of the earlier batches is raised
+        here."""
+
+        if self.limit == 1:
+            self._process(stats, self._send(stats))
+            return
+
+        if len(self.threads) < self.limit:
+            t = threading.Thread(target=self._worker,
+                                 name='gc-batch-%d' % len(self.threads))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+        slot = {'stats' : stats, 'done' : threading.Event()}
+        self.pending.append(slot)
+        self.work.put(slot)
 
-        # A batch operation would be much faster... should implement
-        # someday
-        for con in feed.entry:
-            logging.info('Deleting ID: %s; Name: %s...', con.id.text,
-                         con.name.full_name.text if con.name else '')
-            self.get_gdc().Delete(con)
+        while len(self.pending) > self.limit:
+            self._finish_oldest()
+
+    def finish (self):
+        """Wait for all the batches submitted so far to complete. Returns a
+        tuple (success, cons) as BatchState.process_batch_response() does,
+        for all the batches put together."""
+
+        try:
+            while self.pending:
+                self._finish_oldest()
+        finally:
+            self.close()
+
+        return self.success, self.cons
+
+    def close (self):
+        """Stop the worker threads once they are done with the batches
+        already submitted."""
+
+        for t in self.threads:
+            self.work.put(None)
+        for t in self.threads:
+            t.join()
+
+        self.threads = []
+
+    def _finish_oldest (self):
+        slot = self.pending.popleft()
+        slot['done'].wait()
+
+        if 'err' in slot:
+            err = slot['err']
+            raise err[0], err[1], err[2]
+
+        self._process(slot['stats'], slot['resp'])
+
+    def _process (self, stats, resp):
+        succ, cons = stats.process_batch_response(resp)
+        self.success = self.success and succ
+        self.cons.extend(cons)
+
+    def _worker (self):
+        while True:
+            slot = self.work.get()
+            if slot is None:
+                return
+
+            try:
+                slot['resp'] = self._send(slot['stats'])
+            except:
+                slot['err'] = sys.exc_info()
+
+            slot['done'].set()
+
+    def _send (self, stats):
+        attempt = 0
+        while True:
+            with self.lock:
+                delay = self.resume - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            logging.debug('Uploading %s batch # %02d to Google. ' +
+                          'Count: %3d. Size: %6.2fK', stats.get_operation(),
+                          stats.get_bnum(), stats.get_cnt(), stats.get_size())
+            try:
+                return self.db.exec_batch(stats.get_feed(),
+                                          extra_headers=self.extra_headers)
+            except gdata.client.RequestError, e:
+                if attempt >= self.retries or not self._is_quota_error(e):
+                    raise
+
+                wait = self.BACKOFF * (2 ** attempt) * (1 + random.random())
+                attempt += 1
+                logging.info('Google is throttling requests (%s). Retrying '
+                             'batch # %02d in %.1f seconds', e.status,
+                             stats.get_bnum(), wait)
+                with self.lock:
+                    self.resume = max(self.resume, time.time() + wait)
+
+    def _is_quota_error (self, e):
+        if e.status in [429, 503]:
+            return True
+
+        return (e.status == 403 and
+                re.search('quota|rate ?limit', str(e.body), re.I) is not None)
 
 class BatchState:
     """This class is used as a temporary store of state related to batch
     operations in the Google API. Useful when we are operating in bulk data
     on Google"""
 
-    def __init__ (self, num, f, op=None, sync_tag=None):
-        self.size = 0
+    ## Allowance for the batch id and operation elements added to every
+    ## entry of a batch feed.
+    ENTRY_OVERHEAD = 256
+
+    def __init__ (self, num, f, op=None, sync_tag=None, token=None,
+                  max_cnt=None, max_size=None, stale=None):
+        self.size = len(str(f))
         self.cnt  = 0
         self.num  = num
         self.f    = f
@@ -656,16 +847,56 @@ class BatchState:
         self.cons = {}
         self.origs = {}
         self.sync_tag = sync_tag
+        self.token    = token
+        self.max_cnt  = max_cnt
+        self.max_size = max_size
+        self.stale    = stale
+
+    @classmethod
+    def entry_size (self, entry):
+        """Return the number of bytes entry will take up in a batch
+        feed."""
+
+        return len(str(entry)) + self.ENTRY_OVERHEAD
 
     def get_size (self):
         """Return size of feed in kilobytess."""
-        self.size = len(str(self.f))/1024.0
-        return self.size
+        return self.size/1024.0
+
+    def has_room (self, size):
+        """Return True if an entry of the specified size in bytes can be added
+        to the feed without going over the entry count or size limits. An
+        empty feed always has room for one entry."""
+
+        if self.cnt == 0:
+            return True
+
+        if self.max_cnt and self.cnt >= self.max_cnt:
+            return False
+
+        if self.max_size and self.size + size > self.max_size:
+            return False
+
+        return True
+
+    def add_entry (self, kind, entry, bid, size=None):
+        """Add entry to the feed, for an operation of the specified kind -
+        one of 'insert', 'update', 'query' or 'delete'."""
+
+        getattr(self.f, 'add_' + kind)(entry=entry, batch_id_string=bid)
+        if size is None:
+            size = self.entry_size(entry)
+
+        self.size += size
+        return self.incr_cnt()
 
     def incr_cnt (self):
         self.cnt += 1
         return self.cnt
 
+    def get_feed (self):
+        return self.f
+
     def get_cnt (self):
         return self.cnt
 
@@ -731,6 +962,13 @@ class BatchState:
     
             code   = int(entry.batch_status.code)
             reason = entry.batch_status.reason
+
+            if (self.stale is not None and op in ['update', 'delete'] and
+                code in [SYNC_CONFLICT, SYNC_PRECONDITION_FAILED]):
+                ## The caller will take care of it
+                logging.debug('Stale etag for bid %s: %s', bid, reason)
+                self.stale.append(bid)
+                continue
     
             if code != SYNC_OK and code != SYNC_CREATED:
                 # FIXME this code path needs to be tested properly
@@ -757,11 +995,23 @@ class BatchState:
                     logging.error('Sync failed for bid %s: %s: %s',
                                    bid, err_str, entry.id)
             else:
+                if (self.token and op in ['insert', 'update', 'Writeback olid']
+                    and entry.updated):
+                    ## So our own writes do not show up as modifications in
+                    ## the next sync
+                    gcid = GCContact.normalize_gcid(entry.id.text)
+                    self.token.note_write(gcid, entry.updated.text)
+
                 if op == 'query':
                     con = entry
                     # We could build and return array for all cases, but
                     # why waste memory...
                     cons.append(con)
+                elif op == 'delete':
+                    logging.info('Successfully deleted gmail entry %s', bid)
+                    cons.append(bid)
+                elif op == 'Writeback olid':
+                    cons.append(self.get_orig(bid))
                 elif op in ['insert', 'update']:
                     con  = self.get_con(bid)
                     orig = self.get_orig(bid)
@@ -142,14 +142,7 @@ class OLFolder(Folder):
 
         ctable.SetColumns(self.get_def_cols(), 0)
 
-        kss = newi.keys()
-        for x, y in oldi.iteritems():
-            if not x in kss and not y in kss:
-                logging.debug('Deleted Outlook Contact: %s:%s', x, y)
-                if pdb1id == self.get_dbid():
-                    sl.add_del(x, y)
-                else:
-                    sl.add_del(y,x)
+        sl.add_dels(oldi, newi, pdb1id == self.get_dbid(), 'Outlook')
 
     def get_itemids (self, pname, destid):
         conf  = self.get_config()
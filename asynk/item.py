@@ -295,9 +295,11 @@ class Item:
         try:
             return [(label, tags[label])] if label else tags
         except KeyError, e:
-            ## Could not make an exact match, now let's attempt a regexp
-            ## match... 
-            pass
+            ## Could not make an exact match. If label is a sync label and not
+            ## a regular expression, there is nothing more to look for.
+            conf = self.get_config()
+            if conf and conf.parse_sync_label(label):
+                return []
 
         ret = []
         for key, val in tags.iteritems():
@@ -337,15 +339,15 @@ class Item:
         This method returns True if any property was actually removed, and
         False if label_re did not match any sync_tag."""
 
-        if not self.in_init():
-            self.dirty(True)
-
         dels = []
 
         for pair in self.get_sync_tags(label_re):
             tag, val = pair
             dels.append(tag)
 
+        if dels and not self.in_init():
+            self.dirty(True)
+
         arr = [self._del_prop('sync_tags', t) for t in dels]
 
         return len(arr) > 0
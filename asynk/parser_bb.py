@@ -0,0 +1,151 @@
+##
+## Created : Sun Oct 18 09:12:40 IST 2026
+##
+## Copyright (C) 2026 Sriram Karra <karra.etc@gmail.com>
+##
+## This file is part of ASynK
+##
+## ASynK is free software: you can redistribute it and/or modify it under
+## the terms of the GNU Affero GPL (GNU AGPL) as published by the
+## Free Software Foundation, version 3 of the License
+##
+## ASynK is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+## License for more details.
+##
+## You should have a copy of the license in the doc/ directory of ASynK.  If
+## not, see <http://www.gnu.org/licenses/>.
+##
+## ####
+##
+## A single pass s-expression tokenizer for BBDB records. Every BBDB record
+## is a lisp vector on a line of its own. The regex based parser in pimdb_bb
+## matches the full record against one giant regular expression, which
+## backtracks heavily on large records. The routines here walk the record
+## exactly once, token by token, and slice out the raw text of each top level
+## element of the vector. The result is a dictionary with the same shape as
+## the groupdict() of the old con_re, so the _snarf_* routines in contact_bb
+## work unchanged on either.
+##
+
+import re
+
+class BBDBSexpError(Exception):
+    pass
+
+## Each token is preceded by optional whitespace. Strings can contain any
+## escaped character; symbols can contain escaped characters as well, for
+## e.g. d\.o\.b in the user-fields of the preamble.
+_tok_re = re.compile(r'\s*(?:'
+                     r'("[^"\\]*(?:\\.[^"\\]*)*")|'    # 1: String
+                     r'([\[(])|'                       # 2: Open
+                     r'([\])])|'                       # 3: Close
+                     r'((?:[^\s\[\]()"\\]|\\.)+)'      # 4: Symbol / Number
+                     r')', re.S)
+
+_STRING, _OPEN, _CLOSE, _ATOM = 1, 2, 3, 4
+_closer = {'[' : ']', '(' : ')'}
+
+## The fast path. In practice BBDB records do not nest very deep - the
+## street list inside an address vector inside the address list is as deep
+## as it gets. So we build up a regular expression that matches one complete
+## element nested up to _MAX_DEPTH levels. Every alternative is decided by
+## the first character, so there is no backtracking to speak of, and each
+## top level element of the record is consumed in a single match.
+_MAX_DEPTH = 5
+
+def _make_elem_re (depth):
+    ## The look ahead ensures a symbol is never split into two on a retry
+    atom = (r'"[^"\\]*(?:\\.[^"\\]*)*"|'
+            r'(?:[^\s\[\]()"\\]|\\.)+(?=[\s\[\]()"]|$)')
+    elem = atom
+    for i in range(depth):
+        elem = r'[\[(](?:\s*(?:%s))*\s*[\])]' % elem + '|' + atom
+
+    return re.compile(r'\s*(%s)' % elem, re.S)
+
+_elem_re = _make_elem_re(_MAX_DEPTH)
+_end_re  = re.compile(r'\s*\]')
+
+def split_vector (rec):
+    """Split the BBDB record rec, which should be the string representation
+    of a lisp vector, into the raw text of each of its top level elements and
+    return them as a list of strings. Nested lists and vectors are returned
+    as is, with their brackets. A BBDBSexpError is raised if the record is not
+    a well-formed vector."""
+
+    match = _tok_re.match
+    elems = []
+    stack = []
+    start = 0
+    pos   = 0
+
+    while True:
+        m = match(rec, pos)
+        if not m:
+            raise BBDBSexpError('Unexpected input at offset %d in record: %s'
+                                % (pos, rec))
+
+        kind = m.lastindex
+        tok  = m.start(kind)
+        pos  = m.end()
+
+        if kind == _OPEN:
+            if not stack and rec[tok] != '[':
+                raise BBDBSexpError('BBDB record is not a vector: %s' % rec)
+            if len(stack) == 1:
+                start = tok
+            stack.append(_closer[rec[tok]])
+        elif kind == _CLOSE:
+            if not stack or stack.pop() != rec[tok]:
+                raise BBDBSexpError('Mismatched "%s" at offset %d in record: '
+                                    '%s' % (rec[tok], tok, rec))
+            if not stack:
+                return elems
+            if len(stack) == 1:
+                elems.append(rec[start:pos])
+        elif not stack:
+            raise BBDBSexpError('BBDB record is not a vector: %s' % rec)
+        elif len(stack) == 1:
+            elems.append(rec[tok:pos])
+
+def split_record (rec):
+    """Split the BBDB record rec into the raw text of its top level
+    elements. This is functionally the same as split_vector, but consumes one
+    whole element at a time, and falls back to the token by token walk of
+    split_vector only if the record is too deeply nested or malformed."""
+
+    pos = rec.find('[')
+    if pos < 0 or rec[:pos].strip():
+        raise BBDBSexpError('BBDB record is not a vector: %s' % rec)
+
+    match = _elem_re.match
+    elems = []
+    pos  += 1
+
+    while True:
+        m = match(rec, pos)
+        if not m:
+            break
+
+        elems.append(m.group(1))
+        pos = m.end()
+
+    if not _end_re.match(rec, pos):
+        return split_vector(rec)
+
+    return elems
+
+def parse_rec (rec, fields):
+    """Parse the BBDB record rec and return a dictionary mapping each of the
+    names in the fields sequence to the raw text of the corresponding
+    element. fields is specific to the BBDB file format version, and is
+    available in the regexes of that version as 'con_fields'."""
+
+    elems = split_record(rec)
+    if len(elems) != len(fields):
+        raise BBDBSexpError('Expected %d fields, found %d in record: %s'
+                            % (len(fields), len(elems), rec))
+
+    return dict(zip(fields, elems))
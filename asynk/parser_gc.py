@@ -0,0 +1,458 @@
+##
+## Created : Sun Oct 18 20:03:45 IST 2026
+##
+## Copyright (C) 2026 Sriram Karra <karra.etc@gmail.com>
+##
+## This file is part of ASynK
+##
+## ASynK is free software: you can redistribute it and/or modify it under
+## the terms of the GNU Affero GPL (GNU AGPL) as published by the
+## Free Software Foundation, version 3 of the License
+##
+## ASynK is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+## License for more details.
+##
+## You should have a copy of the license in the doc/ directory of ASynK.  If
+## not, see <http://www.gnu.org/licenses/>.
+##
+## ####
+##
+## A lean reader and writer for the Atom entries and feeds of the Google
+## Contacts API, as an alternative to the gdata object model. gdata builds a
+## tree of python objects for every element of a response, driven by
+## per-class rule tables, and serializes requests the same way, which makes
+## writing batches of entries about twice as slow as it need be.
+##
+## The reader parses responses straight off the wire with cElementTree, and
+## wraps the elements in GCNode objects. The pages of the contacts feed are
+## streamed - each entry is handed out as soon as it has been read. A GCNode
+## exposes the children and attributes of its element under the same names
+## gdata uses - ce.name.given_name.text, ce.email[0].address,
+## ce.user_defined_field, and so on. They are worked out for a node the
+## first time anything is asked of it, and then stay in its instance
+## dictionary, so reading a field costs about what it does on a gdata
+## object. Code written against gdata entries, like the _snarf_* routines
+## of GCContact, works unchanged on either.
+##
+## On the writing side, entries are put together from string templates and
+## kept as strings, and batch feeds are spliced together from them without
+## ever building an object tree.
+##
+
+import re
+import xml.etree.cElementTree as ET
+from   xml.sax.saxutils import escape, quoteattr
+
+NS = {'atom'       : 'http://www.w3.org/2005/Atom',
+      'gd'         : 'http://schemas.google.com/g/2005',
+      'gContact'   : 'http://schemas.google.com/contact/2008',
+      'batch'      : 'http://schemas.google.com/gdata/batch',
+      'openSearch' : 'http://a9.com/-/spec/opensearch/1.1/',}
+
+for prefix, uri in NS.iteritems():
+    ET.register_namespace(prefix, uri)
+
+def Q (prefix, name):
+    return '{%s}%s' % (NS[prefix], name)
+
+ETAG = Q('gd', 'etag')
+
+## The elements that can appear more than once in their parent. gdata
+## always has a list for these, empty if there are none.
+LISTS = set(['entry', 'link', 'category', 'author', 'email', 'im',
+             'phone_number', 'structured_postal_address',
+             'group_membership_info', 'user_defined_field', 'website',
+             'event', 'relation', 'external_id', 'extended_property'])
+
+## Where the gdata name of an element is not simply its tag in snake case
+NAMES = {Q('gd', 'orgName')       : 'name',
+         Q('gd', 'orgTitle')      : 'title',
+         Q('gd', 'orgDepartment') : 'department',
+         Q('batch', 'id')         : 'batch_id',
+         Q('batch', 'status')     : 'batch_status',
+         Q('batch', 'operation')  : 'batch_operation',
+         Q('batch', 'interrupted'): 'batch_interrupted',}
+
+## Likewise for attributes, by the tag of their element
+ATTRS = {Q('gd', 'when') : {'start' : 'startTime',
+                            'end'   : 'endTime',
+                            'value' : 'valueString'},}
+
+_tag_re   = re.compile(r'^(?:{[^}]*})?(.*)$')
+_camel_re = re.compile(r'([A-Z])')
+_names    = {}
+
+def py_name (tag):
+    """Return the name gdata uses for an element or attribute with the
+    specified tag."""
+
+    try:
+        return _names[tag]
+    except KeyError, e:
+        name = NAMES.get(tag)
+        if name is None:
+            name = _tag_re.match(tag).group(1)
+            name = _camel_re.sub(r'_\1', name).lower()
+        _names[tag] = name
+        return name
+
+## The children of an element without any. Shared, and never modified.
+NO_KIDS = {}
+
+## The gdata names of the attributes that are not simply their key
+ATTR_NAMES = dict([(tag, dict([(y, x) for x, y in alias.iteritems()]))
+                   for tag, alias in ATTRS.iteritems()])
+
+class GCNode(object):
+    """A read-mostly view of an Atom element that looks like a gdata object
+    to the code that reads it. A child element is returned as a GCNode, or
+    None if missing, and the elements in LISTS as a list of them. Attributes
+    are returned as strings. etag is the gd:etag attribute.
+
+    The first time anything is asked of a node, all its children and
+    attributes are worked out in one go and put in the instance dictionary,
+    so later lookups find them there without a call into python code. Names
+    the element does not have are looked up one at a time, and likewise
+    remembered.
+
+    A node can also be made from the XML text of an element, in which case
+    the text is parsed only if the node is read or modified. Until then
+    str() returns the text as is, and after that the element is serialized
+    afresh every time, as any of its children could have been modified."""
+
+    def __init__ (self, elem=None, xml=None):
+        self.__dict__.update(_elem=elem, _xml=xml, _kids=None, _done=False)
+
+    def get_elem (self):
+        elem = self.__dict__['_elem']
+        if elem is None:
+            elem = ET.fromstring(self.__dict__['_xml'])
+            self.__dict__['_elem'] = elem
+            self.__dict__['_xml']  = None
+
+        return elem
+
+    def _get_kids (self):
+        kids = self.__dict__['_kids']
+        if kids is None:
+            elem = self.get_elem()
+            if len(elem):
+                kids = {}
+                for child in elem:
+                    kids.setdefault(py_name(child.tag), []).append(child)
+            else:
+                kids = NO_KIDS
+            self.__dict__['_kids'] = kids
+
+        return kids
+
+    def _attr (self, name):
+        if name == 'etag':
+            return ETAG
+
+        alias = ATTRS.get(self.get_elem().tag)
+        return alias.get(name, name) if alias else name
+
+    def _read (self):
+        """Put the text, attributes and children of the element in the
+        instance dictionary under their gdata names."""
+
+        d    = self.__dict__
+        elem = self.get_elem()
+
+        d['_done'] = True
+        d['text']  = elem.text
+
+        if elem.attrib:
+            alias = ATTR_NAMES.get(elem.tag)
+            for key, val in elem.attrib.iteritems():
+                if key == ETAG:
+                    key = 'etag'
+                elif alias:
+                    key = alias.get(key, key)
+                if not key in LISTS:
+                    d[key] = val
+
+        if len(elem):
+            names = _names
+            lists = {}
+            for child in elem:
+                tag  = child.tag
+                name = names.get(tag) or py_name(tag)
+                if name in LISTS:
+                    same = lists.get(name)
+                    if same is None:
+                        lists[name] = same = []
+                        d[name] = same
+                    same.append(GCNode(child))
+                elif not name in lists:
+                    ## Only the first one is returned
+                    lists[name] = None
+                    d[name] = GCNode(child)
+
+    def _modified (self):
+        ## Drop whatever was worked out from the element so far
+        for name in [n for n in self.__dict__ if not n.startswith('_')]:
+            del self.__dict__[name]
+        self.__dict__['_kids'] = None
+        self.__dict__['_done'] = False
+
+    def __getattr__ (self, name):
+        """Called for names not in the instance dictionary: either the node
+        has not been read yet, or the element does not have the name. The
+        latter are remembered as None, or an empty list for the elements in
+        LISTS, till the node is modified."""
+
+        if name[:2] == '__':
+            raise AttributeError(name)
+
+        d = self.__dict__
+        if not d['_done']:
+            self._read()
+            if name in d:
+                return d[name]
+
+        val = [] if name in LISTS else None
+        d[name] = val
+        return val
+
+    def __setattr__ (self, name, value):
+        """Setting a list replaces all the children by that name, setting a
+        GCNode replaces the child by that name, and setting a string sets the
+        attribute (or the text). Setting None removes the child or
+        attribute."""
+
+        elem = self.get_elem()
+
+        if name == 'text':
+            elem.text = value
+        elif isinstance(value, list) or name in self._get_kids():
+            for kid in self._get_kids().get(name, []):
+                elem.remove(kid)
+            for kid in (value if isinstance(value, list) else [value]):
+                if kid is not None:
+                    elem.append(kid.get_elem())
+        elif isinstance(value, GCNode):
+            elem.append(value.get_elem())
+        else:
+            attr = self._attr(name)
+            if value is None:
+                elem.attrib.pop(attr, None)
+            else:
+                elem.set(attr, value)
+
+        self._modified()
+
+    def GetNextLink (self):
+        for link in self.link:
+            if link.rel == 'next':
+                return link
+
+        return None
+
+    def find_next_link (self):
+        link = self.GetNextLink()
+        return link.href if link else None
+
+    def to_string (self, version=None):
+        xml = self.__dict__['_xml']
+        if xml is None:
+            xml = strip_decl(ET.tostring(self.get_elem(), encoding='UTF-8'))
+
+        return xml
+
+    def __str__ (self):
+        return self.to_string()
+
+##
+## Reading
+##
+
+ENTRY = Q('atom', 'entry')
+
+def parse_feed (response):
+    """Parse the Atom feed in the file like object response, which can be
+    the http response itself, and return it as a GCNode. This is meant to
+    be used as the converter of gdata client requests."""
+
+    root = None
+    for event, elem in ET.iterparse(response):
+        root = elem
+
+    if root is None:
+        raise ValueError('Empty response from Google')
+
+    return GCNode(root)
+
+def stream_feed (response):
+    """Like parse_feed(), but only the elements of the feed up to its first
+    entry are read here - links, counts and the like, which come before the
+    entries in the feeds of Google. The entries are read off the response
+    one at a time as the entry attribute of the returned GCFeed is iterated
+    over, so a page of the feed can be worked on as it comes in, and only
+    the entries still in use are held in memory."""
+
+    events = ET.iterparse(response, events=('start', 'end'))
+    root   = None
+    depth  = 0
+
+    for event, elem in events:
+        if event == 'start':
+            if root is None:
+                root = elem
+            depth += 1
+            if depth == 2 and elem.tag == ENTRY:
+                break
+        else:
+            depth -= 1
+
+    if root is None:
+        raise ValueError('Empty response from Google')
+
+    return GCFeed(root, events, depth)
+
+def parse_entry (response):
+    return parse_feed(response)
+
+class GCFeed(GCNode):
+    """A feed being read by stream_feed(). entry is a generator of the
+    entries, which can be gone through only once."""
+
+    def __init__ (self, root, events, depth):
+        GCNode.__init__(self, root)
+        self.__dict__['_events'] = events
+        self.__dict__['_depth']  = depth
+
+    @property
+    def entry (self):
+        ## A property, so it is not shadowed by the entries the root element
+        ## may have when the node is read
+        return self._iter_entries()
+
+    def _iter_entries (self):
+        events = self.__dict__['_events']
+        if events is None:
+            return
+
+        self.__dict__['_events'] = None
+        root  = self.get_elem()
+        depth = self.__dict__['_depth']
+
+        for event, elem in events:
+            if event == 'start':
+                depth += 1
+                continue
+
+            depth -= 1
+            if depth == 1 and elem.tag == ENTRY:
+                ## Entries are detached from the feed, not cleared, as the
+                ## caller may well hold on to some of them.
+                root.remove(elem)
+                yield GCNode(elem)
+
+##
+## Writing
+##
+
+def strip_decl (xml):
+    if xml.startswith('<?xml'):
+        xml = xml[xml.index('?>')+2:].lstrip()
+
+    return xml
+
+ENTRY_START = ('<atom:entry xmlns:atom="%s" xmlns:gd="%s" xmlns:gContact="%s"'
+               % (NS['atom'], NS['gd'], NS['gContact']))
+
+def text (val):
+    if isinstance(val, unicode):
+        val = val.encode('utf-8')
+    elif not isinstance(val, str):
+        val = str(val)
+    return escape(val)
+
+def attrs (**kwargs):
+    ret = ''
+    for key, val in kwargs.iteritems():
+        if val is not None:
+            ret += ' %s=%s' % (key, quoteattr(text(val)))
+
+    return ret
+
+def elem (tag, body=None, **kwargs):
+    """Return the XML text of an element with the specified prefixed tag,
+    attributes and body. The body is escaped if it is a string, while a
+    list is taken to be XML text of the children already."""
+
+    if body is None:
+        return '<%s%s/>' % (tag, attrs(**kwargs))
+
+    if isinstance(body, list):
+        body = ''.join(body)
+    else:
+        body = text(body)
+
+    return '<%s%s>%s</%s>' % (tag, attrs(**kwargs), body, tag)
+
+def entry (children, etag=None):
+    """Return a GCNode for an atom entry with the specified children, each
+    of which is XML text as returned by elem()."""
+
+    return GCNode(xml='%s%s>%s</atom:entry>' % (ENTRY_START,
+                                                attrs(**{'gd:etag' : etag}),
+                                                ''.join(children)))
+
+class BatchFeed:
+    """A batch feed of entries. This has the add_* methods of the gdata
+    ContactsFeed that BatchState uses, and the entries can be GCNodes or
+    gdata entries. The feed is only put together into XML when it is
+    sent."""
+
+    def __init__ (self):
+        self.entry = []
+        self.ops   = []
+
+    def add_insert (self, entry=None, batch_id_string=None):
+        self._add(entry, 'insert', batch_id_string)
+
+    def add_update (self, entry=None, batch_id_string=None):
+        self._add(entry, 'update', batch_id_string)
+
+    def add_query (self, entry=None, batch_id_string=None):
+        self._add(entry, 'query', batch_id_string)
+
+    def add_delete (self, entry=None, batch_id_string=None):
+        self._add(entry, 'delete', batch_id_string)
+
+    def _add (self, entry, op, bid):
+        self.entry.append(entry)
+        self.ops.append((op, bid))
+
+    def to_string (self, version=None):
+        xml = ['<atom:feed xmlns:atom="%s" xmlns:batch="%s">'
+               % (NS['atom'], NS['batch'])]
+
+        for ent, (op, bid) in zip(self.entry, self.ops):
+            ent = strip_decl(ent.to_string())
+            batch = ('<batch:operation xmlns:batch="%s" type="%s"/>'
+                     % (NS['batch'], op))
+            if bid is not None:
+                batch += ('<batch:id xmlns:batch="%s">%s</batch:id>'
+                          % (NS['batch'], text(bid)))
+
+            ## Right after the start tag of the entry
+            end = ent.index('>')
+            if ent[end-1] == '/':
+                ent = ent[:end-1] + '>' + batch + '</%s>' % (
+                    ent[1:].split(None, 1)[0].split('/')[0])
+            else:
+                ent = ent[:end+1] + batch + ent[end+1:]
+
+            xml.append(ent)
+
+        xml.append('</atom:feed>')
+        return ''.join(xml)
+
+    def __str__ (self):
+        return self.to_string()
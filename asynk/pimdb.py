@@ -212,6 +212,30 @@ class PIMDB:
 
         return self._set_att('phones_map', None)
 
+    def log_stats (self):
+        """Log any statistics the PIMDB keeps about its use, such as the
+        number of requests made to a server. Called at the end of a sync. The
+        default is to have nothing to say."""
+
+        pass
+
+    def release_session (self):
+        """Give back the connection to a server the calling thread has been
+        using, if the PIMDB keeps one per thread, so close_idle() can close
+        it. Called by threads that work on the PIMDB for a while and then
+        end. The thread should not use the PIMDB after this. The default is
+        to do nothing."""
+
+        pass
+
+    def close_idle (self):
+        """Close the connections to a server the PIMDB keeps around for reuse
+        and is not using at the moment. Called at the end of a sync. Any
+        that are needed later are opened afresh. The default is to keep no
+        such connections."""
+
+        pass
+
     def list_folders (self, silent=False):
         """Print details of all folders in the PIMDB. Detail will typically
         include one line per folder, with its name, and any identifier that
@@ -18,12 +18,14 @@
 ## not, see <http://www.gnu.org/licenses/>.
 ##
 
-import codecs, datetime, logging, os, re, shutil, string, time
+import codecs, datetime, logging, mmap, multiprocessing, os, re, shutil
+import string, threading, time
 from   pimdb        import PIMDB
 from   folder       import Folder
 from   folder_bb    import BBContactsFolder
-from   contact_bb   import BBContact, BBDBParseError
-import utils
+from   contact_bb   import BBContact, BBContactRef, BBDBParseError
+from   parser_bb    import BBDBSexpError
+import parser_bb, utils
 
 class BBDBFileFormatError(Exception):
     pass
@@ -31,6 +33,64 @@ class BBDBFileFormatError(Exception):
 class ASynKBBDBUnicodeError(Exception):
     pass
 
+class MappedLineReader:
+    """Minimal file like wrapper to read decoded lines from a memory mapped
+    BBDB file. The byte offset of the next line is available via tell()."""
+
+    def __init__ (self, mm, encoding):
+        self.mm       = mm
+        self.encoding = encoding
+
+    def readline (self):
+        if self.mm is None:
+            return u''
+
+        try:
+            return self.mm.readline().decode(self.encoding)
+        except UnicodeDecodeError, e:
+            raise ASynKBBDBUnicodeError('')
+
+    def tell (self):
+        return self.mm.tell() if self.mm is not None else 0
+
+    def close (self):
+        pass
+
+## The coding cookie Emacs writes on the first line of the file, for
+## e.g. ";; -*-coding: utf-8-emacs;-*-". Emacs coding system names mostly
+## map onto Python codec names once the Emacs specific decorations are
+## dropped; the rest are listed here.
+_coding_re = re.compile(r'coding:\s*([-\w.]+)')
+_emacs_codings = {'iso-latin-1'          : 'latin-1',
+                  'utf-8-with-signature' : 'utf-8-sig',
+                  'prefer-utf-8'         : 'utf-8',}
+
+def emacs_coding_to_codec (name):
+    """Return the name of the Python codec corresponding to the Emacs coding
+    system name, or None if there is no such codec."""
+
+    name = re.sub(r'-(unix|dos|mac)$', '', name.lower())
+    name = re.sub(r'-emacs$', '', name)
+    name = _emacs_codings.get(name, name)
+
+    try:
+        return codecs.lookup(name).name
+    except LookupError, e:
+        return None
+
+## The folder records are parsed into by the worker processes of a parallel
+## parse. It is set just before the pool is created, so the forked workers
+## inherit it - along with the message store, config, etc. - and do not need
+## any of it sent across.
+_pool_folder = None
+
+def _parse_recs (recs):
+    """Parse a chunk of BBDB records in a worker process, and return the
+    parsed state of each as a list in the same order."""
+
+    return [BBContact(_pool_folder, rec=rec).get_parsed_state()
+            for rec in recs]
+
 ## Note: Each BBDB File is a message store and there are one or more folders
 ## in it.
 class MessageStore:
@@ -42,6 +102,7 @@ class MessageStore:
         self.set_db(db)
         self.set_name(name)
         self.set_folders({})
+        self.set_mmap(None)
 
         self.populate_folders()
 
@@ -137,6 +198,18 @@ class MessageStore:
     def set_notes_re (self, reg):
         return self._set_att('notes_re', reg)
 
+    def get_con_fields (self):
+        return self._get_att('con_fields')
+
+    def set_con_fields (self, fields):
+        return self._set_att('con_fields', fields)
+
+    def get_rec_parser (self):
+        return self._get_att('rec_parser')
+
+    def set_rec_parser (self, parser):
+        return self._set_att('rec_parser', parser)
+
     def get_sync_tag_re (self):
         return self._get_att('sync_tag_re')
 
@@ -159,6 +232,8 @@ class MessageStore:
         self.set_ph_re(regexes['ph_re'])
         self.set_note_re(regexes['note_re'])
         self.set_notes_re(regexes['notes_re'])
+        self.set_con_fields(regexes['con_fields'])
+        self.set_rec_parser(self.get_db().get_rec_parser(ver))
 
         # Compute and store away a regular expression to match sync tags in
         # the notes section
@@ -168,6 +243,66 @@ class MessageStore:
         r = '%s%s\w+%s' % (p, s, s)
         self.set_sync_tag_re(r)
 
+    def parse_rec (self, rec):
+        """Parse the string representation of a BBDB record and return a
+        dictionary of the raw text of each of its fields, keyed by the names
+        used in the con_re of the file format version. Raises BBDBParseError
+        if the record cannot be parsed."""
+
+        if self.get_rec_parser() == 'sexp':
+            try:
+                return parser_bb.parse_rec(rec, self.get_con_fields())
+            except BBDBSexpError, e:
+                raise BBDBParseError('Could not Parse BBDB contact entry: %s'
+                                     % str(e))
+
+        parse_res = re.search(self.get_con_re(), rec)
+        if not parse_res:
+            raise BBDBParseError('Could not Parse BBDB contact entry: %s' %rec)
+
+        return parse_res.groupdict()
+
+    def is_lazy (self):
+        return self.get_db().is_lazy_store()
+
+    def get_mmap (self):
+        return self._get_att('mmap')
+
+    def set_mmap (self, mm):
+        return self._set_att('mmap', mm)
+
+    def map_file (self, fn):
+        """Memory map the BBDB file fn (read-only) and make it the backing
+        store for any lazily parsed records. Returns the mmap object, or None
+        if the file is empty."""
+
+        self.unmap_file()
+        if os.path.getsize(fn) == 0:
+            return None
+
+        with open(fn, 'rb') as bbf:
+            mm = mmap.mmap(bbf.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return self.set_mmap(mm)
+
+    def unmap_file (self):
+        mm = self.get_mmap()
+        if mm is not None:
+            mm.close()
+            self.set_mmap(None)
+
+    def read_rec (self, offset, length):
+        """Return the decoded text of the record at the specified location
+        in the memory mapped file."""
+
+        mm = self.get_mmap()
+        if mm is None:
+            raise BBDBFileFormatError('BBDB file %s is not mapped. Cannot '
+                                      'read record at offset %d' %
+                                      (self.get_name(), offset))
+
+        return mm[offset:offset+length].decode(self.get_encoding()).strip()
+
     def set_encoding (self, ver):
         return self._set_att('encoding', ver)
 
@@ -244,6 +379,71 @@ class MessageStore:
 
         return ver
 
+    def sniff_encoding (self, fn):
+        """Determine the text encoding of the BBDB file fn without parsing
+        it. A UTF-8 byte order mark settles the matter. Otherwise the codec
+        named in the Emacs coding cookie, and then the configured
+        text_encodings are tried in turn, and the first one that can decode
+        the entire file wins. The result is remembered in the application
+        state along with the file's modification time and size, and the file
+        is not read at all on later runs as long as those do not change.
+
+        Returns None if the file does not exist or none of the encodings
+        work."""
+
+        conf = self.get_config()
+        fn   = os.path.realpath(fn)
+
+        try:
+            st = os.stat(fn)
+        except OSError, e:
+            return None
+
+        mtime  = repr(st.st_mtime)
+        cached = conf.get_bb_encoding(fn)
+        if (cached and cached['mtime'] == mtime and
+            cached['size'] == st.st_size):
+            logging.debug('Using cached encoding %s for %s',
+                          cached['encoding'], fn)
+            return cached['encoding']
+
+        with open(fn, 'rb') as bbf:
+            data = bbf.read()
+
+        if data.startswith(codecs.BOM_UTF8):
+            cands = ['utf-8-sig']
+        else:
+            cands = []
+            res = _coding_re.search(data[:data.find('\n')])
+            if res:
+                codec = emacs_coding_to_codec(res.group(1))
+                if codec:
+                    cands.append(codec)
+            cands += self.get_db().get_text_encodings()
+
+        for encoding in cands:
+            try:
+                data.decode(encoding)
+            except (UnicodeDecodeError, LookupError), e:
+                continue
+
+            self._cache_encoding(fn, st, encoding)
+            return encoding
+
+        return None
+
+    def _cache_encoding (self, fn, st, encoding):
+        """Remember encoding as that of the file fn, whose os.stat() result
+        is st. state.json is only written out if that is news."""
+
+        conf = self.get_config()
+        val  = {'encoding' : encoding,
+                'mtime'    : repr(st.st_mtime),
+                'size'     : st.st_size}
+
+        if conf.get_bb_encoding(fn) != val:
+            conf.set_bb_encoding(fn, val)
+
     def parse_with_encoding (self, def_f, fn, encoding):
         """Folder object to which the parsed contacts will be added. fn is the
         name of the BBDB file/message store. encoding is a string representing
@@ -262,34 +462,26 @@ class MessageStore:
             ## format 
             self._set_regexes(ver)
 
-            cnt = 0
-            while True:
-                try:
-                    ff = bbf.readline().strip()
-                except UnicodeDecodeError, e:
-                    ## We got the encoding wrong. We will have to drop
-                    ## everything we have done, and start all over again.  At
-                    ## a later stage, we could optimize by skipping over
-                    ## whatever we have read so far, but then we will need to
-                    ## evalute if the parsed strings will be in the same
-                    ## encoding or not. Tricky and shady business, this.
-                    raise ASynKBBDBUnicodeError('')
-
-                if re.search('^\s*$', ff):
-                    break
-
-                if re.search('^;', ff):
-                    self.append_preamble(ff + "\n")
-                    continue
-
-                try:
-                    c  = BBContact(def_f, rec=ff.rstrip())
-                except BBDBParseError, e:
-                    logging.error('Could not parse BBDB record: %s', ff)
-
-                    raise BBDBFileFormatError(('Cannot proceed with '
-                                              'processing file "%s" ') % fn)
+            recs  = self._read_recs(bbf)
+            procs = self.get_db().get_parse_processes()
 
+            ## The workers are forked, which is only safe while this is the
+            ## only thread around - a lock held by another thread, for
+            ## e.g. that of logging, would stay held for good in the
+            ## workers. When syncing profiles or folders concurrently we
+            ## make do with parsing right here.
+            if procs > 1 and threading.active_count() > 1:
+                logging.debug('Other threads are running. Parsing %s '
+                              'without a process pool.', fn)
+                procs = 1
+
+            if procs > 1 and len(recs) > procs:
+                cons = self._parse_recs_in_pool(def_f, fn, recs, procs)
+            else:
+                cons = (self._parse_rec(def_f, fn, rec) for rec in recs)
+
+            cnt = 0
+            for c in cons:
                 fon = c.get_bbdb_folder()
 
                 if fon:
@@ -305,6 +497,130 @@ class MessageStore:
 
             return bbf, cnt
 
+    def _read_recs (self, bbf):
+        """Read the records from the open BBDB file bbf, positioned just past
+        the preamble, and return them as a list of strings. Comment lines are
+        added to the preamble."""
+
+        recs = []
+        while True:
+            try:
+                ff = bbf.readline().strip()
+            except UnicodeDecodeError, e:
+                ## We got the encoding wrong. We will have to drop
+                ## everything we have done, and start all over again.  At
+                ## a later stage, we could optimize by skipping over
+                ## whatever we have read so far, but then we will need to
+                ## evalute if the parsed strings will be in the same
+                ## encoding or not. Tricky and shady business, this.
+                raise ASynKBBDBUnicodeError('')
+
+            if re.search('^\s*$', ff):
+                break
+
+            if re.search('^;', ff):
+                self.append_preamble(ff + "\n")
+                continue
+
+            recs.append(ff)
+
+        return recs
+
+    def _parse_rec (self, def_f, fn, rec, parsed=None):
+        try:
+            return BBContact(def_f, rec=rec, parsed=parsed)
+        except BBDBParseError, e:
+            logging.error('Could not parse BBDB record: %s', rec)
+
+            raise BBDBFileFormatError(('Cannot proceed with '
+                                      'processing file "%s" ') % fn)
+
+    def _parse_recs_in_pool (self, def_f, fn, recs, procs):
+        """Parse recs in a pool of procs worker processes, and return the
+        resulting contacts in the same order as the records. The records are
+        handed out in chunks, a few per worker to even out the load."""
+
+        global _pool_folder
+
+        size   = max(1, len(recs) / (procs * 4))
+        chunks = [recs[i:i+size] for i in range(0, len(recs), size)]
+
+        logging.info('Parsing %d records in %d chunks with %d processes',
+                     len(recs), len(chunks), procs)
+
+        _pool_folder = def_f
+        pool = multiprocessing.Pool(procs)
+        try:
+            res = pool.map(_parse_recs, chunks)
+            pool.close()
+        except BBDBParseError, e:
+            pool.terminate()
+            logging.error('Could not parse BBDB record: %s', e)
+
+            raise BBDBFileFormatError(('Cannot proceed with '
+                                      'processing file "%s" ') % fn)
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _pool_folder = None
+
+        for chunk, parsed in zip(chunks, res):
+            for rec, p in zip(chunk, parsed):
+                yield self._parse_rec(def_f, fn, rec, parsed=p)
+
+    def index_with_encoding (self, def_f, fn, encoding):
+        """The lazy counterpart of parse_with_encoding(). The file is memory
+        mapped and, instead of a full BBContact, a BBContactRef recording the
+        location and the cheap sync related fields of each record is added to
+        the folders."""
+
+        if not os.path.exists(fn):
+            utils.touch(fn)
+
+        bbf = MappedLineReader(self.map_file(fn), encoding)
+        ver = self._parse_preamble(fn, bbf)
+        if not ver:
+            ver = self._set_default_preamble()
+
+        self._set_regexes(ver)
+
+        cnt = 0
+        while True:
+            off = bbf.tell()
+            ff  = bbf.readline().strip()
+
+            if re.search('^\s*$', ff):
+                break
+
+            if re.search('^;', ff):
+                self.append_preamble(ff + "\n")
+                continue
+
+            try:
+                c = BBContactRef(self, off, bbf.tell() - off, ff)
+            except BBDBParseError, e:
+                logging.error('Could not parse BBDB record: %s', ff)
+
+                raise BBDBFileFormatError(('Cannot proceed with '
+                                          'processing file "%s" ') % fn)
+
+            fon = c.get_bbdb_folder()
+
+            if fon:
+                f = self.get_folder(fon)
+                if not f:
+                    f = BBContactsFolder(self.get_db(), fon, self)
+                    self.add_folder(f)
+                f.add_contact_ref(c)
+            else:
+                def_f.add_contact_ref(c)
+
+            cnt += 1
+
+        return bbf, cnt
+
     def populate_folders (self, fn=None):
         """Parse a BBDB file contents, and create folders of contacts."""
 
@@ -333,13 +649,24 @@ class MessageStore:
         self.add_folder(def_f)
         failed = True
 
-        for encoding in self.get_db().get_text_encodings():
+        ## The sniffed encoding is all but certain to work, but hang on to the
+        ## rest in case it does not.
+        encodings = self.get_db().get_text_encodings()
+        sniffed   = self.sniff_encoding(fn)
+        if sniffed:
+            encodings = [sniffed] + [x for x in encodings if x != sniffed]
+
+        for encoding in encodings:
             self.set_encoding(encoding)
             try:
                 logging.info('Parsing BBDB Store with encoding %s...',
                              encoding)
-                bbf, cnt = self.parse_with_encoding(def_f, fn,
-                                                    encoding=encoding)
+                if self.is_lazy():
+                    bbf, cnt = self.index_with_encoding(def_f, fn,
+                                                        encoding=encoding)
+                else:
+                    bbf, cnt = self.parse_with_encoding(def_f, fn,
+                                                        encoding=encoding)
                 logging.info('Parsing BBDB Store with encoding %s...Success',
                              encoding)
                 failed = False
@@ -364,20 +691,54 @@ class MessageStore:
         bbf.close()
 
     def save_file (self, fn=None):
+        """Write the store out to the BBDB file fn, which defaults to the
+        file it was read from. The contents are written to a temporary file
+        which is then renamed over the target, so an interrupted save never
+        leaves behind a truncated BBDB file."""
+
         if not fn:
             fn = self.get_name()
 
         fn = utils.abs_pathname(self.get_config(), fn)
         logging.info('Saving BBDB File %s...', fn)
 
-        with codecs.open(fn, 'w', encoding=self.get_encoding()) as bbf:
+        ## Records that have not been parsed in a lazy store are read out of
+        ## the memory mapped file while saving. Once the new file is in place
+        ## they are pointed at their new locations.
+        mapped = self.is_lazy() and fn == self._mapped_name()
+        moves  = [] if mapped else None
+
+        ## Replace the file a symlink points to, rather than the link itself
+        fn  = os.path.realpath(fn)
+        tmp = fn + '.tmp'
+
+        with codecs.open(tmp, 'w', encoding=self.get_encoding()) as bbf:
             bbf.write(self.get_preamble())
 
             for name, f in self.get_folders().iteritems():
-                f.write_to_file(bbf)
+                f.write_to_file(bbf, moves=moves)
+
+        if os.path.exists(fn):
+            shutil.copymode(fn, tmp)
+
+        if mapped:
+            self.unmap_file()
+
+        utils.replace_file(tmp, fn)
+
+        if mapped:
+            self.map_file(fn)
+            for ref, offset, length in moves:
+                ref.set_offset(offset, length)
+
+        ## We know the encoding of what we just wrote
+        self._cache_encoding(fn, os.stat(fn), self.get_encoding())
 
         logging.info('Saving BBDB File %s...done', fn)
 
+    def _mapped_name (self):
+        return utils.abs_pathname(self.get_config(), self.get_name())
+
     def prep_for_sync (self, pname):
         self.create_backup(pname)
 
@@ -408,6 +769,8 @@ class MessageStore:
         store  = self.get_name()
         logging.info('Restoring BBDB Store (%s) from backup... (%s)',
                      store, backup)
+        ## Do not leave a mapping around for a file being overwritten under it
+        self.unmap_file()
         shutil.copy2(backup, store)
         logging.info('Restoring BBDB Store (%s) from backup...done (%s)',
                      store, backup)
@@ -429,6 +792,24 @@ class BBPIMDB(PIMDB):
         enc = self.get_db_config()['text_encodings']
         self.set_text_encodings(enc)
 
+        try:
+            self.set_rec_parsers(self.get_db_config()['record_parser'])
+        except KeyError, e:
+            ## Older config files do not have this.
+            self.set_rec_parsers('sexp')
+
+        try:
+            self.set_lazy_store(self.get_db_config()['lazy_store'])
+        except KeyError, e:
+            ## Older config files do not have this.
+            self.set_lazy_store(False)
+
+        try:
+            self.set_parse_processes(self.get_db_config()['parse_processes'])
+        except KeyError, e:
+            ## Older config files do not have this.
+            self.set_parse_processes(1)
+
         ## For now the only version we support is file format 7. But in the
         ## near future ...
         self.set_regexes({})
@@ -461,6 +842,50 @@ class BBPIMDB(PIMDB):
     def get_text_encodings (self):
         return self.text_encodings
 
+    def set_rec_parsers (self, parsers):
+        """parsers is either the name of a record parser ('sexp' or 'regex')
+        to be used for all file format versions, or a dictionary mapping a
+        file format version to the name of the parser for that version."""
+
+        self.rec_parsers = parsers
+        return parsers
+
+    def get_rec_parser (self, ver):
+        """Return the name of the record parser to be used for files of the
+        given file format version. Versions not explicitly listed in a
+        dictionary of parsers default to the sexp parser."""
+
+        if isinstance(self.rec_parsers, dict):
+            return self.rec_parsers.get(ver, 'sexp')
+
+        return self.rec_parsers
+
+    def is_lazy_store (self):
+        return self.lazy_store
+
+    def set_lazy_store (self, val):
+        self.lazy_store = val
+        return val
+
+    def get_parse_processes (self):
+        """Return the number of processes to parse BBDB records with. A value
+        of 1 means parse serially in this process."""
+
+        return self.parse_processes
+
+    def set_parse_processes (self, val):
+        if val is None or val == 0:
+            val = multiprocessing.cpu_count()
+
+        ## The workers inherit the state of the parent by forking
+        if val > 1 and not hasattr(os, 'fork'):
+            logging.info('Parallel parsing of BBDB files is not supported '
+                         'on this platform. Parsing serially.')
+            val = 1
+
+        self.parse_processes = val
+        return val
+
     def get_msgstore (self, name):
         return self.msgstores[name]
 
@@ -670,9 +1095,16 @@ class BBPIMDB(PIMDB):
         
         ver = '6'
 
+        ## The names of the fields of a record vector, in order. These are
+        ## used by the sexp record parser and are the same as the group
+        ## names in re_con above.
+        con_fields = ('firstname', 'lastname', 'aka', 'company', 'phones',
+                      'addrs', 'emails', 'notes', 'cache')
+
         ## Now save some of the regexes for later use...
         self.add_regexes(ver, {
             'con_re' : re_con,
+            'con_fields' : con_fields,
             'str_re' : res['string'],
             'adr_re' : re_ad_vec,
             'ph_re'  : re_ph_vec,
@@ -727,9 +1159,13 @@ class BBPIMDB(PIMDB):
                   '(?P<cache>'     + res['string']       + ')\s*' +
                   '\s*\]')
 
+        con_fields = ('firstname', 'lastname', 'affix', 'aka', 'company',
+                      'phones', 'addrs', 'emails', 'notes', 'cache')
+
         ## Now save some of the regexes for later use...
         self.add_regexes(ver, {
             'con_re' : re_con,
+            'con_fields' : con_fields,
             'str_re' : res['string'],
             'adr_re' : re_ad_vec,
             'ph_re'  : re_ph_vec,
@@ -791,9 +1227,14 @@ class BBPIMDB(PIMDB):
                   '(?P<cache>'     + res['string']       + ')\s*' +
                   '\s*\]')
 
+        con_fields = ('firstname', 'lastname', 'affix', 'aka', 'company',
+                      'phones', 'addrs', 'emails', 'notes', 'bbdbid',
+                      'createdon', 'lastupdated', 'cache')
+
         ## Now save some of the regexes for later use...
         self.add_regexes(ver, {
             'con_re' : re_con,
+            'con_fields' : con_fields,
             'str_re' : res['string'],
             'adr_re' : re_ad_vec,
             'ph_re'  : re_ph_vec,
@@ -31,7 +31,7 @@ from   caldavclientlibrary.protocol.url   import URL
 from   caldavclientlibrary.client.account import CalDAVAccount
 
 import iso8601
-import datetime, logging, os, re, sys, urllib, urlparse
+import datetime, logging, os, re, sys, threading, urllib, urlparse
 
 class CardDAVPrincipalNotFoundError(Exception):
     pass
@@ -250,7 +250,52 @@ class CDPIMDB(PIMDB):
         self.settings = s
 
     def session (self):
-        return self.get_account().session
+        """Return the CardDAV session to use on the calling thread. A
+        session of the client library cannot be used from more than one
+        thread at a time, so every thread other than the one that logged in
+        gets a session of its own. It is one given back by an earlier thread
+        with release_session() if there is one to spare, and a new login
+        otherwise."""
+
+        if threading.current_thread() is self.login_thread:
+            return self.get_account().session
+
+        sess = getattr(self.sessions, 'session', None)
+        if sess is None:
+            with self.lock:
+                sess = self.spares.pop() if self.spares else None
+
+            if sess is None:
+                logging.debug('New CardDAV session for thread %s',
+                              threading.current_thread().name)
+                sess = self._new_account().session
+
+            self.sessions.session = sess
+
+        return sess
+
+    def release_session (self):
+        """Give the session of the calling thread, if it has one, back for
+        use by other threads, or to be closed by close_idle(). The thread
+        should not use it after this."""
+
+        sess = getattr(self.sessions, 'session', None)
+        if sess is not None:
+            self.sessions.session = None
+            with self.lock:
+                self.spares.append(sess)
+
+    def close_idle (self):
+        """See the documentation in class PIMDB"""
+
+        with self.lock:
+            spares, self.spares = self.spares, []
+
+        for sess in spares:
+            sess.closeConnection()
+
+        if spares:
+            logging.debug('Closed %d spare CardDAV sessions', len(spares))
 
     def set_client_logging (self, val):
         self.client_logging = val
@@ -269,17 +314,26 @@ class CDPIMDB(PIMDB):
         self.set_server(splits.scheme + "://" + splits.netloc)
         self.set_path(splits.path)
 
-    def cd_init (self):
+    def _new_account (self):
         sf  = self.get_server()
         ssl = sf.startswith('https://')
         server = sf[8:] if ssl else sf[7:]
+
+        return CalDAVAccount(server, ssl=ssl, user=self.get_user(),
+                             pswd=self.get_pw(), root=self.get_path(),
+                             principal=None,
+                             logging=self.get_client_logging())
+
+    def cd_init (self):
+        self.login_thread = threading.current_thread()
+        self.sessions     = threading.local()
+        self.spares       = []
+        self.lock         = threading.Lock()
+
         try:
-            account  = CalDAVAccount(server, ssl=ssl, user=self.get_user(),
-                                     pswd=self.get_pw(), root=self.get_path(),
-                                     principal=None,
-                                     logging=self.get_client_logging())
+            account = self._new_account()
         except HTTPError, e:
-            server = "Carddav Server (%s)" % sf
+            server = "Carddav Server (%s)" % self.get_server()
             logging.fatal('Could not open connection to %s. Error: %s',
                           server, e)
             raise
@@ -20,13 +20,15 @@
 ## ####
 ##
 
-import base64, datetime, getopt, httplib2, logging, os, sys, threading, time
+import base64, datetime, getopt, httplib, httplib2, logging, os, select
+import socket, sys, threading, time
 import utils, webbrowser
 from   urlparse import urlparse
 import SimpleHTTPServer, SocketServer
 
 from   apiclient import discovery
-import atom, gdata.contacts.data, gdata.contacts.client
+import atom, atom.http_core, gdata.contacts.data, gdata.contacts.client
+import parser_gc
 from   oauth2client.client import flow_from_clientsecrets as flow_from_cs
 from   oauth2client.file   import Storage
 
@@ -49,6 +51,215 @@ def patched_post(client, entry, uri, auth_token=None, converter=None,
                           http_request=http_request, converter=converter,
                           desired_class=desired_class, **kwargs)
 
+class PooledResponse:
+    """Wraps a httplib response obtained on a pooled connection, and hands
+    the connection back to the pool once the response has been read in
+    full. If reading the response fails, or it is closed or dropped before
+    it has been read in full, the connection is closed instead."""
+
+    def __init__ (self, resp, release):
+        self.resp    = resp
+        self.release = release
+
+    def read (self, amt=None):
+        try:
+            data = self.resp.read(amt)
+        except:
+            self._release(False)
+            raise
+
+        if self.resp.isclosed():
+            self._release(not self.resp.will_close)
+
+        return data
+
+    def close (self):
+        self._release(False)
+        self.resp.close()
+
+    def _release (self, reuse):
+        ## Not self.release, which would go to __getattr__ if we are being
+        ## collected after a failed __init__.
+        release = self.__dict__.get('release')
+        if release:
+            self.release = None
+            release(reuse)
+
+    def __del__ (self):
+        self._release(False)
+
+    def __getattr__ (self, name):
+        return getattr(self.resp, name)
+
+class PooledHttpClient(atom.http_core.ProxiedHttpClient):
+    """An atom HttpClient that keeps connections to the server open and
+    reuses them for later requests, instead of paying for a new connection
+    and TLS handshake on every request. Up to size idle connections are
+    kept per server; the rest are closed once they are done with.
+
+    If server is specified, as a url, all the requests are sent there
+    regardless of the host they are addressed to. Otherwise, requests to a
+    server for whose scheme a proxy is set up in the environment, with
+    http_proxy or https_proxy, are handed to the ProxiedHttpClient of atom
+    - which is what gdata uses by default - and are not pooled."""
+
+    ## Methods that can safely be sent again if it is not known whether the
+    ## server got them the first time around. This leaves out POST, which
+    ## is what batch operations use.
+    IDEMPOTENT = ['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS']
+
+    def __init__ (self, size=4, timeout=60, server=None):
+        self.size    = size
+        self.timeout = timeout
+        self.server  = None
+        if server:
+            u = urlparse(server)
+            self.server = (u.scheme, u.hostname, u.port)
+        self.idle    = {}
+        self.lock    = threading.Lock()
+        self.stats   = {'requests'    : 0,
+                        'connections' : 0,
+                        'reused'      : 0,
+                        'retries'     : 0}
+
+    def get_stats (self):
+        with self.lock:
+            return dict(self.stats)
+
+    def close (self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+
+    def _checkout (self, key):
+        with self.lock:
+            conns = self.idle.get(key) or []
+            while conns:
+                conn = conns.pop()
+                if self._is_dropped(conn):
+                    conn.close()
+                    continue
+
+                self.stats['reused'] += 1
+                return conn, True
+
+            self.stats['connections'] += 1
+
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, port, timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(host, port, timeout=self.timeout)
+
+        return conn, False
+
+    def _is_dropped (self, conn):
+        """Whether the server has closed the idle connection conn. Nothing is
+        expected on an idle connection, so if there is something to read it
+        can only be the end of it - or garbage."""
+
+        if not conn.sock:
+            return True
+
+        try:
+            return bool(select.select([conn.sock], [], [], 0)[0])
+        except (select.error, socket.error), e:
+            return True
+
+    def _checkin (self, key, conn, reuse):
+        if reuse:
+            with self.lock:
+                conns = self.idle.setdefault(key, [])
+                if len(conns) < self.size:
+                    conns.append(conn)
+                    return
+
+        conn.close()
+
+    def _is_proxied (self, uri):
+        return (not self.server and
+                bool(os.environ.get('%s_proxy' % uri.scheme)))
+
+    def _http_request (self, method, uri, headers=None, body_parts=None):
+        if isinstance(uri, (str, unicode)):
+            uri = atom.http_core.Uri.parse_uri(uri)
+
+        with self.lock:
+            self.stats['requests'] += 1
+
+        if self._is_proxied(uri):
+            return atom.http_core.ProxiedHttpClient._http_request(
+                self, method, uri, headers, body_parts)
+
+        key = self.server or (uri.scheme, uri.host, uri.port)
+
+        while True:
+            conn, reused = self._checkout(key)
+            sent = False
+            try:
+                self._send(conn, method, uri, headers or {}, body_parts)
+                sent = True
+                resp = conn.getresponse()
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                if not (reused and self._can_retry(method, sent, e)):
+                    raise
+
+                ## The server has most likely timed out the idle connection
+                ## under our feet. Try again on another one.
+                logging.debug('Retrying request on a new connection (%s)', e)
+                with self.lock:
+                    self.stats['retries'] += 1
+                continue
+
+            def release (reuse, key=key, conn=conn):
+                self._checkin(key, conn, reuse)
+
+            return PooledResponse(resp, release)
+
+    def _can_retry (self, method, sent, e):
+        """Whether a request that failed with the exception e on a reused
+        connection can be sent again on another one. sent is True if the
+        request went out in full before the failure. Once a request is out
+        it may well have been acted upon, however the response was lost;
+        the only failure that tells us it was not is the connection being
+        closed without a byte of response - and even then a request that is
+        not idempotent is not risked again."""
+
+        if not sent:
+            return True
+
+        if not method.upper() in self.IDEMPOTENT:
+            return False
+
+        if not isinstance(e, httplib.BadStatusLine):
+            return False
+
+        ## Python versions differ on what they put in the exception when
+        ## nothing was read.
+        line = e.line or ''
+        return (line in ['', "''", '""'] or
+                line.startswith('No status line received'))
+
+    def _send (self, conn, method, uri, headers, body_parts):
+        if self.debug:
+            conn.set_debuglevel(1)
+
+        conn.putrequest(method, uri._get_relative_path(),
+                        skip_accept_encoding=True)
+        for name, value in headers.iteritems():
+            conn.putheader(name, value)
+        conn.endheaders()
+
+        for part in (body_parts or []):
+            if isinstance(part, unicode):
+                part = part.encode('utf-8')
+            elif not isinstance(part, str):
+                part = part.read()
+            conn.send(part)
+
 class MyAuthToken:
     def __init__ (self, config, credentials):
         self.config = config
@@ -66,10 +277,20 @@ class GCPIMDB(PIMDB):
 
     def __init__ (self, config, user, pw):
         self.server = None
+        self.credentials = None
+        self.reqs   = {}
+        self.reqs_lock = threading.Lock()
 
         PIMDB.__init__(self, config)
         self.set_user(user)
         self.set_cs(pw)
+
+        try:
+            self.set_atom_codec(self.get_db_config()['atom_codec'])
+        except KeyError, e:
+            ## Older config files do not have this.
+            self.set_atom_codec('lean')
+
         self.gc_init()
 
         self.set_folders()
@@ -78,6 +299,18 @@ class GCPIMDB(PIMDB):
         if not self.server is None:
             self.server.shutdown()
 
+    def log_stats (self):
+        """See the documentation in class PIMDB"""
+
+        s = self.get_gdc().http_client.get_stats()
+        logging.info('Google requests: %d feed pages, %d batches',
+                     self.get_request_count('page'),
+                     self.get_request_count('batch'))
+        logging.info('Google HTTP: %d requests on %d connections '
+                     '(%d reuses, %d retries after a dropped connection)',
+                     s['requests'], s['connections'], s['reused'],
+                     s['retries'])
+
     ##
     ## First implementation of the abstract methods of PIMDB.
     ##
@@ -218,6 +451,43 @@ class GCPIMDB(PIMDB):
     def set_gdc (self, gdc):
         self.gdc = gdc
 
+    def get_atom_codec (self):
+        return self.atom_codec
+
+    def set_atom_codec (self, codec):
+        if not codec in ['lean', 'gdata']:
+            raise GoutInvalidPropValueError('Unknown atom_codec: %s' % codec)
+
+        self.atom_codec = codec
+
+    def get_converter (self, stream=False):
+        """Return the converter to be passed to gdata client requests, so
+        the response is read with the configured codec. None means gdata's
+        own object model. If stream is True, the entries of a feed read with
+        the lean codec can be iterated over only once, as they come in."""
+
+        if self.atom_codec != 'lean':
+            return None
+
+        return parser_gc.stream_feed if stream else parser_gc.parse_feed
+
+    def count_request (self, kind):
+        """Keep track of the number of requests of each kind - 'list' for
+        a fetch of a contacts feed, 'page' for each page fetched of such a
+        feed, 'batch' for a batch operation - made to Google."""
+
+        with self.reqs_lock:
+            self.reqs[kind] = self.reqs.get(kind, 0) + 1
+
+    def get_request_count (self, kind=None):
+        """Return the number of requests of the specified kind made so far,
+        or the number of requests of all kinds if kind is None."""
+
+        with self.reqs_lock:
+            if kind is None:
+                return sum(self.reqs.values())
+            return self.reqs.get(kind, 0)
+
     def _init_webserver (self, port):
         class MyRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
             def do_GET (self1):
@@ -240,7 +510,7 @@ class GCPIMDB(PIMDB):
         thread.start()
 
     def _new_http (self):
-        http = httplib2.Http()
+        http = httplib2.Http(timeout=self.get_config().get_gc_http_timeout())
         debug = self.get_config().get_gc_logging()
         if debug:
             http.debuglevel = 4
@@ -269,7 +539,7 @@ class GCPIMDB(PIMDB):
 
         return self.credentials
 
-    def gc_init (self):
+    def _login (self):
         logging.info('Attempting to log into Google...')
         user_dir = self.get_config().get_user_dir()
         cs_file = os.path.abspath(os.path.join(user_dir,
@@ -288,9 +558,26 @@ class GCPIMDB(PIMDB):
                 else:
                     logging.info('Using pre-fetched access_token...')
 
-        auth = MyAuthToken(self.get_config(), self.credentials)
+        return self.credentials
+
+    def gc_init (self):
+        conf = self.get_config()
+        server = conf.get_gc_server_url()
+
+        if server:
+            ## A stand-in for Google such as test/fake_gc.py, which does not
+            ## need any authentication
+            logging.info('Using Google Contacts server at %s', server)
+            auth = None
+        else:
+            auth = MyAuthToken(conf, self._login())
+
+        http = PooledHttpClient(size=conf.get_gc_http_pool_size(),
+                                timeout=conf.get_gc_http_timeout(),
+                                server=server)
         gdc = gdata.contacts.client.ContactsClient(source='ASynK',
-                                                   auth_token=auth)
+                                                   auth_token=auth,
+                                                   http_client=http)
         self.set_gdc(gdc)
 
         ## Mon Jun 15 16:07:56 IST 2015 Not sure why this code is commented
@@ -349,8 +636,25 @@ class GCPIMDB(PIMDB):
         return None
 
     def new_feed (self):
+        if self.atom_codec == 'lean':
+            return parser_gc.BatchFeed()
+
         return gdata.contacts.data.ContactsFeed()
 
+    def new_entry (self, gcid, etag=None):
+        """Return an entry with just the specified id and etag, as needed
+        for batch queries and deletes."""
+
+        if self.atom_codec == 'lean':
+            return parser_gc.entry([parser_gc.elem('atom:id', gcid)], etag)
+
+        ce = gdata.contacts.data.ContactEntry()
+        ce.id = atom.data.Id(text=gcid)
+        if etag:
+            ce.etag = etag
+
+        return ce
+
     def exec_batch (self, batch_feed, extra_headers=None):
         # return self.get_gdc().ExecuteBatch(
         #     batch_feed, gdata.contacts.client.DEFAULT_BATCH_URL,
@@ -361,5 +665,15 @@ class GCPIMDB(PIMDB):
         # repeated requests to fix this. Eventually someone suggested a
         # workaround that worked. The method patched_post is take from here:
         # https://code.google.com/p/gdata-python-client/issues/detail?id=700#c9
+        self.count_request('batch')
+        if self.atom_codec == 'lean':
+            ## The feed is written out with the gd prefix to begin with, so
+            ## patched_post's fixup of the prefix is not needed.
+            http_request = atom.http_core.HttpRequest()
+            http_request.add_body_part(str(batch_feed), 'application/atom+xml')
+            return self.get_gdc().request(
+                method='POST', uri=gdata.contacts.client.DEFAULT_BATCH_URL,
+                http_request=http_request, converter=parser_gc.parse_feed)
+
         return patched_post(self.get_gdc(), batch_feed,
                             gdata.contacts.client.DEFAULT_BATCH_URL)
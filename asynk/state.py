@@ -26,8 +26,8 @@
 ## wondering, at some point in the past it all resided in a single json file,
 ## and we are continuing to use the same handling framework...
 
-import iso8601, demjson
-import glob, logging, os, re, shutil, sys, time, stat
+import iso8601, demjson, utils
+import glob, logging, os, re, shutil, sys, threading, time, stat
 
 sync_dirs = ['SYNC1WAY', 'SYNC2WAY']
 
@@ -52,6 +52,14 @@ class Config:
         self.state = { 'state'  : {},
                        'config' : {} }
 
+        ## Parsed sync labels, keyed by label. See parse_sync_label()
+        self.sync_labels = {}
+
+        ## Profiles may be synched concurrently from multiple threads. All
+        ## changes to the state, and writing it out to disk, are done holding
+        ## this lock.
+        self.lock = threading.RLock()
+
         self.sync_through = False
         self.set_app_root(asynk_base_dir)
         self.set_user_dir(user_dir)
@@ -223,45 +231,48 @@ class Config:
         return self.state[group][key]
 
     def _set_prop (self, group, key, val, sync=True):
-        self.state[group][key] = val
+        with self.lock:
+            self.state[group][key] = val
 
-        if self.sync_through and sync:
-            if group == 'state':
-                self.save_state()
-            elif group == 'config':
-                self.save_config()
+            if self.sync_through and sync:
+                if group == 'state':
+                    self.save_state()
+                elif group == 'config':
+                    self.save_config()
 
     def _append_to_prop (self, group, key, val, sync=True):
         """In the particular property value is an array, we would like to
         append individual elements to the property value. this method does
         exactly that."""
 
-        if not self.state[group][key]:
-            self.state[group][key] = [val]
-        else:
-            self.state[group][key].append(val)
+        with self.lock:
+            if not self.state[group][key]:
+                self.state[group][key] = [val]
+            else:
+                self.state[group][key].append(val)
 
-        if self.sync_through and sync:
-            if group == 'state':
-                self.save_state()
-            elif group == 'config':
-                self.save_config()
+            if self.sync_through and sync:
+                if group == 'state':
+                    self.save_state()
+                elif group == 'config':
+                    self.save_config()
 
     def _update_prop (self, group, prop, which, val, sync=True):
         """If a particular property value is a dictionary, we would like to
         update the dictinary with a new mapping or alter an existing
         mapping. This method does exactly that."""
 
-        if not self.state[group][prop]:
-            self.state[group][prop] = {which : val}
-        else:
-            self.state[group][prop].update({which : val})
+        with self.lock:
+            if not self.state[group][prop]:
+                self.state[group][prop] = {which : val}
+            else:
+                self.state[group][prop].update({which : val})
 
-        if self.sync_through and sync:
-            if group == 'state':
-                self.save_state()
-            elif group == 'config':
-                self.save_config()
+            if self.sync_through and sync:
+                if group == 'state':
+                    self.save_state()
+                elif group == 'config':
+                    self.save_config()
 
     ## get/set properties for specified sync profiles.Invalid field access
     ## will throw a AsynkConfigError exeption. ss in the method names stands
@@ -283,10 +294,11 @@ class Config:
             raise AsynkConfigError('Profile %s not found in state.json'
                                    % profile)
 
-        self.state['state']['profiles'][profile].update({key : val})
+        with self.lock:
+            self.state['state']['profiles'][profile].update({key : val})
 
-        if self.sync_through and sync:
-            self.save_state()
+            if self.sync_through and sync:
+                self.save_state()
 
     def get_curr_time (self):
         return iso8601.tostring(time.time())
@@ -318,9 +330,23 @@ class Config:
             ## return a default value
             return 7        
 
+    def get_sync_workers (self):
+        try:
+            return self._get_prop('config', 'sync_workers')
+        except KeyError, e:
+            ## Older config files do not have this.
+            return 4
+
     def get_log_dir (self):
         return self._get_prop('config', 'log_dir')
 
+    def get_cache_dir (self):
+        try:
+            return self._get_prop('config', 'cache_dir')
+        except KeyError, e:
+            ## Older config files do not have this.
+            return 'cache'
+
     def get_log_hold_period (self):
         try:
             return self._get_prop('config', 'log_hold_period')
@@ -356,9 +382,107 @@ class Config:
     def get_cd_logging (self):
         return self.get_db_config('cd')['log']
 
+    def get_cd_multiget_size (self):
+        try:
+            return self.get_db_config('cd')['multiget_size']
+        except KeyError, e:
+            ## Older config files do not have this.
+            return 100
+
+    def get_cd_multiget_concurrency (self):
+        try:
+            return self.get_db_config('cd')['multiget_concurrency']
+        except KeyError, e:
+            ## Older config files do not have this.
+            return 4
+
+    def get_cd_put_concurrency (self):
+        try:
+            return self.get_db_config('cd')['put_concurrency']
+        except KeyError, e:
+            ## Older config files do not have this.
+            return 4
+
+    def get_cd_put_retries (self):
+        try:
+            return self.get_db_config('cd')['put_retries']
+        except KeyError, e:
+            ## Older config files do not have this.
+            return 3
+
+    def get_cd_put_backoff (self):
+        try:
+            return self.get_db_config('cd')['put_backoff']
+        except KeyError, e:
+            ## Older config files do not have this.
+            return 1.0
+
+    def get_cd_cache (self):
+        try:
+            return self.get_db_config('cd')['cache']
+        except KeyError, e:
+            ## Older config files do not have this.
+            return True
+
     def get_gc_logging (self):
         return self.get_db_config('gc')['log']
 
+    def get_gc_feed_page_size (self):
+        try:
+            return self.get_db_config('gc')['feed_page_size']
+        except KeyError, e:
+            ## Older config files do not have this.
+            return 500
+
+    def get_gc_batch_max_entries (self):
+        try:
+            return self.get_db_config('gc')['batch_max_entries']
+        except KeyError, e:
+            ## Older config files do not have this.
+            return 100
+
+    def get_gc_batch_max_size (self):
+        try:
+            return self.get_db_config('gc')['batch_max_size']
+        except KeyError, e:
+            ## Older config files do not have this.
+            return 900 * 1024
+
+    def get_gc_batch_concurrency (self):
+        try:
+            return self.get_db_config('gc')['batch_concurrency']
+        except KeyError, e:
+            ## Older config files do not have this.
+            return 4
+
+    def get_gc_batch_retries (self):
+        try:
+            return self.get_db_config('gc')['batch_retries']
+        except KeyError, e:
+            ## Older config files do not have this.
+            return 5
+
+    def get_gc_http_pool_size (self):
+        try:
+            return self.get_db_config('gc')['http_pool_size']
+        except KeyError, e:
+            ## Older config files do not have this.
+            return 4
+
+    def get_gc_http_timeout (self):
+        try:
+            return self.get_db_config('gc')['http_timeout']
+        except KeyError, e:
+            ## Older config files do not have this.
+            return 60
+
+    def get_gc_server_url (self):
+        try:
+            return self.get_db_config('gc')['server_url']
+        except KeyError, e:
+            ## Older config files do not have this.
+            return None
+
     def get_ex_guid (self):
         return self.get_db_config('ex')['guid']
 
@@ -452,6 +576,27 @@ class Config:
         coll2.update({'stid' : stid})
         return self.set_coll_2(profile, coll2, sync)
 
+    ## The sync token of a folder is whatever the get_state() method of its
+    ## token returned - see folder.SyncToken. Older state.json files do not
+    ## have these, and neither does a folder that has not been through a
+    ## successful sync yet. None is returned in that case.
+
+    def get_sync_token1 (self, profile):
+        return self.get_coll_1(profile).get('sync_token')
+
+    def set_sync_token1 (self, profile, token, sync=True):
+        coll1 = self.get_coll_1(profile)
+        coll1.update({'sync_token' : token})
+        return self.set_coll_1(profile, coll1, sync)
+
+    def get_sync_token2 (self, profile):
+        return self.get_coll_2(profile).get('sync_token')
+
+    def set_sync_token2 (self, profile, token, sync=True):
+        coll2 = self.get_coll_2(profile)
+        coll2.update({'sync_token' : token})
+        return self.set_coll_2(profile, coll2, sync)
+
     def get_fid1 (self, profile):
         return self.get_coll_1(profile)['foid']
 
@@ -554,6 +699,30 @@ class Config:
         self._set_profile_prop(pname, 'sync_state', sync_state, sync)
         return sync_state
 
+    def get_bb_encoding (self, fn):
+        """Returns the text encoding last determined for the BBDB file fn, as
+        a dictionary with keys 'encoding', 'mtime' and 'size' - the latter two
+        being the file attributes at the time. Returns None if nothing is
+        known about fn."""
+
+        try:
+            return self._get_prop('state', 'bb_encodings')[fn]
+        except KeyError, e:
+            ## Older state.json files do not have this
+            return None
+
+    def set_bb_encoding (self, fn, val, sync=True):
+        try:
+            encs = self._get_prop('state', 'bb_encodings')
+        except KeyError, e:
+            encs = None
+
+        if encs is None:
+            self._set_prop('state', 'bb_encodings', {}, sync=False)
+
+        self._update_prop('state', 'bb_encodings', fn, val, sync)
+        return val
+
     ##
     ## Finally the two save routines.
     ##
@@ -562,18 +731,24 @@ class Config:
         """fn should be the full absolute path. json is the json to be written
         out"""
 
+        ## Write to a temporary file and move it into place, so the file is
+        ## never left half written.
+        tmp = fn + '.tmp'
         try:
-            fi = open(fn, "w")
+            fi = open(tmp, "w")
         except IOError, e:
-            logging.critical('Error! Could not Open file (%s): %s', fn, e)
+            logging.critical('Error! Could not Open file (%s): %s', tmp, e)
             return
 
         fi.write(json)
         fi.close()
 
+        utils.replace_file(tmp, fn)
+
     def save_state (self, fn=None):
-        json = demjson.encode(self.state['state'], compactly=False)
-        self._save(fn if fn else self.staten, json)
+        with self.lock:
+            json = demjson.encode(self.state['state'], compactly=False)
+            self._save(fn if fn else self.staten, json)
 
     def save_config (self, fn=None):
         logging.debug(' ==== Alert - trying to save config.json ==== ')
@@ -652,19 +827,27 @@ class Config:
     
     def parse_sync_label (self, label):
         """Parse the given sync label, which is of the form asynk:profile:ol
-        and return a (profile, dbid) tuple."""
+        and return a (profile, dbid) tuple. None is returned if label is not
+        a sync label - in particular if it is a regular expression matching
+        sync labels. The same few labels are parsed over and over again during
+        a sync, so the results are remembered."""
+
+        try:
+            return self.sync_labels[label]
+        except KeyError, e:
+            pass
 
         pre = self.get_label_prefix()
         sep = self.get_label_separator()
         nre = self.get_profile_name_re()
         dre = self.get_dbid_re()
 
-        reg =  (pre + sep + nre + sep + dre)
+        reg =  (pre + sep + nre + sep + dre + '$')
         res = re.match(reg, label)
-        if res:
-            return (res.group(1), res.group(2))
-        else:
-            return None
+        ret = (res.group(1), res.group(2)) if res else None
+
+        self.sync_labels[label] = ret
+        return ret
 
     def list_profiles (self):
         for key in self.get_profiles().keys():
@@ -24,8 +24,9 @@
 ## (DB ID, Store ID, Folder ID)
 ##
 
-import logging, netrc, os
+import logging, netrc, os, threading
 from   abc              import ABCMeta, abstractmethod
+import utils
 from   pimdb_bb         import BBPIMDB
 from   gdata.client     import BadAuthentication
 from   pimdb_gc         import GCPIMDB
@@ -190,6 +191,12 @@ class Collection:
     def set_colln (self, colln):
         self.colln = colln
 
+    def get_session_key (self):
+        """Collections with the same session key can share a single logged
+        in PIMDB object."""
+
+        return (self.get_dbid(), self.get_stid(), self.get_username())
+
     def all_set (self):
         return (self.get_dbid() is not None and
                 self.get_stid() is not None and
@@ -278,6 +285,13 @@ class BBCollection(Collection):
         bb   = BBPIMDB(self.config, bbfn)
         return self.set_db(bb)
 
+    def get_session_key (self):
+        ## The same BBDB file can be referred to in many ways
+        bbfn = self.get_stid() if self.get_stid() is not None else '~/.bbdb'
+        bbfn = os.path.realpath(utils.abs_pathname(self.get_config(), bbfn))
+
+        return (self.get_dbid(), bbfn, None)
+
 
 class CDCollection(Collection):
     def __init__ (self, config=None, stid=None, fid=None, pname=None, colln=1):
@@ -355,6 +369,38 @@ class OLCollection(Collection):
         return OLPIMDB(self.get_config())
 
 
+class CollectionSessions:
+    """The logged in PIMDB objects of all the collections of the profiles
+    being synched in one invocation. A collection that is part of more than
+    one of the profiles is logged into only once."""
+
+    def __init__ (self):
+        self.lock     = threading.Lock()
+        self.sessions = {}
+
+    def login (self, coll):
+        """Set the PIMDB object of the collection coll to the one shared by
+        all collections with the same session key, logging in if there is no
+        such object yet. Returns the PIMDB object."""
+
+        with self.lock:
+            lock, db = self.sessions.setdefault(coll.get_session_key(),
+                                                [threading.Lock(), None])
+
+        ## Hold a lock specific to the session while logging in, so other
+        ## collections can log in at the same time.
+        with lock:
+            sess = self.sessions[coll.get_session_key()]
+            if sess[1] is None:
+                logging.info('Logging in to %s', coll.get_session_key()[:2])
+                sess[1] = coll.login()
+            else:
+                logging.info('Reusing login to %s',
+                             coll.get_session_key()[:2])
+
+            return coll.set_db(sess[1])
+
+
 collection_id_to_class = {
     'bb' : BBCollection,
     'cd' : CDCollection,
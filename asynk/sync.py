@@ -20,19 +20,103 @@
 ## ####
 ##
 
-import logging, os
+import logging, os, Queue, sys, threading, time
 
 from   state         import Config
 import demjson
 
-import atom, gdata
-from   gdata.client import BadAuthentication
-from   pimdb_gc     import GCPIMDB
-import gdata.contacts.data, gdata.contacts.client
+def reconcile_2_way (f1sl, f2sl, cr, db1id, db2id):
+    """Resolve the conflicts between the sync lists of the two folders of a
+    two way sync, f1sl and f2sl, once they have been populated. Entries
+    modified in both places are retained only in the list of the side named
+    by the conflict resolution direction cr. Modifications to entries
+    deleted on the other side are dropped, as are deletes of entries deleted
+    on both sides. The lists are updated in place.
+
+    Every step here is a single pass over one of the lists with dictionary
+    lookups into the other, so the whole thing is linear in the number of
+    entries."""
+
+    f1_mod = f1sl.get_mods()
+    f2_mod = f2sl.get_mods()
+
+    ## Identify potential conflicts in the modified lists and resolve them
+    ## by deleting the conflict entries from one of the two lists
+
+    # First create a list of matching entries: the f1 ids of entries whose
+    # f2 counterparts have also been modified
+    coma = [id1 for id1,id2 in f1_mod.iteritems() if id2 in f2_mod]
+
+    logging.info('Number of entries modified both places (conflicts): %d',
+                 len(coma))
+
+    if cr == db2id or cr == "2":
+        f1_mod = f1sl.remove_keys_from_mod(coma)
+    elif cr == db1id or cr == "1":
+        f2_mod = f2sl.remove_values_from_mod(coma)
+    else:
+        logging.error('Unknown conflict resolution dir: %s', cr)
+
+    logging.info('conflict resolve direction : %s. db1id: %s, db2id: %s',
+                  cr, db1id, db2id)
+    logging.info('After conflict resolution, size of %s mod : %5d',
+                 db1id, len(f1_mod))
+    logging.info('After conflict resolution, size of %s mod : %5d',
+                 db2id, len(f2_mod))
+
+    ## Now we need to process the deletes as well
+
+    f1_del = f1sl.get_dels()
+    f2_del = f2sl.get_dels()
+
+    coma = [y for x,y in f1_del.iteritems() if y in f2_mod]
+    f2_mod = f2sl.remove_keys_from_mod(coma)
+
+    coma = [y for x,y in f2_del.iteritems() if y in f1_mod]
+    f1_mod = f1sl.remove_keys_from_mod(coma)
+
+    logging.debug('After removing dels from mod, size of %s mod : %5d',
+                  db1id, len(f1_mod))
+    logging.debug('After removing dels from mod, size of %s mod : %5d',
+                  db2id, len(f2_mod))
+
+    # Finally remove entries that have been deleted from both places. Why
+    # bother with these suckers?
+    coma = [(x,y) for x,y in f1_del.iteritems() if y in f2_del]
+    f2_del = f2sl.remove_keys_from_del([y for x,y in coma])
+    f1_del = f1sl.remove_keys_from_del([x for x,y in coma])
+
+    coma = [(x,y) for x,y in f2_del.iteritems() if y in f1_del]
+    f1_del = f1sl.remove_keys_from_del([y for x,y in coma])
+    f2_del = f2sl.remove_keys_from_del([x for x,y in coma])
+
+    logging.info('After conflict resolution, size of %s del : %5d',
+                 db1id, len(f1_del))
+    logging.info('After conflict resolution, size of %s del : %5d',
+                 db2id, len(f2_del))
 
 class Sync:
     BATCH_SIZE = 100
 
+    ## Folders of these databases are bound to the thread that opened them -
+    ## Outlook's are COM objects - and cannot be scanned from another thread
+    THREAD_BOUND_DBIDS = ['ol']
+
+    ## Stores that are written out in full every time a batch of items is
+    ## created or updated in them, or their sync tags are written back.
+    WHOLE_FILE_DBIDS = ['bb']
+
+    @classmethod
+    def can_overlap (cls, fa, fb):
+        """Returns True if folders fa and fb can be worked on from two
+        threads at the same time. That is not the case if either is bound to
+        the thread that opened it, or if both belong to the same PIMDB
+        object, which is not safe to use from two threads at once."""
+
+        return not (fa.get_dbid() in cls.THREAD_BOUND_DBIDS or
+                    fb.get_dbid() in cls.THREAD_BOUND_DBIDS or
+                    fa.get_db() is fb.get_db())
+
     def __init__ (self, config, profile, pimdbs, dirn=None, dr=False):
         """dirn is one of the syn directions, and can be used to override the
         default sync direction stored in the profile. It is then used as the
@@ -95,6 +179,11 @@ class Sync:
             else:
                 raise Exception()
 
+        f1.set_sync_token(f1.new_sync_token(config.get_sync_token1(profile),
+                                            profile))
+        f2.set_sync_token(f2.new_sync_token(config.get_sync_token2(profile),
+                                            profile))
+
         db1.prep_for_sync(self.get_db2id(), profile, dr)
         db2.prep_for_sync(self.get_db1id(), profile, dr)
 
@@ -175,26 +264,11 @@ class Sync:
         f1sl  = SyncLists(f1, pname)
         f2sl  = SyncLists(f2, pname)
 
-        f1.prep_sync_lists(f2.get_dbid(), f1sl)
-        f2.prep_sync_lists(f1.get_dbid(), f2sl)
+        self._prep_sync_lists_concurrently(f1, f2, f1sl, f2sl)
 
         f1sl.log_print_stats()
         f2sl.log_print_stats()
 
-        f1_mod = f1sl.get_mods()
-        f2_mod = f2sl.get_mods()
-
-        ## Identify potential conflicts in the modified lists and resolve them
-        ## by deleting the conflict entries from one of the two lists
-
-        # First create a list of matching entries. comd will be a dictionary
-        # of common entries represented as a dictionary of 'f1_id : f2_id'
-        # pairs: essentially an extract of the f1_mod
-        coma = [id1 for id1,id2 in f1_mod.iteritems() if id2 in f2_mod.keys()]
-
-        logging.info('Number of entries modified both places (conflicts): %d',
-                     len(coma) if coma else 0)
-
         db1id = self.get_db1id()
         db2id = self.get_db2id()
 
@@ -211,56 +285,48 @@ class Sync:
         # db2 = db2id if db1id < db2id else db1id
 
         cr = self.get_config().get_conflict_resolve(pname)
-
-        if cr == db2id or cr == "2":
-            f1_mod = f1sl.remove_keys_from_mod(coma)
-        elif cr == db1id or cr == "1":
-            f2_mod = f2sl.remove_values_from_mod(coma)
-        else:
-            logging.error('Unknown conflict resolution dir: %s', cr)
-
-        logging.info('conflict resolve direction : %s. db1id: %s, db2id: %s',
-                      cr, db1id, db2id)
-        logging.info('After conflict resolution, size of %s mod : %5d',
-                     db1id, len(f1_mod))
-        logging.info('After conflict resolution, size of %s mod : %5d',
-                     db2id, len(f2_mod))
-
-        ## Now we need to process the deletes as well
-
-        f1_del = f1sl.get_dels()
-        f2_del = f2sl.get_dels()
-
-        coma = [y for x,y in f1_del.iteritems() if y in f2_mod.keys()]
-        f2_mod = f2sl.remove_keys_from_mod(coma)
-
-        coma = [y for x,y in f2_del.iteritems() if y in f1_mod.keys()]
-        f1_mod = f1sl.remove_keys_from_mod(coma)
-
-        logging.debug('After removing dels from mod, size of %s mod : %5d',
-                      db1id, len(f1_mod))
-        logging.debug('After removing dels from mod, size of %s mod : %5d',
-                      db2id, len(f2_mod))
-
-        # Finally remove entries that have been deleted from both places. Why
-        # bother with these suckers?
-        coma = dict([(x,y) for x,y in f1_del.iteritems() if y in f2_del.keys()])
-        f2_del = f2sl.remove_keys_from_del(coma.values())
-        for x in coma.keys():
-            del f1_del[x]
-
-        coma = dict([(x,y) for x,y in f2_del.iteritems() if y in f1_del.keys()])
-        f1_del = f1sl.remove_keys_from_del(coma.values())
-        for x in coma.keys():
-            del f2_del[x]
-
-        logging.info('After conflict resolution, size of %s del : %5d',
-                     db1id, len(f1_del))
-        logging.info('After conflict resolution, size of %s del : %5d',
-                     db2id, len(f2_del))
+        reconcile_2_way(f1sl, f2sl, cr, db1id, db2id)
 
         return f1sl, f2sl
 
+    def _prep_sync_lists (self, f, destid, sl):
+        start = time.time()
+        f.prep_sync_lists(destid, sl)
+        logging.info('Change detection in %s took %.2f seconds',
+                     f.get_dbid(), time.time() - start)
+
+    def _prep_sync_lists_concurrently (self, f1, f2, f1sl, f2sl):
+        """Populate the sync lists of both folders of a two way sync. The
+        folders are scanned at the same time, f2 in a thread of its own, as
+        the scan of a remote folder is mostly spent waiting on the
+        network. Returns when both are done. An exception raised in either
+        scan is raised here. Folders that cannot be worked on from two
+        threads, see can_overlap(), are scanned one after the other."""
+
+        if not self.can_overlap(f1, f2):
+            self._prep_sync_lists(f1, f2.get_dbid(), f1sl)
+            self._prep_sync_lists(f2, f1.get_dbid(), f2sl)
+            return
+
+        err = []
+        def prep_f2 ():
+            try:
+                self._prep_sync_lists(f2, f1.get_dbid(), f2sl)
+            except:
+                err.append(sys.exc_info())
+            finally:
+                f2.get_db().release_session()
+
+        t = threading.Thread(target=prep_f2, name='prep-%s' % f2.get_dbid())
+        t.start()
+        try:
+            self._prep_sync_lists(f1, f2.get_dbid(), f1sl)
+        finally:
+            t.join()
+
+        if err:
+            raise err[0][0], err[0][1], err[0][2]
+
     def _prep_lists_1_way (self, f1, f2):
         logging.debug('_prep_lists_1_way(): ')
         f1sl = SyncLists(f1, self.get_pname())
@@ -317,6 +383,20 @@ class Sync:
 
         conf.set_itemids(prof, items1)
 
+    def save_sync_tokens (self):
+        """Save the high water marks of the changes seen in the two folders
+        during the sync, so the next sync can pick up where this one left
+        off. A folder that was not scanned for changes - the destination of a
+        one way sync - gets no token, and the next sync falls back to the
+        last sync time for it."""
+
+        conf = self.get_config()
+        prof = self.get_pname()
+
+        conf.set_sync_token1(prof, self.get_f1().get_sync_token().get_state(),
+                             sync=False)
+        conf.set_sync_token2(prof, self.get_f2().get_sync_token().get_state())
+
 class SyncLists:
     """Wrapper around lists of items that need to be synched from one place to
     another. Just for convenience."""
@@ -340,44 +420,62 @@ class SyncLists:
         return self.pname
 
     def remove_keys_from_mod (self, k):
-        """Remove all the keys specified in the array k from the passed
-        dictionary and return the new dictionary. This routine is typically
-        used to manipulate one of the self.dictoinaries."""
-
-        d = self.get_mods()
-        d = dict([(x,y) for x,y in d.iteritems() if not x in k])
+        """Remove all the keys specified in the array k from the dictionary
+        of modified entries, and return the dictionary."""
 
-        return self.set_mods(d)
+        return self._remove_keys(self.get_mods(), k)
 
     def remove_values_from_mod (self, v):
-        """Remove all the values specified in the array k from the passed
-        dictionary and return the new dictionary. This routine is typically
-        used to manipulate one of the self.dictoinaries."""
+        """Remove all the entries with values specified in the array v from
+        the dictionary of modified entries, and return the dictionary."""
 
-        d = self.get_mods()
-        d = dict([(x,y) for x,y in d.iteritems() if not y in v])
-
-        return self.set_mods(d)
+        return self._remove_values(self.get_mods(), v)
 
     def remove_keys_from_del (self, k):
-        """Remove all the keys specified in the array k from the passed
-        dictionary and return the new dictionary. This routine is typically
-        used to manipulate one of the self.dictoinaries."""
-
-        d = self.get_dels()
-        d = dict([(x,y) for x,y in d.iteritems() if not x in k])
+        """Remove all the keys specified in the array k from the dictionary
+        of deleted entries, and return the dictionary."""
 
-        return self.set_dels(d)
+        return self._remove_keys(self.get_dels(), k)
 
     def remove_values_from_del (self, v):
-        """Remove all the values specified in the array k from the passed
-        dictionary and return the new dictionary. This routine is typically
-        used to manipulate one of the self.dictoinaries."""
-
-        d = self.get_dels()
-        d = dict([(x,y) for x,y in d.iteritems() if not y in v])
-
-        return self.set_dels(d)
+        """Remove all the entries with values specified in the array v from
+        the dictionary of deleted entries, and return the dictionary."""
+
+        return self._remove_values(self.get_dels(), v)
+
+    def _remove_keys (self, d, k):
+        for x in k:
+            d.pop(x, None)
+
+        return d
+
+    def _remove_values (self, d, v):
+        v = set(v)
+        for x in [x for x,y in d.iteritems() if y in v]:
+            del d[x]
+
+        return d
+
+    def add_dels (self, oldi, curi, is_db1, name):
+        """Record the deleted entries of the source folder. oldi is the
+        mapping of the item ids of the first collection of the profile to
+        those of the second as of the last sync, and curi is the mapping of
+        the ids of the items currently in the source folder to their remote
+        ids. Any pair in oldi neither of whose ids is in curi has been
+        deleted. is_db1 should be True if the source folder is the first
+        collection of the profile. name is the name of the source to be used
+        in log messages."""
+
+        for x, y in oldi.iteritems():
+            ## FIXME: The following could lead to virtually undebuggable
+            ## problem if same item ID is used across two different sources
+            ## and stores. But what are the chances, eh?
+            if not x in curi and not y in curi:
+                logging.debug('Del      %s Contact: %s:%s', name, x, y)
+                if is_db1:
+                    self.add_del(x, y)
+                else:
+                    self.add_del(y, x)
 
     def add_new (self, fid):
         self.news.append(fid)
@@ -441,11 +539,8 @@ class SyncLists:
             logging.info('No new entries that need to be synched')
             return True
 
-        items = self.fold.find_items(self.get_news())
-        res = df.batch_create(self, self.db1id, items)
-        res = res and self.fold.writeback_sync_tags(self.get_pname(), items)
-
-        return res
+        return self._send_in_chunks(df, self.get_news(), df.batch_create,
+                                    writeback=True)
 
     def log_print_stats (self):
         total = (len(self.get_news()) + len(self.get_mods()) +
@@ -474,8 +569,141 @@ class SyncLists:
             logging.info('No modified entries that need to be synched')
             return True
 
-        items = self.fold.find_items(self.get_mods())
-        res = df.batch_update(self, self.db1id, items)
+        return self._send_in_chunks(df, self.get_mods().keys(),
+                                    df.batch_update)
+
+    def _get_chunk_size (self, df):
+        ## Large enough for a full batch on either side
+        return max(self.fold.get_batch_size(), df.get_batch_size())
+
+    def _send_in_chunks (self, df, itemids, push, writeback=False):
+        """Fetch the items with the specified ids from the source folder in
+        chunks, and hand each chunk to push, which should be the batch_create
+        or batch_update of the destination folder df. If writeback is True,
+        the sync tags of each chunk are then written back to the source
+        folder.
+
+        The source folder is worked on in a thread of its own, which fetches
+        the next chunk while the current one is being pushed, so only a few
+        chunks are in memory at any time. All operations on the source
+        folder are done on that one thread, and all on the destination on the
+        calling thread. Returns True if all the chunks were sent
+        successfully.
+
+        A store in Sync.WHOLE_FILE_DBIDS is written out in full on every
+        push and every write back, so it gets exactly one of each per
+        send. If it is the destination, all the items are sent as a single
+        chunk; if it is the source, the sync tags of all the chunks that
+        were pushed are written back together at the end."""
+
+        src   = self.fold
+        pname = self.get_pname()
+        defer = src.get_dbid() in Sync.WHOLE_FILE_DBIDS
+
+        if df.get_dbid() in Sync.WHOLE_FILE_DBIDS:
+            size = len(itemids)
+        else:
+            size = self._get_chunk_size(df)
+        chunks = [itemids[i:i+size] for i in range(0, len(itemids), size)]
+
+        if not Sync.can_overlap(src, df) or len(chunks) < 2 or defer:
+            return self._send_serially(chunks, push, writeback, defer)
+
+        ## fetched holds at most one chunk waiting to be pushed. Chunks that
+        ## were pushed successfully come back on pushed to have their sync
+        ## tags written back, and a None there means we are done.
+        fetched = Queue.Queue(1)
+        pushed  = Queue.Queue()
+        stop    = threading.Event()
+        state   = {'res' : True, 'err' : None}
+
+        def write_back (block):
+            while True:
+                try:
+                    items = pushed.get(block)
+                except Queue.Empty, e:
+                    return
+                if items is None:
+                    return
+                if writeback and not src.writeback_sync_tags(pname, items):
+                    state['res'] = False
+
+        def source ():
+            try:
+                for chunk in chunks:
+                    write_back(False)
+                    if stop.is_set():
+                        return
+                    fetched.put(src.find_items(chunk))
+                fetched.put(None)
+                write_back(True)
+            except:
+                state['err'] = sys.exc_info()
+                stop.set()
+                try:
+                    fetched.put_nowait(None)
+                except Queue.Full, e:
+                    pass
+                ## Items already pushed still need their sync tags
+                try:
+                    write_back(True)
+                except:
+                    logging.debug('Could not write back sync tags',
+                                  exc_info=True)
+            finally:
+                src.get_db().release_session()
+
+        t = threading.Thread(target=source, name='send-%s' % src.get_dbid())
+        t.start()
+
+        try:
+            while not stop.is_set():
+                items = fetched.get()
+                if items is None:
+                    break
+                if push(self, self.db1id, items):
+                    pushed.put(items)
+                else:
+                    state['res'] = False
+        finally:
+            stop.set()
+            pushed.put(None)
+            ## Keep draining in case the source thread is blocked handing us
+            ## a chunk we are no longer going to push
+            while t.is_alive():
+                try:
+                    fetched.get(timeout=0.1)
+                except Queue.Empty, e:
+                    pass
+
+        if state['err']:
+            err = state['err']
+            raise err[0], err[1], err[2]
+
+        return state['res']
+
+    def _send_serially (self, chunks, push, writeback, defer):
+        """The single threaded version of _send_in_chunks(). If defer is
+        True the sync tags of all pushed chunks are written back with one
+        call at the end, even if a later chunk could not be sent."""
+
+        src     = self.fold
+        pname   = self.get_pname()
+        res     = True
+        pending = []
+
+        try:
+            for chunk in chunks:
+                items = src.find_items(chunk)
+                if not push(self, self.db1id, items):
+                    res = False
+                elif defer:
+                    pending.extend(items)
+                elif writeback:
+                    res = src.writeback_sync_tags(pname, items) and res
+        finally:
+            if writeback and pending:
+                res = src.writeback_sync_tags(pname, pending) and res
 
         return res
 
@@ -83,6 +83,16 @@ def touch (fn):
     with open(fn, 'a'):
         os.utime(fn, None)
 
+def replace_file (src, dst):
+    """Move the file src over dst, replacing dst if it already exists. On
+    POSIX systems this is an atomic rename. Windows does not allow renaming
+    over an existing file, so dst has to be removed first."""
+
+    if os.name == 'nt' and os.path.exists(dst):
+        os.remove(dst)
+
+    os.rename(src, dst)
+
 def abs_pathname (config, fname):
     """If fname is an absolute path then it is returned as is. If it starts
     with a ~ then expand the path as per Unix conventions and finally if it
@@ -88,6 +88,17 @@ def setup_parser ():
                    help=('For profile operations, specifies profile name. '
                          'For Folder operations, specifies folder name'))
 
+    p.add_argument('--profiles', action='store', nargs='+',
+                   help=('For --op=sync, specifies the names of more than '
+                         'one profile to sync in one go. Profiles that do '
+                         'not share a store are synched in parallel. '
+                         '"all" syncs every profile other than the samples.'))
+
+    p.add_argument('--workers', action='store', type=int,
+                   help=('The maximum number of profiles to sync in parallel '
+                         'with --profiles. Defaults to the sync_workers '
+                         'setting in config.json'))
+
     p.add_argument('--direction', action='store', default=None,
                    choices=('1way', '2way'),
                    help='Specifies whether a sync has to be unidirectional '
@@ -235,6 +246,32 @@ class AsynkBuilderC:
         else:
             self.asynk.set_name(None)
 
+    def _snarf_profiles (self, uinps):
+        if not uinps.profiles:
+            return
+
+        if self.asynk.get_op() != 'op_sync':
+            raise AsynkParserError('--profiles is only valid with --op=sync')
+
+        if uinps.name or uinps.db or uinps.store or uinps.folder:
+            raise AsynkParserError('--profiles cannot be combined with '
+                                   '--name, --db, --store or --folder')
+
+        if uinps.gcuser or uinps.gcpwd or uinps.cduser or uinps.cdpwd:
+            raise AsynkParserError('--profiles cannot be combined with '
+                                   'credentials on the command line. Use '
+                                   'netrc instead.')
+
+        if 'all' in uinps.profiles and len(uinps.profiles) > 1:
+            raise AsynkParserError('--profiles all cannot be combined with '
+                                   'other profile names')
+
+        if uinps.workers is not None and uinps.workers < 1:
+            raise AsynkParserError('--workers should be at least 1')
+
+        self.asynk.set_pnames(uinps.profiles)
+        self.asynk.set_sync_workers(uinps.workers)
+
     def _snarf_folder_ids (self, uinps):
         if uinps.folder:
             for i, fid in enumerate(uinps.folder):
@@ -259,6 +296,7 @@ class AsynkBuilderC:
         self.asynk.set_op(op)
 
         self._snarf_pname(uinps)
+        self._snarf_profiles(uinps)
 
         # Let's start with the db flags
         if uinps.db:
@@ -293,6 +331,10 @@ class AsynkBuilderC:
         self.asynk.set_conflict_resolve(uinps.conflict_resolve)
         self.asynk.set_item_id(uinps.item)
 
+        if self.asynk.get_pnames():
+            ## Each profile gets its credentials when it is loaded
+            return
+
         if not self.asynk.get_op() in ['op_list_profiles',
                                        'op_list_profile_names']:
             self._snarf_auth_creds(uinps)
@@ -0,0 +1,183 @@
+##
+## Created : Sun Oct 18 10:02:17 IST 2026
+##
+## Copyright (C) 2026 Sriram Karra <karra.etc@gmail.com>
+##
+## This file is part of ASynK
+##
+## ASynK is free software: you can redistribute it and/or modify it under
+## the terms of the GNU Affero GPL (GNU AGPL) as published by the
+## Free Software Foundation, version 3 of the License
+##
+## ASynK is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+## License for more details.
+##
+## You should have a copy of the license in the doc/ directory of ASynK.  If
+## not, see <http://www.gnu.org/licenses/>.
+##
+## Some rough benchmarks for the BBDB backend. A synthetic BBDB file with
+## the specified number of records is generated in a scratch user directory
+## and the various parsing strategies are timed against it. Usage:
+##
+## python bench_bb.py [num_records] [file_format]
+
+import logging, os, shutil, sys, time
+
+## Being able to fix the sys.path thusly makes is easy to execute this
+## script standalone from IDLE. Hack it is, but what the hell.
+CUR_DIR        = os.path.abspath(os.path.dirname(__file__))
+ASYNK_BASE_DIR = os.path.abspath(os.path.join(CUR_DIR, '..'))
+EXTRA_PATHS = [os.path.join(ASYNK_BASE_DIR, 'lib'),
+               os.path.join(ASYNK_BASE_DIR, 'asynk'),]
+sys.path = EXTRA_PATHS + sys.path
+
+from state         import Config
+from pimdb_bb      import BBPIMDB
+import parser_bb
+
+user_dir = os.path.join(CUR_DIR, 'user_dir')
+
+def gen_rec (i, ver):
+    names = '"First%05d" "Last%05d"' % (i, i)
+    affix = ' nil' if ver != '6' else ''
+    phones = ('(["Mobile" "+91 90084 %05d"] ["Work" 0 0 0 %d] '
+              '["Home" "+1 415 555 %04d"])' % (i, i, i % 10000))
+    addrs = ('(["Home" ("%d Some Street" "Apt %d") "Chennai" "TN" "600%03d" '
+             '"India"] ["Work" nil "San Francisco" "CA" "94107" "USA"])'
+             % (i, i, i % 1000))
+    emails = '("first%05d@gmail.com" "last%05d@work.example.com")' % (i, i)
+    notes = ('((bbdb-id . "bench-%08d") (notes . "Some \\"quoted\\" note\\n'
+             'on two lines") (asynk:bbgc:gc . "http://example.com/%d") '
+             '(im-jabber . "first%05d@jabber.org") (Web-00-Home . '
+             '"http://www.example.com/~%d")' % (i, i, i, i))
+    if ver == '9':
+        notes += ') "bench-%08d" "2013-12-06 14:33:49 +0000" ' \
+                 '"2013-12-20 17:56:49 +0000"' % i
+    else:
+        notes += ' (creation-date . "2013-12-06 14:33:49 +0000") ' \
+                 '(timestamp . "2013-12-20 17:56:49 +0000"))'
+    company = '"ACME Corp"' if ver == '6' else '("ACME Corp" "Widgets Inc")'
+
+    return ('[%s%s ("Nick%d") %s %s %s %s %s nil]'
+            % (names, affix, i, company, phones, addrs, emails, notes))
+
+def gen_file (fn, cnt, ver):
+    with open(fn, 'w') as bbf:
+        bbf.write(';; -*-coding: utf-8-emacs;-*-\n')
+        bbf.write(';;; file-format: %s\n' % ver)
+        for i in range(cnt):
+            bbf.write(gen_rec(i, ver) + '\n')
+
+def setup_config ():
+    if os.path.exists(user_dir):
+        shutil.rmtree(user_dir)
+    os.makedirs(user_dir)
+
+    shutil.copyfile(os.path.join(ASYNK_BASE_DIR, 'state.init.json'),
+                    os.path.join(user_dir, 'state.json'))
+
+    return Config(asynk_base_dir=ASYNK_BASE_DIR, user_dir=user_dir)
+
+def timeit (label, fn, *args, **kwargs):
+    start = time.time()
+    ret = fn(*args, **kwargs)
+    logging.info('%-40s: %8.3f s', label, time.time() - start)
+    return ret
+
+def bench_rec_parsers (config, fn, ver):
+    """Time only the record parsing step with each of the parsers."""
+
+    bb = BBPIMDB(config, fn)
+    regexes = bb.get_regexes(ver)
+    con_re  = regexes['con_re']
+    fields  = regexes['con_fields']
+
+    with open(fn) as bbf:
+        recs = [x.strip() for x in bbf if x[0] == '[']
+
+    def regex_parse ():
+        import re
+        return [re.search(con_re, rec).groupdict() for rec in recs]
+
+    def sexp_parse ():
+        return [parser_bb.parse_rec(rec, fields) for rec in recs]
+
+    r = timeit('regex record parse (%d records)' % len(recs), regex_parse)
+    s = timeit('sexp  record parse (%d records)' % len(recs), sexp_parse)
+
+    for x, y in zip(r, s):
+        for f in fields:
+            assert x[f] == y[f], 'Mismatch in field %s: %s vs. %s' % (
+                f, x[f], y[f])
+
+def bench_populate (config, fn):
+    """Time the full parse of the BBDB file into folders and contacts with
+    each of the parsers."""
+
+    dbc = config.get_db_config('bb')
+    for parser in ['regex', 'sexp']:
+        dbc['record_parser'] = parser
+        timeit('BBPIMDB with %s parser' % parser, BBPIMDB, config, fn)
+
+def bench_lazy (config, fn):
+    """Time indexing the BBDB file as a lazy store, and materializing a
+    handful of records from it."""
+
+    dbc = config.get_db_config('bb')
+    dbc['lazy_store'] = True
+    bb = timeit('BBPIMDB with lazy store', BBPIMDB, config, fn)
+    dbc['lazy_store'] = False
+
+    f = bb.get_def_folder()
+    iids = f.get_contacts(materialize=False).keys()[:20]
+    timeit('Materialize %d records' % len(iids), f.find_items, iids)
+
+def bench_save (config, fn):
+    """Time saving the BBDB file after modifying a handful of records,
+    against saving it after modifying every record."""
+
+    bb = BBPIMDB(config, fn)
+    f  = bb.get_def_folder()
+    cons = f.get_contacts().values()
+
+    for con in cons[:20]:
+        con.set_nickname('Bench')
+    timeit('Save with %d modified records' % 20, f.save)
+
+    for con in cons:
+        con.dirty(True)
+    timeit('Save with %d modified records' % len(cons), f.save)
+
+def bench_parallel (config, fn):
+    """Time the full parse of the BBDB file with pools of worker processes
+    of various sizes."""
+
+    import multiprocessing
+
+    dbc = config.get_db_config('bb')
+    procs = 1
+    while procs <= multiprocessing.cpu_count():
+        dbc['parse_processes'] = procs
+        timeit('BBPIMDB with %d parse processes' % procs, BBPIMDB, config, fn)
+        procs *= 2
+    dbc['parse_processes'] = 1
+
+def main (argv=None):
+    cnt = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    ver = sys.argv[2] if len(sys.argv) > 2 else '7'
+
+    config = setup_config()
+    fn = os.path.join(user_dir, 'bench.bbdb')
+    timeit('Generating %d v%s records' % (cnt, ver), gen_file, fn, cnt, ver)
+
+    bench_rec_parsers(config, fn, ver)
+    bench_populate(config, fn)
+    bench_lazy(config, fn)
+    bench_save(config, fn)
+    bench_parallel(config, fn)
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    main()
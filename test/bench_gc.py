@@ -0,0 +1,200 @@
+##
+## Created : Sun Oct 18 19:12:08 IST 2026
+##
+## Copyright (C) 2026 Sriram Karra <karra.etc@gmail.com>
+##
+## This file is part of ASynK
+##
+## ASynK is free software: you can redistribute it and/or modify it under
+## the terms of the GNU Affero GPL (GNU AGPL) as published by the
+## Free Software Foundation, version 3 of the License
+##
+## ASynK is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+## License for more details.
+##
+## You should have a copy of the license in the doc/ directory of ASynK.  If
+## not, see <http://www.gnu.org/licenses/>.
+##
+## Throughput benchmark and regression run of the Google Contacts backend
+## against the offline stand-in server in fake_gc.py. The server is started
+## in process with the specified number of contacts and latency per
+## request, and the listing, batch query, change detection and batch delete
+## code paths of GCContactsFolder are timed and checked against it, with
+## each of the atom codecs. The conversion between Atom entries and
+## GCContacts is also timed by itself, without the server, with gdata's
+## object model and with the lean reader and writer of parser_gc, and the
+## two are checked to agree. Usage:
+##
+## python bench_gc.py [num_contacts] [latency_secs]
+
+import logging, os, shutil, StringIO, sys, time
+
+## Being able to fix the sys.path thusly makes is easy to execute this
+## script standalone from IDLE. Hack it is, but what the hell.
+CUR_DIR        = os.path.abspath(os.path.dirname(__file__))
+ASYNK_BASE_DIR = os.path.abspath(os.path.join(CUR_DIR, '..'))
+EXTRA_PATHS = [os.path.join(ASYNK_BASE_DIR, 'lib'),
+               os.path.join(ASYNK_BASE_DIR, 'asynk'),]
+sys.path = EXTRA_PATHS + sys.path
+
+from state         import Config
+from pimdb_gc      import GCPIMDB
+from contact_gc    import GCContact
+import atom.core, gdata.contacts.data
+import fake_gc, parser_gc
+
+user_dir = os.path.join(CUR_DIR, 'user_dir')
+
+def setup_config (url):
+    if os.path.exists(user_dir):
+        shutil.rmtree(user_dir)
+    os.makedirs(user_dir)
+
+    shutil.copyfile(os.path.join(ASYNK_BASE_DIR, 'state.init.json'),
+                    os.path.join(user_dir, 'state.json'))
+
+    config = Config(asynk_base_dir=ASYNK_BASE_DIR, user_dir=user_dir)
+    config.get_db_config('gc')['server_url'] = url
+
+    return config
+
+def timeit (label, fn, *args, **kwargs):
+    start = time.time()
+    ret = fn(*args, **kwargs)
+    logging.info('%-40s: %8.3f s', label, time.time() - start)
+    return ret
+
+def norm (gcids):
+    return sorted([GCContact.normalize_gcid(x) for x in gcids])
+
+def bench_list (f, store):
+    ids = timeit('Read group feed', lambda: [x.id.text for x in
+                                             f._iter_group_feed()])
+    assert norm(ids) == norm(store.get_contact_ids())
+
+    return ids
+
+def bench_query (f, ids):
+    success, ces = timeit('Batch query %d contacts' % len(ids),
+                          f._fetch_gc_entries, ids)
+    assert success and norm([x.id.text for x in ces]) == norm(ids)
+
+def bench_changes (f, store, ids):
+    """Modify and delete a few contacts behind our back, and check they are
+    the only ones in an updated-min feed, with the deleted ones marked as
+    such."""
+
+    since = fake_gc.timestamp(time.time())
+    time.sleep(0.01)
+
+    mods = ids[:5]
+    dels = ids[5:8]
+    for gcid in mods:
+        store.modify_contact(gcid, 'Modified')
+    for gcid in dels:
+        store.delete_contact(gcid)
+
+    entries = timeit('Read changes with updated-min',
+                     lambda: list(f._iter_group_feed(showdeleted='true',
+                                                     updated_min=since)))
+    assert norm([x.id.text for x in entries]) == norm(mods + dels)
+    assert norm([x.id.text for x in entries if x.deleted]) == norm(dels)
+
+    ## The etags noted in the first listing are stale for the modified
+    ## entries, and deleting them needs the fresh ones.
+    success, failed = f.del_itemids(mods)
+    assert success and not failed
+
+    return [x for x in ids if not x in mods + dels]
+
+def bench_interrupted (server, f, ids):
+    server.interrupt_after = 3
+    try:
+        success, ces = f._fetch_gc_entries(ids[:10])
+    finally:
+        server.interrupt_after = None
+
+    assert not success and len(ces) == 3
+
+def bench_delete (f, store, cnt):
+    success = timeit('Delete all %d contacts' % cnt, f.del_all_entries)
+    assert success and not store.get_contact_ids()
+
+def props (con):
+    ## created is made up from the current time if it is not in the entry
+    return dict([(x, y) for x, y in con.props.iteritems()
+                 if not x in ['created', 'updated']])
+
+def bench_codecs (gc, f, store):
+    """Time reading a page of the contacts feed into GCContacts, and writing
+    them out into a batch feed, with each of the codecs."""
+
+    xml  = fake_gc.ET.tostring(store.contacts_feed({'max-results' : 10**6}),
+                               encoding='UTF-8')
+    cons = {}
+
+    for codec in ['gdata', 'lean']:
+        gc.set_atom_codec(codec)
+
+        def read ():
+            if codec == 'gdata':
+                feed = atom.core.parse(xml, gdata.contacts.data.ContactsFeed)
+            else:
+                feed = parser_gc.stream_feed(StringIO.StringIO(xml))
+            return [GCContact(f, gce=x) for x in feed.entry]
+
+        def write ():
+            feed = gc.new_feed()
+            for i, con in enumerate(cons[codec]):
+                feed.add_update(entry=con.init_gce_from_props(),
+                                batch_id_string=str(i))
+            return str(feed)
+
+        cons[codec] = timeit('Read %d KB of entries with %s' % (
+            len(xml) / 1024, codec), read)
+        timeit('Write %d entries with %s' % (len(cons[codec]), codec), write)
+
+    for x, y in zip(cons['gdata'], cons['lean']):
+        assert props(x) == props(y), 'Mismatch: %s vs. %s' % (x, y)
+
+    gc.set_atom_codec(gc.get_config().get_db_config('gc').get('atom_codec',
+                                                              'lean'))
+
+def main (argv=None):
+    cnt     = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+
+    server = fake_gc.FakeGCServer(latency=latency)
+    store  = server.get_store()
+    fake_gc.populate(store, cnt, rich=True)
+    url = server.start()
+
+    try:
+        config = setup_config(url)
+        gc = GCPIMDB(config, store.get_user(), None)
+        f  = gc.get_def_folder()
+
+        bench_codecs(gc, f, store)
+
+        for codec in ['gdata', 'lean']:
+            logging.info('With the %s atom codec:', codec)
+            gc.set_atom_codec(codec)
+            if not store.get_contact_ids():
+                fake_gc.populate(store, cnt, rich=True)
+
+            ids = bench_list(f, store)
+            bench_query(f, ids)
+            ids = bench_changes(f, store, ids)
+            bench_interrupted(server, f, ids)
+            bench_delete(f, store, len(ids))
+
+        gc.log_stats()
+        logging.info('Server stats: %s', server.get_stats())
+    finally:
+        server.stop()
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    main()
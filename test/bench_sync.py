@@ -0,0 +1,244 @@
+##
+## Created : Sun Oct 18 14:20:05 IST 2026
+##
+## Copyright (C) 2026 Sriram Karra <karra.etc@gmail.com>
+##
+## This file is part of ASynK
+##
+## ASynK is free software: you can redistribute it and/or modify it under
+## the terms of the GNU Affero GPL (GNU AGPL) as published by the
+## Free Software Foundation, version 3 of the License
+##
+## ASynK is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+## License for more details.
+##
+## You should have a copy of the license in the doc/ directory of ASynK.  If
+## not, see <http://www.gnu.org/licenses/>.
+##
+## Scaling benchmark for the reconciliation of the sync lists of a two way
+## sync. Synthetic sync lists for profiles of various sizes are run through
+## the delete detection of prep_sync_lists and through reconcile_2_way, and
+## the same is done with the implementation these replaced, for comparison
+## and to verify both produce the same lists. The old implementation is
+## quadratic, so it is only run for the smaller sizes. Usage:
+##
+## python bench_sync.py [max_old_size] [size1 size2 ...]
+
+import logging, os, random, sys, time
+
+## Being able to fix the sys.path thusly makes is easy to execute this
+## script standalone from IDLE. Hack it is, but what the hell.
+CUR_DIR        = os.path.abspath(os.path.dirname(__file__))
+ASYNK_BASE_DIR = os.path.abspath(os.path.join(CUR_DIR, '..'))
+EXTRA_PATHS = [os.path.join(ASYNK_BASE_DIR, 'lib'),
+               os.path.join(ASYNK_BASE_DIR, 'asynk'),]
+sys.path = EXTRA_PATHS + sys.path
+
+from sync import Sync, SyncLists, reconcile_2_way
+
+class BenchFolder:
+    """All that SyncLists needs of its source folder."""
+
+    def __init__ (self, dbid):
+        self.dbid = dbid
+
+    def get_dbid (self):
+        return self.dbid
+
+class LatentFolder(BenchFolder):
+    """A folder that takes delay seconds for every batch of items it
+    fetches, stores or writes back, and keeps track of what it is sent."""
+
+    def __init__ (self, dbid, delay):
+        BenchFolder.__init__(self, dbid)
+        self.delay   = delay
+        self.created = []
+        self.tagged  = []
+
+    def get_db (self):
+        return self
+
+    def release_session (self):
+        pass
+
+    def get_batch_size (self):
+        return 100
+
+    def find_items (self, itemids):
+        time.sleep(self.delay)
+        return list(itemids)
+
+    def batch_create (self, src_sl, src_dbid, items):
+        time.sleep(self.delay)
+        self.created.extend(items)
+        return True
+
+    def writeback_sync_tags (self, pname, items):
+        time.sleep(self.delay / 4)
+        self.tagged.extend(items)
+        return True
+
+##
+## The implementation prior to reconcile_2_way, and the delete detection
+## loop of the folders' prep_sync_lists.
+##
+
+def old_dels (sl, oldi, curi, is_db1):
+    kss = curi.keys()
+    for x, y in oldi.iteritems():
+        if not x in kss and not y in kss:
+            if is_db1:
+                sl.add_del(x, y)
+            else:
+                sl.add_del(y,x)
+
+def old_remove_keys (d, k):
+    return dict([(x,y) for x,y in d.iteritems() if not x in k])
+
+def old_remove_values (d, v):
+    return dict([(x,y) for x,y in d.iteritems() if not y in v])
+
+def old_reconcile (f1sl, f2sl, cr, db1id, db2id):
+    f1_mod = f1sl.get_mods()
+    f2_mod = f2sl.get_mods()
+
+    coma = [id1 for id1,id2 in f1_mod.iteritems() if id2 in f2_mod.keys()]
+
+    if cr == db2id or cr == "2":
+        f1_mod = f1sl.set_mods(old_remove_keys(f1_mod, coma))
+    elif cr == db1id or cr == "1":
+        f2_mod = f2sl.set_mods(old_remove_values(f2_mod, coma))
+
+    f1_del = f1sl.get_dels()
+    f2_del = f2sl.get_dels()
+
+    coma = [y for x,y in f1_del.iteritems() if y in f2_mod.keys()]
+    f2_mod = f2sl.set_mods(old_remove_keys(f2_mod, coma))
+
+    coma = [y for x,y in f2_del.iteritems() if y in f1_mod.keys()]
+    f1_mod = f1sl.set_mods(old_remove_keys(f1_mod, coma))
+
+    coma = dict([(x,y) for x,y in f1_del.iteritems() if y in f2_del.keys()])
+    f2_del = f2sl.set_dels(old_remove_keys(f2_del, coma.values()))
+    for x in coma.keys():
+        del f1_del[x]
+
+    coma = dict([(x,y) for x,y in f2_del.iteritems() if y in f1_del.keys()])
+    f1_del = f1sl.set_dels(old_remove_keys(f1_del, coma.values()))
+    for x in coma.keys():
+        del f2_del[x]
+
+##
+## The benchmark proper
+##
+
+def gen_profile (n, seed=0):
+    """Generate the state of a profile with n synched item pairs, as seen by
+    the two folders at the start of the next sync: the itemid map of the
+    profile from the last sync, and each folder's current map of local to
+    remote ids and modified entries. About 7% of the items are modified on
+    each side, a third of them on both sides, and 3% deleted on each side,
+    a third of them on both sides."""
+
+    rnd  = random.Random(seed)
+    oldi = dict([('ol%08d' % i, 'gc%08d' % i) for i in xrange(n)])
+    cur1 = dict(oldi)
+    cur2 = dict([(y, x) for x, y in oldi.iteritems()])
+    mod1 = {}
+    mod2 = {}
+
+    for x, y in oldi.iteritems():
+        r = rnd.random()
+        if r < 0.02:
+            del cur1[x]
+        elif r < 0.04:
+            del cur2[y]
+        elif r < 0.05:
+            del cur1[x]
+            del cur2[y]
+        elif r < 0.10:
+            mod1[x] = y
+        elif r < 0.15:
+            mod2[y] = x
+        elif r < 0.17:
+            mod1[x] = y
+            mod2[y] = x
+
+    ## Modified entries that were deleted on the other side
+    for x, y in mod1.items():
+        if y not in cur2 and rnd.random() < 0.5:
+            del mod1[x]
+
+    return oldi, cur1, cur2, mod1, mod2
+
+def make_lists (prof, dels_fn):
+    oldi, cur1, cur2, mod1, mod2 = prof
+    f1sl = SyncLists(BenchFolder('ol'), 'bench')
+    f2sl = SyncLists(BenchFolder('gc'), 'bench')
+
+    f1sl.set_mods(dict([(x, y) for x, y in mod1.iteritems() if x in cur1]))
+    f2sl.set_mods(dict([(x, y) for x, y in mod2.iteritems() if x in cur2]))
+
+    start = time.time()
+    dels_fn(f1sl, oldi, cur1, True)
+    dels_fn(f2sl, oldi, cur2, False)
+
+    return f1sl, f2sl, time.time() - start
+
+def new_dels (sl, oldi, curi, is_db1):
+    sl.add_dels(oldi, curi, is_db1, 'Bench')
+
+def run (n, with_old):
+    prof = gen_profile(n)
+    res  = []
+
+    impls = [('new', new_dels, reconcile_2_way)]
+    if with_old:
+        impls.append(('old', old_dels, old_reconcile))
+
+    for name, dels_fn, rec_fn in impls:
+        f1sl, f2sl, t_dels = make_lists(prof, dels_fn)
+
+        start = time.time()
+        rec_fn(f1sl, f2sl, 'ol', 'ol', 'gc')
+        t_rec = time.time() - start
+
+        print '%8d items  %s: deletes %8.3f s  reconcile %8.3f s' % (
+            n, name, t_dels, t_rec)
+        res.append((f1sl.get_mods(), f2sl.get_mods(),
+                    f1sl.get_dels(), f2sl.get_dels()))
+
+    if with_old:
+        assert res[0] == res[1], 'Old and new implementations disagree'
+
+def run_pipeline (n, delay=0.02):
+    for dbid in ['ol', 'cd']:
+        src = LatentFolder(dbid, delay)
+        dst = LatentFolder('gc', delay)
+        sl  = SyncLists(src, 'bench')
+        for i in xrange(n):
+            sl.add_new('id%06d' % i)
+
+        start = time.time()
+        res   = sl.send_news_to_folder(dst)
+        mode  = 'serial' if dbid in Sync.THREAD_BOUND_DBIDS else 'pipelined'
+        print '%8d items  send %-9s: %8.3f s' % (n, mode, time.time() - start)
+
+        assert res and dst.created == sl.get_news() == src.tagged
+
+def main (argv=None):
+    max_old = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    sizes   = [int(x) for x in sys.argv[2:]]
+    if not sizes:
+        sizes = [10000, 20000, 50000, 100000, 500000]
+
+    for n in sizes:
+        run(n, n <= max_old)
+
+    run_pipeline(5000)
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.WARNING)
+    main()
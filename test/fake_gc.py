@@ -0,0 +1,692 @@
+##
+## Created : Sun Oct 18 18:05:31 IST 2026
+##
+## Copyright (C) 2026 Sriram Karra <karra.etc@gmail.com>
+##
+## This file is part of ASynK
+##
+## ASynK is free software: you can redistribute it and/or modify it under
+## the terms of the GNU Affero GPL (GNU AGPL) as published by the
+## Free Software Foundation, version 3 of the License
+##
+## ASynK is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+## License for more details.
+##
+## You should have a copy of the license in the doc/ directory of ASynK.  If
+## not, see <http://www.gnu.org/licenses/>.
+##
+## An offline stand-in for the Google Contacts API, to exercise the gc
+## backend without a Google account. It speaks the subset of the Atom and
+## batch protocols ASynK uses: the groups feed, paged contacts feeds with the
+## group, updated-min, showdeleted, max-results and start-index parameters,
+## single entries, and batch feeds of inserts, queries, updates and
+## deletes. Every entry carries an etag, and updates and deletes with a stale
+## etag fail with a 412 just as they do at Google. Deleted contacts are
+## remembered as tombstones for showdeleted feeds.
+##
+## Latency can be added to every request, and a batch can be made to be
+## interrupted after a given number of entries. A batch is also interrupted,
+## as Google does, at the first entry with a malformed birthday.
+##
+## Point ASynK at it by setting 'server_url' in the gc section of the
+## db_config to the url printed on startup. Usage:
+##
+## python fake_gc.py [--port port] [--contacts cnt] [--latency secs]
+##                   [--interrupt-after cnt]
+
+import BaseHTTPServer, SocketServer, copy, getopt, logging, os, re, sys
+import threading, time, urllib, urlparse
+import xml.etree.ElementTree as ET
+
+## Being able to fix the sys.path thusly makes is easy to execute this
+## script standalone from IDLE. Hack it is, but what the hell.
+CUR_DIR        = os.path.abspath(os.path.dirname(__file__))
+ASYNK_BASE_DIR = os.path.abspath(os.path.join(CUR_DIR, '..'))
+EXTRA_PATHS = [os.path.join(ASYNK_BASE_DIR, 'lib'),
+               os.path.join(ASYNK_BASE_DIR, 'asynk'),]
+sys.path = EXTRA_PATHS + sys.path
+
+import iso8601
+
+NS = {'atom'       : 'http://www.w3.org/2005/Atom',
+      'gd'         : 'http://schemas.google.com/g/2005',
+      'gContact'   : 'http://schemas.google.com/contact/2008',
+      'batch'      : 'http://schemas.google.com/gdata/batch',
+      'openSearch' : 'http://a9.com/-/spec/opensearch/1.1/',}
+
+for prefix, uri in NS.iteritems():
+    ET.register_namespace('' if prefix == 'atom' else prefix, uri)
+
+def Q (prefix, name):
+    return '{%s}%s' % (NS[prefix], name)
+
+ETAG     = Q('gd', 'etag')
+BIRTHDAY = Q('gContact', 'birthday')
+MEMBER   = Q('gContact', 'groupMembershipInfo')
+
+## Entry elements the server sets, and does not take from the client
+SERVER_TAGS = [Q('atom', 'id'), Q('atom', 'updated'), Q('atom', 'link'),
+               Q('gd', 'deleted'), Q('batch', 'id'), Q('batch', 'operation'),
+               Q('batch', 'status'), Q('batch', 'interrupted')]
+
+## Google accepts birthdays with or without the year only
+BIRTHDAY_RE = re.compile(r'^(\d{4}|-)-\d\d-\d\d$')
+
+ATOM_TYPE = 'application/atom+xml; charset=UTF-8'
+
+def entry_key (eid):
+    """Return the key of a contact or group from any of the forms of its
+    id or edit link - base or full projection, http or https."""
+
+    return eid.rstrip('/').split('/')[-1] if eid else None
+
+def parse_time (s):
+    """Return the ISO-8601 time s in seconds since the epoch. Unlike
+    iso8601.parse() this keeps the fractions of a second."""
+
+    frac = re.search(r'T\d\d:\d\d:\d\d[.,](\d+)', s)
+    return iso8601.parse(s) + (float('0.' + frac.group(1)) if frac else 0)
+
+def timestamp (t):
+    return '%s.%03dZ' % (time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(t)),
+                         int((t % 1) * 1000))
+
+class FakeGCError(Exception):
+    def __init__ (self, code, reason):
+        Exception.__init__(self, '%d %s' % (code, reason))
+        self.code   = code
+        self.reason = reason
+
+class FakeGCStore:
+    """The contacts and groups of the single user of a FakeGCServer. All the
+    methods are safe to call from any thread."""
+
+    def __init__ (self, user='asynk.test@example.com'):
+        self.user   = user
+        self.url    = 'http://localhost'
+        self.lock   = threading.RLock()
+        self.seq    = 0
+        self.last   = 0
+        self.groups = {}
+        self.cons   = {}
+
+        self.add_group('System Group: My Contacts', system='Contacts')
+
+    def set_url (self, url):
+        self.url = url
+
+    def get_user (self):
+        return self.user
+
+    def _next (self):
+        """Return a fresh key, and a fresh updated time that is later than
+        all the ones handed out so far."""
+
+        self.seq += 1
+        self.last = max(time.time(), self.last + 0.001)
+        return '%x' % (0x1000 + self.seq), self.last
+
+    def _touch (self, rec):
+        key, rec['updated'] = self._next()
+        rec['etag'] = '"%s-%s"' % (rec['key'], key)
+
+    def _feed_url (self, kind, proj='full'):
+        return '%s/m8/feeds/%s/%s/%s' % (self.url, kind,
+                                         urllib.quote(self.user), proj)
+
+    ##
+    ## Groups
+    ##
+
+    def add_group (self, title, system=None):
+        """Add a group, and return its id."""
+
+        with self.lock:
+            key, t = self._next()
+            node = ET.Element(Q('atom', 'entry'))
+            ET.SubElement(node, Q('atom', 'title')).text = title
+            if system:
+                ET.SubElement(node, Q('gContact', 'systemGroup'), id=system)
+
+            rec = {'key' : key, 'node' : node, 'system' : system}
+            self._touch(rec)
+            self.groups[key] = rec
+
+            return self.group_id(key)
+
+    def group_id (self, key):
+        return '%s/%s' % (self._feed_url('groups', 'base'), key)
+
+    def get_def_group (self):
+        for key, rec in self.groups.iteritems():
+            if rec['system'] == 'Contacts':
+                return self.group_id(key)
+
+    def group_entry (self, rec):
+        return self._entry_out(rec, 'groups')
+
+    def groups_feed (self):
+        with self.lock:
+            recs = sorted(self.groups.values(), key=lambda x: x['updated'])
+            return self._feed('groups', [self.group_entry(x) for x in recs],
+                              len(recs), 1, len(recs))
+
+    def create_group (self, node):
+        with self.lock:
+            title = node.findtext(Q('atom', 'title'))
+            key = entry_key(self.add_group(title))
+            return self.group_entry(self.groups[key])
+
+    def delete_group (self, key):
+        with self.lock:
+            rec = self.groups.get(key)
+            if rec is None:
+                raise FakeGCError(404, 'Group not found')
+            if rec['system']:
+                raise FakeGCError(403, 'Cannot delete a system group')
+
+            del self.groups[key]
+
+    ##
+    ## Contacts
+    ##
+
+    def add_contact (self, name, email=None, gid=None, extra=None):
+        """Add a contact with the specified name to the group gid, which
+        defaults to My Contacts, and return its id. extra is a list of any
+        other elements of the entry."""
+
+        node = ET.Element(Q('atom', 'entry'))
+        gname = ET.SubElement(node, Q('gd', 'name'))
+        ET.SubElement(gname, Q('gd', 'fullName')).text = name
+        if email:
+            ET.SubElement(node, Q('gd', 'email'), address=email,
+                          rel=NS['gd'] + '#home')
+        ET.SubElement(node, MEMBER, href=gid or self.get_def_group())
+        node.extend(extra or [])
+
+        with self.lock:
+            return self._insert(node)['id']
+
+    def modify_contact (self, cid, name):
+        """Change the name of the contact, as if it were edited elsewhere.
+        Returns its new etag."""
+
+        with self.lock:
+            rec = self._find(cid)
+            rec['node'].find(Q('gd', 'name')).find(
+                Q('gd', 'fullName')).text = name
+            self._touch(rec)
+
+            return rec['etag']
+
+    def delete_contact (self, cid):
+        """Delete the contact, as if it were deleted elsewhere."""
+
+        with self.lock:
+            self._delete(self._find(cid))
+
+    def get_contact_ids (self, deleted=False):
+        with self.lock:
+            return [x['id'] for x in self.cons.values()
+                    if deleted or not x['deleted']]
+
+    def get_contact (self, cid):
+        with self.lock:
+            return self._entry_out(self._find(cid), 'contacts')
+
+    def contacts_feed (self, params):
+        """Return the contacts feed for the query in the dictionary params,
+        with the parameter names as in the url."""
+
+        start = int(params.get('start-index', 1))
+        size  = int(params.get('max-results', 25))
+        dels  = params.get('showdeleted', 'false') == 'true'
+        group = entry_key(params.get('group'))
+        since = params.get('updated-min')
+        since = parse_time(since) if since else None
+
+        with self.lock:
+            recs = [x for x in self.cons.values()
+                    if (dels or not x['deleted']) and
+                    (since is None or x['updated'] >= since) and
+                    (group is None or group in x['groups'])]
+            recs.sort(key=lambda x: x['updated'])
+
+            page  = recs[start-1:start-1+size]
+            nodes = [self._entry_out(x, 'contacts') for x in page]
+
+            return self._feed('contacts', nodes, len(recs), start, size,
+                              params)
+
+    def _find (self, cid):
+        rec = self.cons.get(entry_key(cid))
+        if rec is None or rec['deleted']:
+            raise FakeGCError(404, 'Contact not found')
+
+        return rec
+
+    def _check_etag (self, rec, etag):
+        if etag and etag != '*' and etag != rec['etag']:
+            raise FakeGCError(412, 'Etags mismatch')
+
+    def _insert (self, node):
+        node = self._entry_in(node)
+        key, t = self._next()
+        rec = {'key' : key, 'deleted' : False}
+        rec['id'] = '%s/%s' % (self._feed_url('contacts', 'base'), key)
+        self._set_node(rec, node)
+        self.cons[key] = rec
+
+        return rec
+
+    def _update (self, rec, node, etag):
+        self._check_etag(rec, etag)
+        self._set_node(rec, self._entry_in(node))
+
+    def _delete (self, rec, etag=None):
+        self._check_etag(rec, etag)
+        rec['deleted'] = True
+        rec['node']    = ET.Element(Q('atom', 'entry'))
+        self._touch(rec)
+
+    def _set_node (self, rec, node):
+        self._check_entry(node)
+        rec['node']   = node
+        rec['groups'] = set([entry_key(x.get('href'))
+                             for x in node.findall(MEMBER)])
+        self._touch(rec)
+
+    def _check_entry (self, node):
+        """Raise a FakeGCError if Google would refuse the entry."""
+
+        bday = node.find(BIRTHDAY)
+        if bday is not None and not BIRTHDAY_RE.match(bday.get('when', '')):
+            raise FakeGCError(400, "Invalid value for attribute : 'when'")
+
+    def _entry_in (self, node):
+        """Return a copy of the entry the client sent without the elements
+        the server maintains."""
+
+        node = copy.deepcopy(node)
+        for child in list(node):
+            if child.tag in SERVER_TAGS:
+                node.remove(child)
+        node.attrib.pop(ETAG, None)
+
+        return node
+
+    def _entry_out (self, rec, kind):
+        node = copy.deepcopy(rec['node'])
+        node.set(ETAG, rec['etag'])
+
+        eid = '%s/%s' % (self._feed_url(kind, 'base'), rec['key'])
+        edit = '%s/%s' % (self._feed_url(kind), rec['key'])
+
+        node.insert(0, ET.Element(Q('atom', 'id')))
+        node[0].text = eid
+        node.insert(1, ET.Element(Q('atom', 'updated')))
+        node[1].text = timestamp(rec['updated'])
+
+        for rel in ['self', 'edit']:
+            ET.SubElement(node, Q('atom', 'link'), rel=rel, href=edit,
+                          type='application/atom+xml')
+        if rec.get('deleted'):
+            ET.SubElement(node, Q('gd', 'deleted'))
+
+        return node
+
+    def _feed (self, kind, nodes, total, start, size, params=None):
+        url  = self._feed_url(kind)
+        feed = ET.Element(Q('atom', 'feed'))
+        ET.SubElement(feed, Q('atom', 'id')).text = url
+        ET.SubElement(feed, Q('atom', 'updated')).text = timestamp(time.time())
+        ET.SubElement(feed, Q('atom', 'title')).text = (
+            "%s's %s" % (self.user, kind.capitalize()))
+
+        ET.SubElement(feed, Q('atom', 'link'), rel='self', href=url,
+                      type='application/atom+xml')
+        ET.SubElement(feed, Q('atom', 'link'), rel=NS['gd'] + '#post',
+                      href=url, type='application/atom+xml')
+        ET.SubElement(feed, Q('atom', 'link'), rel=NS['gd'] + '#batch',
+                      href=url + '/batch', type='application/atom+xml')
+
+        if start - 1 + size < total:
+            query = dict(params or {})
+            query['start-index'] = str(start + size)
+            query['max-results'] = str(size)
+            ET.SubElement(feed, Q('atom', 'link'), rel='next',
+                          href='%s?%s' % (url, urllib.urlencode(query)),
+                          type='application/atom+xml')
+
+        ET.SubElement(feed, Q('openSearch', 'totalResults')).text = str(total)
+        ET.SubElement(feed, Q('openSearch', 'startIndex')).text = str(start)
+        ET.SubElement(feed, Q('openSearch', 'itemsPerPage')).text = str(size)
+
+        feed.extend(nodes)
+        return feed
+
+    ##
+    ## Single entry operations and batches
+    ##
+
+    def create_contact (self, node):
+        with self.lock:
+            return self._entry_out(self._insert(node), 'contacts')
+
+    def update_contact (self, key, node, etag):
+        with self.lock:
+            rec = self._find(key)
+            self._update(rec, node, etag or node.get(ETAG))
+            return self._entry_out(rec, 'contacts')
+
+    def remove_contact (self, key, etag):
+        with self.lock:
+            self._delete(self._find(key), etag)
+
+    def run_batch (self, feed, interrupt_after=None):
+        """Carry out the operations in the batch feed, and return the
+        response feed. Processing stops at the first entry Google would
+        refuse to parse, or after interrupt_after entries if specified, and
+        the remaining entries are left unprocessed."""
+
+        if feed is None:
+            raise FakeGCError(400, 'Empty batch feed')
+
+        entries = feed.findall(Q('atom', 'entry'))
+        resp    = self._feed('contacts', [], len(entries), 1, len(entries))
+        resp.find(Q('atom', 'title')).text = 'Batch Feed'
+        counts  = {'success' : 0, 'error' : 0}
+
+        for i, node in enumerate(entries):
+            if interrupt_after is not None and i >= interrupt_after:
+                self._interrupt(resp, i, counts, len(entries),
+                                'Processing interrupted by the server')
+                break
+
+            bid = node.findtext(Q('batch', 'id'))
+            op  = node.find(Q('batch', 'operation'))
+            op  = op.get('type') if op is not None else 'insert'
+
+            try:
+                with self.lock:
+                    out = self._run_op(op, node)
+                code, reason = (201, 'Created') if op == 'insert' else (
+                    200, 'Success')
+                counts['success'] += 1
+            except FakeGCError, e:
+                if e.code == 400:
+                    self._interrupt(resp, i, counts, len(entries), e.reason)
+                    break
+
+                out = ET.Element(Q('atom', 'entry'))
+                ET.SubElement(out, Q('atom', 'id')).text = node.findtext(
+                    Q('atom', 'id'))
+                code, reason = e.code, e.reason
+                counts['error'] += 1
+
+            if bid is not None:
+                ET.SubElement(out, Q('batch', 'id')).text = bid
+            ET.SubElement(out, Q('batch', 'operation'), type=op)
+            ET.SubElement(out, Q('batch', 'status'), code=str(code),
+                          reason=reason)
+            resp.append(out)
+
+        return resp
+
+    def _run_op (self, op, node):
+        if op == 'insert':
+            return self._entry_out(self._insert(node), 'contacts')
+
+        rec = self._find(node.findtext(Q('atom', 'id')))
+        if op == 'query':
+            pass
+        elif op == 'update':
+            self._update(rec, node, node.get(ETAG))
+        elif op == 'delete':
+            self._delete(rec, node.get(ETAG))
+            return ET.Element(Q('atom', 'entry'))
+        else:
+            raise FakeGCError(400, 'Unknown batch operation: %s' % op)
+
+        return self._entry_out(rec, 'contacts')
+
+    def _interrupt (self, resp, parsed, counts, total, reason):
+        out = ET.SubElement(resp, Q('atom', 'entry'))
+        ET.SubElement(out, Q('atom', 'id')).text = resp.findtext(
+            Q('atom', 'id')) + '/batch'
+        ET.SubElement(out, Q('atom', 'title')).text = 'Fatal Error'
+        ET.SubElement(out, Q('atom', 'content')).text = (
+            'Feed processing was interrupted.')
+        ET.SubElement(out, Q('batch', 'interrupted'), reason=reason,
+                      parsed=str(parsed), success=str(counts['success']),
+                      error=str(counts['error']),
+                      unprocessed=str(total - parsed))
+
+class FakeGCHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    ## Matches /m8/feeds/<kind>/<user>/<projection>[/<key>]
+    path_re = re.compile(r'^/m8/feeds/(contacts|groups)/([^/]+)/'
+                         r'(full|base|thin)(?:/([^/?]+))?/?$')
+
+    def setup (self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.count('connections')
+
+    def log_message (self, fmt, *args):
+        logging.debug('fake_gc: ' + fmt, *args)
+
+    def do_GET (self):
+        self._handle('GET')
+
+    def do_POST (self):
+        self._handle('POST')
+
+    def do_PUT (self):
+        self._handle('PUT')
+
+    def do_DELETE (self):
+        self._handle('DELETE')
+
+    def _handle (self, method):
+        self.server.count('requests')
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        url    = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        body   = self._read_body()
+        store  = self.server.get_store()
+
+        m = self.path_re.match(url.path)
+        if not m:
+            return self._send(404, 'Not Found')
+
+        kind, user, proj, key = m.groups()
+        etag = self.headers.get('If-Match')
+
+        try:
+            node = ET.fromstring(body) if body else None
+        except ET.ParseError, e:
+            return self._send(400, 'Invalid XML: %s' % e)
+
+        try:
+            if kind == 'groups':
+                if method == 'GET' and not key:
+                    return self._send(200, store.groups_feed())
+                elif method == 'POST' and not key:
+                    return self._send(201, store.create_group(node))
+                elif method == 'DELETE' and key:
+                    store.delete_group(key)
+                    return self._send(200, '')
+            elif key == 'batch' and method == 'POST':
+                self.server.count('batches')
+                return self._send(200, store.run_batch(
+                    node, self.server.interrupt_after))
+            elif method == 'GET' and not key:
+                self.server.count('pages')
+                return self._send(200, store.contacts_feed(params))
+            elif method == 'GET':
+                return self._send(200, store.get_contact(key))
+            elif method == 'POST' and not key:
+                return self._send(201, store.create_contact(node))
+            elif method == 'PUT' and key:
+                return self._send(200, store.update_contact(key, node, etag))
+            elif method == 'DELETE' and key:
+                store.remove_contact(key, etag)
+                return self._send(200, '')
+        except FakeGCError, e:
+            return self._send(e.code, e.reason)
+
+        return self._send(405, 'Method not allowed')
+
+    def _read_body (self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else ''
+
+    def _send (self, code, body):
+        if ET.iselement(body):
+            body = ET.tostring(body, encoding='UTF-8')
+            ctype = ATOM_TYPE
+        else:
+            ctype = 'text/plain; charset=UTF-8'
+
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class FakeGCServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A threaded http server serving the contacts of a FakeGCStore. latency
+    is the number of seconds every request is delayed by, and if
+    interrupt_after is specified every batch is interrupted after that many
+    entries."""
+
+    daemon_threads      = True
+    allow_reuse_address = True
+
+    def __init__ (self, port=0, store=None, latency=0, interrupt_after=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           FakeGCHandler)
+        self.store   = store if store else FakeGCStore()
+        self.latency = latency
+        self.interrupt_after = interrupt_after
+        self.thread  = None
+        self.stats   = {}
+        self.stats_lock = threading.Lock()
+
+        self.store.set_url(self.get_url())
+
+    def get_url (self):
+        return 'http://%s:%d' % self.server_address
+
+    def get_store (self):
+        return self.store
+
+    def count (self, kind):
+        with self.stats_lock:
+            self.stats[kind] = self.stats.get(kind, 0) + 1
+
+    def get_stats (self):
+        with self.stats_lock:
+            return dict(self.stats)
+
+    def start (self):
+        """Serve requests on a background thread. Returns the url of the
+        server."""
+
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       name='fake-gc')
+        self.thread.daemon = True
+        self.thread.start()
+
+        return self.get_url()
+
+    def stop (self):
+        self.shutdown()
+        self.server_close()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+def rich_fields (i):
+    """Return the elements of a contact entry with a bit of everything ASynK
+    knows about, for the ith contact."""
+
+    ret = ET.fromstring(
+        '<entry xmlns="%s" xmlns:gd="%s" xmlns:gContact="%s">'
+        '<content>Met at the conference in %d</content>'
+        '<gContact:nickname>Nick%05d</gContact:nickname>'
+        '<gd:email rel="%s#work" address="last%05d@work.example.com"/>'
+        '<gd:phoneNumber label="Mobile" primary="true">+91 90084 %05d'
+        '</gd:phoneNumber>'
+        '<gd:phoneNumber rel="%s#work">+1 415 555 %04d</gd:phoneNumber>'
+        '<gd:structuredPostalAddress label="Home" primary="true">'
+        '<gd:street>%d Some Street</gd:street><gd:city>Chennai</gd:city>'
+        '<gd:postcode>600%03d</gd:postcode><gd:country>India</gd:country>'
+        '</gd:structuredPostalAddress>'
+        '<gd:organization rel="%s#work" primary="true"><gd:orgName>ACME'
+        '</gd:orgName><gd:orgTitle>Engineer</gd:orgTitle></gd:organization>'
+        '<gContact:birthday when="1980-05-%02d"/>'
+        '<gContact:website href="http://www.example.com/~%d" rel="home-page"/>'
+        '<gd:im address="first%05d@jabber.org" rel="%s#other" '
+        'protocol="%s#JABBER"/>'
+        '<gContact:userDefinedField key="asynk:bbgc:bb" value="bench-%08d"/>'
+        '<gContact:userDefinedField key="created" '
+        'value="2013-12-06T14:33:49"/>'
+        '</entry>' % (NS['atom'], NS['gd'], NS['gContact'], 2000 + i % 20,
+                      i, NS['gd'], i, i, NS['gd'], i % 10000, i, i % 1000,
+                      NS['gd'], 1 + i % 28, i, i, NS['gd'], NS['gd'], i))
+
+    return list(ret)
+
+def populate (store, cnt, rich=False):
+    for i in xrange(cnt):
+        store.add_contact('First%05d Last%05d' % (i, i),
+                          'first%05d@example.com' % i,
+                          extra=rich_fields(i) if rich else None)
+
+def usage ():
+    print ('python fake_gc.py [--port port] [--contacts cnt] '
+           '[--latency secs] [--interrupt-after cnt]')
+
+def main (argv=None):
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], '',
+                                   ['port=', 'contacts=', 'latency=',
+                                    'interrupt-after=', 'help'])
+    except getopt.error, msg:
+        usage()
+        sys.exit(2)
+
+    port, cnt, latency, intr = 0, 0, 0, None
+    for option, arg in opts:
+        if option == '--port':
+            port = int(arg)
+        elif option == '--contacts':
+            cnt = int(arg)
+        elif option == '--latency':
+            latency = float(arg)
+        elif option == '--interrupt-after':
+            intr = int(arg)
+        elif option == '--help':
+            usage()
+            sys.exit(0)
+
+    server = FakeGCServer(port, latency=latency, interrupt_after=intr)
+    populate(server.get_store(), cnt, rich=True)
+
+    logging.info('Serving %d contacts for %s at %s', cnt,
+                 server.get_store().get_user(), server.get_url())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    main()
@@ -24,7 +24,8 @@
 ##
 ## Usage is: python test_bb.py <bbdbfile>
 
-import glob, logging, os, re, shutil, sys, traceback, unittest
+import codecs, glob, logging, os, re, shutil, sys, threading, traceback
+import unittest
 
 ## Being able to fix the sys.path thusly makes is easy to execute this
 ## script standalone from IDLE. Hack it is, but what the hell.
@@ -34,9 +35,11 @@ EXTRA_PATHS = [os.path.join(DIR_PATH, 'lib'), os.path.join(DIR_PATH, 'asynk')]
 sys.path = EXTRA_PATHS + sys.path
 
 from state         import Config
+from folder        import SyncToken
 from pimdb_bb      import BBPIMDB
 from folder_bb     import BBContactsFolder
 from contact_bb    import BBContact
+import parser_bb, pimdb_bb
 
 asynk_base_dir = os.path.abspath(os.path.join("..", ".."))
 user_dir   = os.path.abspath('user_dir')
@@ -106,6 +109,190 @@ class TestBBDB(unittest.TestCase):
         if ver_check:
             assert(ver_check == self.bb.get_def_msgstore().get_file_format())
 
+    def test_rec_parsers (self):
+        ## The sexp and regex record parsers should agree on every field of
+        ## every record.
+        ms = self.bb.get_def_msgstore()
+        if not os.path.getsize(self.bbdbfn):
+            return
+
+        regexes = self.bb.get_regexes(ms.get_file_format())
+        fields  = regexes['con_fields']
+
+        with codecs.open(self.bbdbfn, encoding=ms.get_encoding()) as bbf:
+            recs = [x.strip() for x in bbf if x.strip().startswith('[')]
+
+        for rec in recs:
+            r = re.search(regexes['con_re'], rec).groupdict()
+            s = parser_bb.parse_rec(rec, fields)
+            for f in fields:
+                self.assertEqual(r[f], s[f])
+
+    def test_sexp_bad_rec (self):
+        fields = self.bb.get_regexes('7')['con_fields']
+        self.assertRaises(parser_bb.BBDBSexpError, parser_bb.parse_rec,
+                          '["John" "Doe" nil nil', fields)
+        self.assertRaises(parser_bb.BBDBSexpError, parser_bb.parse_rec,
+                          '["John" "Doe" nil]', fields)
+
+    def test_lazy_store (self):
+        ## A lazily indexed store should have the same contacts, and report
+        ## the same sync related fields as a fully parsed one.
+        dbc = self.config.get_db_config('bb')
+        dbc['lazy_store'] = True
+        try:
+            lazy = BBPIMDB(self.config, bbfn)
+        finally:
+            dbc['lazy_store'] = False
+
+        ms  = self.bb.get_def_msgstore()
+        lms = lazy.get_def_msgstore()
+        self.assertEqual(sorted(ms.get_folders().keys()),
+                         sorted(lms.get_folders().keys()))
+
+        for name, f in ms.get_folders().iteritems():
+            lf   = lms.get_folder(name)
+            cons = f.get_contacts()
+            refs = lf.get_contacts(materialize=False)
+
+            for iid, ref in refs.iteritems():
+                if iid not in cons:
+                    ## Records without a bbdb-id get a new UUID on each parse
+                    continue
+                con = cons[iid]
+                self.assertEqual(con.get_updated(), ref.get_updated())
+                self.assertEqual(con.get_sync_tags(), ref.get_sync_tags())
+
+                lcon = lf.find_item(iid)
+                self.assertEqual(lcon.get_itemid(), iid)
+                self.assertEqual(con.init_rec_from_props(),
+                                 lcon.init_rec_from_props())
+
+            self.assertEqual(len(cons), len(lf.get_contacts()))
+
+    def test_sniff_encoding (self):
+        ## The encoding decided up front should be the one the file was
+        ## actually parsed with, and should be cached for the next run.
+        ms = self.bb.get_def_msgstore()
+        if not os.path.exists(self.bbdbfn):
+            return
+
+        fn = os.path.realpath(self.bbdbfn)
+        self.assertEqual(ms.sniff_encoding(fn), ms.get_encoding())
+        self.assertEqual(self.config.get_bb_encoding(fn)['encoding'],
+                         ms.get_encoding())
+
+    def test_parallel_parse (self):
+        ## Parsing in a pool of processes should give the same contacts as a
+        ## serial parse.
+        dbc = self.config.get_db_config('bb')
+        dbc['parse_processes'] = 2
+        try:
+            par = BBPIMDB(self.config, bbfn)
+        finally:
+            dbc['parse_processes'] = 1
+
+        ms  = self.bb.get_def_msgstore()
+        pms = par.get_def_msgstore()
+        self.assertEqual(ms.get_preamble(), pms.get_preamble())
+        self.assertEqual(sorted(ms.get_folders().keys()),
+                         sorted(pms.get_folders().keys()))
+
+        for name, f in ms.get_folders().iteritems():
+            cons  = f.get_contacts()
+            pcons = pms.get_folder(name).get_contacts()
+            self.assertEqual(len(cons), len(pcons))
+
+            for iid, con in cons.iteritems():
+                if not con.get_rec():
+                    ## Records without a bbdb-id get a new UUID on each parse
+                    continue
+                pcon = pcons[iid]
+                self.assertEqual(con.get_rec(), pcon.get_rec())
+                self.assertEqual(con.init_rec_from_props(),
+                                 pcon.init_rec_from_props())
+
+    def test_parse_in_thread (self):
+        ## With other threads around the records are parsed without forking
+        ## a pool of workers.
+        dbc = self.config.get_db_config('bb')
+        dbc['parse_processes'] = 2
+        pools = []
+        orig  = pimdb_bb.multiprocessing.Pool
+        pimdb_bb.multiprocessing.Pool = lambda *args: pools.append(args)
+        res = {}
+        try:
+            t = threading.Thread(target=lambda: res.update(
+                {'bb' : BBPIMDB(self.config, bbfn)}))
+            t.start()
+            t.join()
+        finally:
+            pimdb_bb.multiprocessing.Pool = orig
+            dbc['parse_processes'] = 1
+
+        self.assertEqual(pools, [])
+        pms = res['bb'].get_def_msgstore()
+        for name, f in self.bb.get_def_msgstore().get_folders().iteritems():
+            self.assertEqual(len(f.get_contacts()),
+                             len(pms.get_folder(name).get_contacts()))
+
+    def test_sync_token (self):
+        ## An item is modified if it is after the mark, or at the mark but
+        ## not seen then. A token saved for another folder is not used.
+        early, mark, late = ('2013-08-10T06:17:19', '2013-08-10T06:17:20',
+                             '2013-08-10T06:17:21')
+
+        tok = SyncToken('f1')
+        self.assertFalse(tok.is_valid())
+        tok.note('a', early)
+        tok.note('b', mark)
+        tok.note('c', mark)
+        tok.note_write('d', early)
+        tok.note_write('e', late)
+
+        state = tok.get_state()
+        self.assertEqual(state['mark'], mark)
+        self.assertEqual(state['seen'], {'b' : mark, 'c' : mark, 'e' : late})
+
+        tok = SyncToken('f1', state)
+        self.assertTrue(tok.is_valid())
+        self.assertFalse(tok.is_modified('a', early))
+        self.assertFalse(tok.is_modified('d', early))
+        self.assertFalse(tok.is_modified('b', mark))
+        self.assertTrue(tok.is_modified('x', mark))
+        self.assertTrue(tok.is_modified('b', late))
+        self.assertFalse(tok.is_modified('e', late))
+        self.assertTrue(tok.is_modified('a', late))
+
+        self.assertFalse(SyncToken('f2', state).is_valid())
+        self.assertEqual(SyncToken('f2').get_state(), None)
+
+    def test_sync_token_limit (self):
+        ## A record from the future does not move the mark, and keeps showing
+        ## up as modified. A saved mark from the future is not used.
+        past, now, future = ('2013-08-10T06:17:20', '2013-08-10T06:20:00',
+                             '2038-01-01T00:00:00')
+
+        tok = SyncToken('f1')
+        tok.set_limit(now)
+        tok.note('a', past)
+        tok.note('b', future)
+
+        state = tok.get_state()
+        self.assertEqual(state['mark'], past)
+        self.assertEqual(state['seen'], {'a' : past})
+
+        tok = SyncToken('f1', state)
+        tok.set_limit(now)
+        self.assertTrue(tok.is_valid())
+        self.assertTrue(tok.is_modified('b', future))
+        self.assertTrue(tok.is_modified('c', now))
+
+        tok = SyncToken('f1', {'fid' : 'f1', 'mark' : future, 'seen' : {}})
+        self.assertTrue(tok.is_valid())
+        tok.set_limit(now)
+        self.assertFalse(tok.is_valid())
+
     def get_ver_from_filename (self):
         v = re.search('\.v(\d+)\.', self.bbdbfn)
         return v.group(1) if v else None
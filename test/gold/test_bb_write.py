@@ -35,9 +35,10 @@ EXTRA_PATHS = [os.path.join(DIR_PATH, 'lib'), os.path.join(DIR_PATH, 'asynk')]
 sys.path = EXTRA_PATHS + sys.path
 
 from state         import Config
-from pimdb_bb      import BBPIMDB
+from pimdb_bb      import BBPIMDB, MessageStore
 from folder_bb     import BBContactsFolder
 from contact_bb    import BBContact
+from sync          import SyncLists
 
 asynk_base_dir = DIR_PATH
 user_dir   = os.path.abspath('user_dir')
@@ -71,6 +72,29 @@ def main (argv=None):
     suite = unittest.TestLoader().loadTestsFromTestCase(TestBBDBWrite)
     unittest.TextTestRunner(verbosity=2).run(suite)
 
+class ChunkedSource:
+    """Source folder of a send to BBDB, which passes itself off as a
+    Google folder with a batch size of two, so that the send is done in
+    several chunks."""
+
+    def __init__ (self, fold):
+        self.fold = fold
+
+    def get_dbid (self):
+        return 'gc'
+
+    def get_db (self):
+        return None
+
+    def get_batch_size (self):
+        return 2
+
+    def find_items (self, itemids):
+        return self.fold.find_items(itemids)
+
+    def writeback_sync_tags (self, pname, items):
+        return self.fold.writeback_sync_tags(pname, items)
+
 class TestBBDBWrite(unittest.TestCase):
     def setUp (self):
         self.config = config
@@ -166,6 +190,180 @@ class TestBBDBWrite(unittest.TestCase):
         self.deff.save()
         self.reparse(self.bbdbfn)
 
+    def test_lazy_save (self):
+        for i in range(3):
+            con = BBContact(self.deff)
+            con.set_firstname('Test Lazy %d' % i)
+            con.set_lastname(u'Héctor')
+            self.deff.add_contact(con)
+        self.deff.save()
+
+        dbc = self.config.get_db_config('bb')
+        dbc['lazy_store'] = True
+        try:
+            self.reparse(self.bbdbfn)
+        finally:
+            dbc['lazy_store'] = False
+
+        ## Modify one record, and save while the others are still unparsed
+        cons = self.deff.get_contacts(materialize=False)
+        iids = sorted(cons.keys())
+        con  = self.deff.find_item(iids[0])
+        con.set_nickname('Lazy')
+        self.deff.add_contact(con)
+        self.deff.save()
+
+        ## Unparsed records should still be readable after the save
+        for iid in iids[1:]:
+            self.assertTrue(re.search('Test Lazy',
+                                      self.deff.find_item(iid).get_name()))
+
+        self.reparse(self.bbdbfn)
+        cons = self.deff.find_contacts_by_name(name='Test Lazy')
+        self.assertEqual(len(cons), 3)
+        self.assertEqual(self.deff.find_item(iids[0]).get_nickname(), 'Lazy')
+
+    def test_incremental_save (self):
+        for i in range(2):
+            con = BBContact(self.deff)
+            con.set_firstname('Test Incremental %d' % i)
+            self.deff.add_contact(con)
+        self.deff.save()
+
+        ## A hand edited record, with spacing that ASynK would never generate
+        rec = ('[ "Test"  "Verbatim"   nil nil nil nil nil nil '
+               '((bbdb-id . "test-verbatim-0001"))  "test-verbatim-0001" '
+               '"" "2013-12-20 17:56:49 +0000" nil ]')
+        with open(self.bbdbfn, 'a') as bbf:
+            bbf.write(rec + '\n')
+
+        self.reparse(self.bbdbfn)
+        cons = self.deff.find_contacts_by_name(name='Test Incremental 0')
+        self.assertEqual(len(cons), 1)
+        cons[0].set_nickname('Changed')
+        self.deff.save()
+
+        with open(self.bbdbfn) as bbf:
+            lines = bbf.read().splitlines()
+        self.assertTrue(rec in lines)
+        self.assertFalse(os.path.exists(self.bbdbfn + '.tmp'))
+
+        self.reparse(self.bbdbfn)
+        cons = self.deff.find_contacts_by_name(name='Test Incremental 0')
+        self.assertEqual(cons[0].get_nickname(), 'Changed')
+        self.assertEqual(len(self.deff.find_contacts_by_name(name='Verbatim')),
+                         1)
+
+    def test_latin1_file (self):
+        ## A latin-1 file that claims to be utf-8 in its coding cookie
+        with open(self.bbdbfn, 'w') as bbf:
+            bbf.write(';; -*-coding: utf-8-emacs;-*-\n')
+            bbf.write(';;; file-format: 7\n')
+            bbf.write('["Test" "H\xe9ctor" nil nil nil nil nil nil '
+                      '((bbdb-id . "test-latin1-0001")) nil]\n')
+
+        self.reparse(self.bbdbfn)
+        ms = self.bb.get_def_msgstore()
+        self.assertEqual(ms.get_encoding(), 'latin-1')
+        cons = self.deff.find_contacts_by_name(name='Test')
+        self.assertEqual(cons[0].get_lastname(), u'H\xe9ctor')
+
+        fn = os.path.realpath(self.bbdbfn)
+        self.assertEqual(self.config.get_bb_encoding(fn)['encoding'],
+                         'latin-1')
+
+        ## Saving should keep the encoding, and the cache in step with the
+        ## file
+        cons[0].set_nickname('Latin')
+        self.deff.save()
+        with open(self.bbdbfn) as bbf:
+            self.assertTrue('H\xe9ctor' in bbf.read())
+        self.assertEqual(ms.sniff_encoding(fn), 'latin-1')
+
+        ## and state.json is not written again if the cache is up to date
+        writes = []
+        self.config.set_bb_encoding = lambda *args: writes.append(args)
+        try:
+            ms._cache_encoding(fn, os.stat(fn), 'latin-1')
+        finally:
+            del self.config.set_bb_encoding
+        self.assertEqual(writes, [])
+
+    def test_sync_tags (self):
+        con = BBContact(self.deff)
+        con.set_firstname('Test Sync Tags')
+        con.update_sync_tags('asynk:bbgc:gc', 'gc-1')
+        con.update_sync_tags('asynk:bbol:ol', 'ol-1')
+        con.update_sync_tags('asynk:other:gc', 'gc-2')
+
+        self.assertEqual(self.config.parse_sync_label('asynk:bbgc:gc'),
+                         ('bbgc', 'gc'))
+        self.assertEqual(self.config.parse_sync_label('asynk:bbgc:[a-z]+'),
+                         None)
+
+        self.assertEqual(con.get_sync_tags('asynk:bbgc:gc'),
+                         [('asynk:bbgc:gc', 'gc-1')])
+        self.assertEqual(con.get_sync_tags('asynk:bbcd:cd'), [])
+        self.assertEqual(sorted(con.get_sync_tags('asynk:[a-z]+:gc')),
+                         [('asynk:bbgc:gc', 'gc-1'), ('asynk:other:gc', 'gc-2')])
+
+        self.assertEqual(con.get_itemid_from_synctags('bbgc', 'gc'), 'gc-1')
+        self.assertEqual(con.get_itemid_from_synctags('bbcd', 'cd'), None)
+
+        self.assertTrue(con.del_sync_tags('asynk:bbgc:[a-z]+'))
+        self.assertEqual(con.get_itemid_from_synctags('bbgc', 'gc'), None)
+
+    def test_send_later_chunk_fails (self):
+        iids = []
+        for i in range(5):
+            con = BBContact(self.deff)
+            con.set_firstname('Test Send %d' % i)
+            self.deff.add_contact(con)
+            iids.append(con.get_itemid())
+        self.deff.save()
+
+        dstfn = os.path.join(CUR_DIR, 'temp-dst.bbdb')
+        dst   = BBPIMDB(self.config, dstfn)
+        store = dst.get_def_msgstore()
+        dstf  = store.get_folder(store.get_def_folder_name())
+
+        ## Any save of more than the first chunk of the send fails
+        saves = []
+        def save_file (fn=None):
+            saves.append(len(dstf.get_contacts()))
+            if len(dstf.get_contacts()) > 2:
+                raise IOError('Disk full')
+            MessageStore.save_file(store, fn)
+        store.save_file = save_file
+
+        try:
+            sl = SyncLists(ChunkedSource(self.deff), 'bbgc')
+            sl.news = list(iids)
+            self.assertFalse(sl.send_news_to_folder(dstf))
+            self.assertEqual(saves, [5])
+
+            ## Whatever made it to the destination file is what the source
+            ## has sync tags for; anything else the next sync would take as
+            ## deleted from BBDB and delete from the source.
+            dst   = BBPIMDB(self.config, dstfn)
+            store = dst.get_def_msgstore()
+            dstf  = store.get_folder(store.get_def_folder_name())
+            self.reparse(self.bbdbfn)
+            oldi = {}
+            for iid in iids:
+                bbid = self.deff.find_item(iid).get_itemid_from_synctags(
+                    'bbgc', 'bb')
+                if bbid:
+                    oldi.update({iid : bbid})
+            curi = dstf.get_itemids('bbgc', 'gc')
+
+            dsl = SyncLists(dstf, 'bbgc')
+            dsl.add_dels(oldi, curi, False, 'BBDB')
+            self.assertEqual(dsl.get_dels(), {})
+        finally:
+            if os.path.exists(dstfn):
+                os.remove(dstfn)
+
 if __name__ == '__main__':
     if '--debug' in sys.argv:
         logging.getLogger().setLevel(logging.DEBUG)
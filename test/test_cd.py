@@ -23,7 +23,7 @@
 ## unit tests. code often moves from here to the unittest directory (gold/)
 ## after a while
 
-import logging, os, shutil, sys
+import logging, os, shutil, sys, threading, time, unittest
 
 ## Being able to fix the sys.path thusly makes is easy to execute this
 ## script standalone from IDLE. Hack it is, but what the hell.
@@ -33,8 +33,12 @@ EXTRA_PATHS = [os.path.join(DIR_PATH, 'lib'), os.path.join(DIR_PATH, 'asynk')]
 sys.path = EXTRA_PATHS + sys.path
 
 from state         import Config
+from pimdb         import PIMDB
 from pimdb_cd      import CDPIMDB
-from contact_cd    import CDContact
+from folder_cd     import CDContactsFolder, CDSyncToken, CDContactCache
+from contact_cd    import CDContact, vcf_digest
+from sync          import SyncLists
+import vobject
 
 user_dir   = os.path.abspath('user_dir')
 state_src  = os.path.join('.', 'state.test.json')
@@ -71,6 +75,10 @@ def clear_def_folder (cd):
 
 def main (argv=None):
     setup_config()
+
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestCDOffline)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+
     user = raw_input('Enter Username:')
     pw   = raw_input('Password:')
     #url = 'https://localhost:8443'
@@ -115,6 +123,317 @@ def create_contact (cd):
     c.save()
     print c
 
+## Stand-ins for the login and the sessions of the CardDAV client library, so
+## that the folder code can be exercised without a server.
+
+class FakeSession:
+    def __init__ (self):
+        self.closed = False
+
+    def closeConnection (self):
+        self.closed = True
+
+class FakePrincipal:
+    displayname = 'Test'
+
+class FakeAccount:
+    def __init__ (self):
+        self.session   = FakeSession()
+        self.principal = FakePrincipal()
+
+class FakeDest:
+    """Destination of a send from a CardDAV folder, which takes the contacts
+    one at a time and keeps nothing."""
+
+    def get_dbid (self):
+        return 'gc'
+
+    def get_db (self):
+        return None
+
+    def get_batch_size (self):
+        return 1
+
+    def batch_create (self, sl, srcdbid, items):
+        return True
+
+def vcf (name, tag=None):
+    v = 'BEGIN:VCARD\r\nVERSION:3.0\r\nFN:%s\r\nN:%s;;;;\r\n' % (name, name)
+    if tag:
+        v += 'X-ASYNK-SYNCTAG-TEST-BB:%s\r\n' % tag
+    return v + 'END:VCARD\r\n'
+
+class TestCDOffline(unittest.TestCase):
+    """Tests of the CardDAV folder code that do not need a server."""
+
+    def setUp (self):
+        self.logins = []
+
+        ## Everything CDPIMDB.__init__() does, short of talking to the server
+        db = CDPIMDB.__new__(CDPIMDB)
+        PIMDB.__init__(db, config)
+        db.set_user('test')
+        db.set_pw('')
+        db.set_client_logging(False)
+        db.parse_uri('http://localhost:8008/addressbooks/')
+        db._new_account = self.new_account
+        db.cd_init()
+
+        self.db     = db
+        self.folder = CDContactsFolder(db, '/ab/', 'ab', '/')
+        self.cfn    = os.path.join(user_dir, 'test-cache.pickle')
+
+    def tearDown (self):
+        if os.path.exists(self.cfn):
+            os.remove(self.cfn)
+
+    def new_account (self):
+        acc = FakeAccount()
+        self.logins.append(acc)
+        return acc
+
+    def new_contact (self, name, etag=None):
+        con = CDContact(self.folder, vco=vobject.readOne(vcf(name, name)),
+                        itemid=name)
+        con.set_etag(etag)
+        con.set_digest(vcf_digest(vcf(name, name)))
+        return con
+
+    def run_jobs (self, fn, jobs, limit):
+        return list(self.folder._run_concurrent(fn, jobs, limit))
+
+    ##
+    ## _run_concurrent() and the sessions of its threads
+    ##
+
+    def test_run_serial (self):
+        ## With a limit of one the jobs run here, in order
+        seen = []
+        ret  = self.run_jobs(lambda x: seen.append(
+            threading.current_thread()) or x * x, range(5), 1)
+
+        self.assertEqual(ret, [(x, x * x, None) for x in range(5)])
+        self.assertEqual(set(seen), set([threading.current_thread()]))
+        self.assertEqual(len(self.logins), 1)
+
+    def test_run_completion_order (self):
+        ## Results come in the order the jobs complete, and all of them do
+        def fn (x):
+            if x == 0:
+                time.sleep(0.3)
+            return x * x
+
+        ret = self.run_jobs(fn, range(6), 2)
+
+        self.assertEqual(sorted(ret), [(x, x * x, None) for x in range(6)])
+        self.assertNotEqual(ret[0][0], 0)
+        self.assertEqual(ret[-1][0], 0)
+
+    def test_run_errors (self):
+        ## An exception is passed back with its job, and the others go on
+        def fn (x):
+            if x == 3:
+                raise ValueError('job %d' % x)
+            return x
+
+        ret = dict([(job, (val, err)) for job, val, err in
+                    self.run_jobs(fn, range(8), 4)])
+
+        self.assertEqual(sorted(ret.keys()), range(8))
+        val, err = ret[3]
+        self.assertEqual(val, None)
+        self.assertEqual(err[0], ValueError)
+        self.assertEqual(str(err[1]), 'job 3')
+        for x in range(8):
+            if x != 3:
+                self.assertEqual(ret[x], (x, None))
+
+    def test_run_close_early (self):
+        ## Giving up on the results leaves no threads behind
+        before = threading.active_count()
+        it = self.folder._run_concurrent(lambda x: time.sleep(0.01),
+                                         range(20), 4)
+        it.next()
+        it.close()
+        self.assertEqual(threading.active_count(), before)
+
+    def test_sessions_reused (self):
+        ## The threads of a later call get the sessions of the earlier ones
+        ## instead of logging in again, and the spares are closed at the end
+        def fn (x):
+            time.sleep(0.01)
+            return self.db.session()
+
+        first  = set([x[1] for x in self.run_jobs(fn, range(8), 4)])
+        logins = len(self.logins)
+        second = set([x[1] for x in self.run_jobs(fn, range(8), 4)])
+
+        self.assertTrue(logins <= 5)
+        self.assertEqual(len(self.logins), logins)
+        self.assertTrue(second <= first)
+        self.assertFalse(self.db.get_account().session in first)
+
+        self.db.close_idle()
+        self.assertTrue(all([x.closed for x in first]))
+        self.assertFalse(self.db.get_account().session.closed)
+        self.assertEqual(self.db.spares, [])
+
+    def test_sessions_released_by_send (self):
+        ## The session the source thread of a send opens is given back when
+        ## the thread is done, and closed along with the other spares
+        used = set()
+        def find_items (itemids):
+            used.add(self.db.session())
+            return itemids
+
+        self.folder.find_items = find_items
+        self.folder.writeback_sync_tags = lambda pname, items: True
+        self.folder.get_batch_size = lambda: 1
+
+        sl = SyncLists(self.folder, 'p')
+        sl.add_new('a')
+        sl.add_new('b')
+        self.assertTrue(sl.send_news_to_folder(FakeDest()))
+
+        self.assertEqual(len(used), 1)
+        self.assertEqual(self.db.spares, list(used))
+        self.db.close_idle()
+        self.assertTrue(all([x.closed for x in used]))
+
+    ##
+    ## CDSyncToken
+    ##
+
+    def test_sync_token (self):
+        cache = CDContactCache(self.cfn, '/ab/')
+        token = CDSyncToken('/ab/', None, cache, 'p')
+        self.assertFalse(token.is_valid())
+        self.assertEqual(token.get_new_items(), None)
+        self.assertEqual(token.get_state(), None)
+
+        a = self.new_contact('a', 'e1')
+        b = self.new_contact('b', 'e2')
+        items = dict([(x.get_itemid(), CDSyncToken.item_state(x))
+                      for x in [a, b]])
+        token.set_new('tok1', 'ctag1', items)
+
+        ## What we write is noted with its digest, and the etag if the server
+        ## sent one
+        c = self.new_contact('c')
+        token.note_write(c)
+        token.note_delete('b')
+        self.assertEqual(sorted(token.get_new_items().keys()), ['a', 'c'])
+
+        state = token.get_state()
+        self.assertEqual(sorted(state.keys()),
+                         ['ctag', 'fid', 'stamp', 'sync_token'])
+        self.assertEqual((state['sync_token'], state['ctag']),
+                         ('tok1', 'ctag1'))
+
+        ## The contacts come back from the cache on disk
+        cache = CDContactCache(self.cfn, '/ab/')
+        token = CDSyncToken('/ab/', state, cache, 'p')
+        self.assertTrue(token.is_valid())
+        self.assertEqual(token.get_item('a')['etag'], 'e1')
+        self.assertEqual(token.get_item('c'), {'etag'   : None,
+                                               'digest' : c.get_digest(),
+                                               'tags'   : c.get_sync_tags()})
+        self.assertEqual(token.get_item('b'), None)
+
+        ## ...but only for the folder, the cache and the profile they were
+        ## saved with
+        self.assertFalse(CDSyncToken('/other/', state, cache, 'p').is_valid())
+        self.assertFalse(CDSyncToken('/ab/', state, None, 'p').is_valid())
+        self.assertFalse(CDSyncToken('/ab/', state, cache, 'q').is_valid())
+        self.assertFalse(CDSyncToken('/ab/', dict(state, stamp='x'),
+                                     cache, 'p').is_valid())
+
+        token.set_new('tok2', 'ctag2', {})
+        newer = token.get_state()
+        self.assertNotEqual(newer['stamp'], state['stamp'])
+        cache = CDContactCache(self.cfn, '/ab/')
+        self.assertFalse(CDSyncToken('/ab/', state, cache, 'p').is_valid())
+        self.assertTrue(CDSyncToken('/ab/', newer, cache, 'p').is_valid())
+
+    def test_sync_token_profiles (self):
+        ## Profiles with the same addressbook keep their own state of it
+        cache = CDContactCache(self.cfn, '/ab/')
+        tokp  = CDSyncToken('/ab/', None, cache, 'p')
+        tokq  = CDSyncToken('/ab/', None, cache, 'q')
+        a = self.new_contact('a', 'e1')
+        tokp.set_new('tokp', None, {'a' : CDSyncToken.item_state(a)})
+        tokq.set_new('tokq', None, {})
+        statep = tokp.get_state()
+        stateq = tokq.get_state()
+
+        cache = CDContactCache(self.cfn, '/ab/')
+        tokp  = CDSyncToken('/ab/', statep, cache, 'p')
+        tokq  = CDSyncToken('/ab/', stateq, cache, 'q')
+        self.assertTrue(tokp.is_valid())
+        self.assertTrue(tokq.is_valid())
+        self.assertEqual(tokp.get_item('a')['etag'], 'e1')
+        self.assertEqual(tokq.get_items(), {})
+
+    ##
+    ## CDContactCache
+    ##
+
+    def test_cache (self):
+        cache = CDContactCache(self.cfn, '/ab/')
+        cache.put(self.new_contact('a', 'e1'))
+        cache.put(self.new_contact('b', 'e2'))
+        cache.retain(['a'])
+        self.assertTrue(cache.save())
+
+        cache = CDContactCache(self.cfn, '/ab/')
+        parsed = cache.get('a', 'e1')
+        self.assertEqual(CDContact(self.folder, parsed=parsed,
+                                   itemid='a').get_disp_name(), 'a')
+        self.assertEqual(cache.get_digest('a'), vcf_digest(vcf('a', 'a')))
+        self.assertEqual(cache.get('a', 'e2'), None)
+        self.assertEqual(cache.get('a', None), None)
+        self.assertEqual(cache.get('b', 'e2'), None)
+
+    def test_cache_invalidation (self):
+        ## A cache written for another folder, or with another version, is
+        ## thrown away along with the sync state in it
+        cache = CDContactCache(self.cfn, '/ab/')
+        cache.put(self.new_contact('a', 'e1'))
+        stamp = cache.set_synced('p', {'a' : {}})
+
+        cache = CDContactCache(self.cfn, '/other/')
+        self.assertEqual(cache.get('a', 'e1'), None)
+        self.assertEqual(cache.get_synced('p', stamp), None)
+
+        version = CDContactCache.VERSION
+        CDContactCache.VERSION = version + 1
+        try:
+            cache = CDContactCache(self.cfn, '/ab/')
+        finally:
+            CDContactCache.VERSION = version
+        self.assertEqual(cache.get('a', 'e1'), None)
+        self.assertEqual(cache.get_synced('p', stamp), None)
+
+        cache = CDContactCache(self.cfn, '/ab/')
+        self.assertNotEqual(cache.get('a', 'e1'), None)
+        self.assertEqual(cache.get_synced('p', stamp), {'a' : {}})
+
+        ## Unreadable caches are ignored
+        with open(self.cfn, 'wb') as f:
+            f.write('garbage')
+        cache = CDContactCache(self.cfn, '/ab/')
+        self.assertEqual(cache.get('a', 'e1'), None)
+
+    def test_cache_contacts_off (self):
+        ## With caching of contacts turned off only the sync state is kept
+        cache = CDContactCache(self.cfn, '/ab/', keep_contacts=False)
+        cache.put(self.new_contact('a', 'e1'))
+        stamp = cache.set_synced('p', {'a' : {}})
+
+        cache = CDContactCache(self.cfn, '/ab/', keep_contacts=False)
+        self.assertEqual(cache.get('a', 'e1'), None)
+        self.assertEqual(cache.get_synced('p', stamp), {'a' : {}})
+
 if __name__ == '__main__':
     logging.getLogger().setLevel(logging.DEBUG)
     main()
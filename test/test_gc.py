@@ -14,10 +14,17 @@ import gdata, gdata.data, gdata.contacts.data, gdata.contacts.client
 from   pimdb_gc   import GCPIMDB
 from   contact_gc import GCContact
 from   folder_gc  import BatchState
-import utils
+import fake_gc, shutil, utils
 import xml.etree.ElementTree as ET
 
 def main ():
+    offline = TestGCOffline()
+    try:
+        offline.test_prep_request_count()
+        offline.test_sync_request_count()
+    finally:
+        offline.stop()
+
     tests = TestGCContact()
 
     tests.test_batch_error()
@@ -27,6 +34,104 @@ def main ():
     #tests.test_del_item('http://www.google.com/m8/feeds/contacts/karra.etc%40gmail.com/base/1fabc8309273c15')
     # tests.test_del_item('http://www.google.com/m8/feeds/contacts/karra.etc%40gmail.com/base/1fabc8309273c15')
 
+class TestGCOffline:
+    """Tests that run against the offline stand-in for Google Contacts in
+    fake_gc.py, and need neither credentials nor the network."""
+
+    def __init__ (self, cnt=20):
+        self.cnt    = cnt
+        self.server = fake_gc.FakeGCServer()
+        self.store  = self.server.get_store()
+        fake_gc.populate(self.store, cnt)
+        url = self.server.start()
+
+        self.user_dir = os.path.join(CUR_DIR, 'user_dir')
+        if os.path.exists(self.user_dir):
+            shutil.rmtree(self.user_dir)
+        os.makedirs(self.user_dir)
+        shutil.copyfile(os.path.join(ASYNK_BASE_DIR, 'state.init.json'),
+                        os.path.join(self.user_dir, 'state.json'))
+
+        self.conf = Config(asynk_base_dir=ASYNK_BASE_DIR,
+                           user_dir=self.user_dir)
+        self.conf.get_db_config('gc')['server_url'] = url
+
+        self.pname = 'gcbbtest'
+        profile = self.conf.get_profile_defaults()
+        profile.update({'coll_1' : {'dbid' : 'gc', 'stid' : None,
+                                    'foid' : None},
+                        'coll_2' : {'dbid' : 'bb', 'stid' : None,
+                                    'foid' : None},
+                        'sync_dir'         : 'SYNC2WAY',
+                        'conflict_resolve' : '1'})
+        self.conf.add_profile(self.pname, profile)
+
+        self.pimdb = GCPIMDB(self.conf, self.store.get_user(), None)
+
+    def stop (self):
+        self.server.stop()
+        shutil.rmtree(self.user_dir)
+
+    def test_prep_request_count (self):
+        from   sync       import SyncLists
+
+        ## Change detection should take a single fetch of the group feed -
+        ## of however many pages.
+        f = self.pimdb.get_def_folder()
+        for size in [500, 7]:
+            self.conf.get_db_config('gc')['feed_page_size'] = size
+            sl = SyncLists(f, self.pname)
+
+            before = self.pimdb.get_request_count('list')
+            pages  = self.pimdb.get_request_count('page')
+            f.prep_sync_lists('bb', sl)
+            reqs  = self.pimdb.get_request_count('list') - before
+            pages = self.pimdb.get_request_count('page') - pages
+
+            print 'Listing requests for change detection: %d (%d pages)' % (
+                reqs, pages)
+            assert reqs == 1
+            assert pages == (self.cnt + size - 1) / size
+            assert len(sl.get_news()) == self.cnt
+
+    def test_sync_request_count (self):
+        from   pimdb_bb   import BBPIMDB
+        from   contact_bb import BBContact
+        from   sync       import Sync
+
+        ## A full two way sync, entries going both ways, should list the
+        ## group feed just once: the itemid map saved at the end of the sync
+        ## is built from the change detection and the batches sent.
+        bbfn = os.path.join(self.user_dir, 'gcbbtest.bbdb')
+        bb   = BBPIMDB(self.conf, bbfn)
+        bbf  = bb.get_def_folder()
+        for i in range(5):
+            con = BBContact(bbf)
+            con.set_firstname('BBDB Contact %d' % i)
+            bbf.add_contact(con)
+        bbf.save()
+
+        f = self.pimdb.get_def_folder()
+        self.conf.set_fid1(self.pname, f.get_itemid())
+        self.conf.set_fid2(self.pname, bbf.get_itemid())
+        self.conf.get_db_config('gc')['feed_page_size'] = 7
+        before = self.pimdb.get_request_count('list')
+
+        sync = Sync(self.conf, self.pname, [self.pimdb, bb])
+        assert sync.sync()
+        sync.save_sync_tokens()
+        sync.save_item_lists()
+
+        reqs = self.pimdb.get_request_count('list') - before
+        print 'Listing requests for a full sync: %d' % reqs
+        assert reqs == 1
+
+        ## and the map is the one a fresh listing of the feed would give
+        itemids = self.conf.get_itemids(self.pname)
+        f.set_sync_token(f.new_sync_token())
+        assert itemids == f.get_itemids(self.pname, 'bb')
+        assert len(itemids) == self.cnt + 5
+
 class TestGCContact:
     def __init__ (self):
         self.conf = Config(asynk_base_dir=ASYNK_BASE_DIR, user_dir='./')
@@ -180,16 +285,10 @@ class TestGCContact:
         logging.info('Querying Google for status of Contact Entries...')
 
         updated_min = f.get_config().get_last_sync_stop('gc', 'ol')
-        feed = f._get_group_feed(updated_min=updated_min, showdeleted='false')
-
-        logging.info('Response recieved from Google. Processing...')
-
-        if not feed.entry:
-            logging.info('No entries in feed.')
-            return
 
         contacts = []
-        for i, entry in enumerate(feed.entry):
+        for entry in f._iter_group_feed(updated_min=updated_min,
+                                        showdeleted='false'):
             c = GCContact(f, gce=entry)
             contacts.append(c)
 